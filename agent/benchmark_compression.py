@@ -0,0 +1,92 @@
+import argparse
+import time
+import zlib
+
+from compression import DEFLATE, ZSTD, available_codecs, compress_stream, train_dictionary
+
+# Compression Benchmark
+#
+# Reports the compression ratio and CPU cost per KB of the payload codings on
+# representative log samples (for example agent.log), so the codec, level and
+# dictionary settings in coap_agent.conf can be chosen per deployment.
+#
+# The samples are split into report-sized payloads, each prefixed with the
+# agent's report header, and every payload is compressed on its own as the
+# agent would. With --dictionary a dictionary is trained from the first half of
+# the reports and evaluated on the second half.
+#
+# Usage:
+#   python3 benchmark_compression.py agent.log [more samples...] [--report-size 16384]
+
+HEADER = (b"Timestamp: 2024-01-01T00:00:00.000000\n"
+          b"Memory Usage: 42.00%\n"
+          b"Disk Usage: 37.00%\n"
+          b"Logs:\n")
+
+LEVELS = {DEFLATE: (1, 6, 9), ZSTD: (1, 3, 9, 19)}
+NAMES = {DEFLATE: 'deflate', ZSTD: 'zstd'}
+
+
+def split_reports(data, report_size):
+    """Cut sample data into report payloads at line boundaries."""
+    reports = []
+    start = 0
+    while start < len(data):
+        end = data.rfind(b'\n', start, start + report_size) + 1
+        if end <= start:
+            end = min(start + report_size, len(data))
+        reports.append(HEADER + data[start:end])
+        start = end
+    return reports
+
+
+def measure(reports, codec, level, dictionary, repeat):
+    """Return (ratio, CPU microseconds per KB of input) for compressing each report."""
+    raw = sum(len(report) for report in reports)
+    compressed = 0
+    started = time.process_time()
+    for _ in range(repeat):
+        compressed = 0
+        for report in reports:
+            compressed += sum(len(piece) for piece in compress_stream([report], codec, level, dictionary))
+    cpu = (time.process_time() - started) / repeat
+    return raw / compressed, cpu * 1e6 / (raw / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark payload compression on log samples")
+    parser.add_argument('samples', nargs='+', help="Log files to use as sample data")
+    parser.add_argument('--report-size', type=int, default=16 * 1024,
+                        help="Bytes of log data per report (default: 16384)")
+    parser.add_argument('--dictionary', action='store_true',
+                        help="Also evaluate a dictionary trained on half of the reports")
+    parser.add_argument('--repeat', type=int, default=3, help="Repetitions per measurement")
+    args = parser.parse_args()
+
+    data = b''
+    for path in args.samples:
+        with open(path, 'rb') as f:
+            data += f.read()
+    reports = split_reports(data, args.report_size)
+    if not reports:
+        print("No sample data")
+        return
+
+    variants = [(None, reports)]
+    if args.dictionary:
+        half = max(1, len(reports) // 2)
+        dictionary = train_dictionary(reports[:half])
+        variants.append((dictionary, reports[half:] or reports))
+
+    print(f"{len(reports)} reports, {len(data)} bytes of log data, zlib {zlib.ZLIB_VERSION}")
+    print(f"{'codec':<8} {'level':>5} {'dict':>6} {'ratio':>8} {'us/KB':>9}")
+    for codec in sorted(available_codecs()):
+        for level in LEVELS[codec]:
+            for dictionary, sample in variants:
+                ratio, cost = measure(sample, codec, level, dictionary, args.repeat)
+                dict_size = f"{len(dictionary) // 1024}K" if dictionary else '-'
+                print(f"{NAMES[codec]:<8} {level:>5} {dict_size:>6} {ratio:>8.2f} {cost:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import configparser
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Startup Benchmark
+#
+# Measures how long the agent takes from process start until it is ready to
+# spool reports (contexts created, tailer, spool, scheduler and sampler
+# started), which it logs as "Agent started". The agent is started several
+# times in a scratch directory with the given configuration, its log files
+# replaced by an empty sample, and stopped once it is ready, so no report is
+# sent. The interpreter's own startup is measured alongside, and --imports
+# lists the modules that take the longest to import.
+#
+# With --target the script fails if the median startup exceeds it, so it can
+# gate changes on the boards the agent runs on.
+#
+# Usage:
+#   python3 benchmark_startup.py [--config coap_agent.conf] [--runs 10] [--target 1.5] [--imports]
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coap_agent.py')
+STARTED = 'Agent started'
+
+
+def scratch_config(config_path, directory):
+    """Write the configuration into the scratch directory with its files redirected there."""
+    config = configparser.ConfigParser()
+    if not config.read(config_path):
+        raise SystemExit(f"Cannot read {config_path}")
+    sample = os.path.join(directory, 'sample.log')
+    open(sample, 'w').close()
+    config['paths'] = {'LOG_FILES': sample}
+    for section, key, value in (('tail', 'STATE_FILE', 'tail_state.json'), ('spool', 'DIRECTORY', 'spool')):
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][key] = value
+    with open(os.path.join(directory, 'coap_agent.conf'), 'w') as f:
+        config.write(f)
+
+
+def start_agent(directory, timeout):
+    """Start the agent and stop it once it is ready; returns the seconds it took."""
+    for name in ('agent.log', 'tail_state.json', 'spool'):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+    log = os.path.join(directory, 'agent.log')
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, AGENT], cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise SystemExit(f"The agent exited: {process.stderr.read().decode(errors='replace')}")
+            try:
+                with open(log, 'r') as f:
+                    if STARTED in f.read():
+                        return time.perf_counter() - started
+            except FileNotFoundError:
+                pass
+            time.sleep(0.005)
+        raise SystemExit(f"The agent was not ready after {timeout} seconds")
+    finally:
+        process.kill()
+        process.wait()
+
+
+def interpreter_startup():
+    """Return the seconds the bare interpreter takes to start and exit."""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - started
+
+
+def slowest_imports(directory, count):
+    """Return the count modules with the longest cumulative import time as (microseconds, name)."""
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(AGENT))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import coap_agent'], cwd=directory,
+                            env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def summary(values):
+    return (f"median {statistics.median(values) * 1000:7.1f} ms, min {min(values) * 1000:7.1f} ms, "
+            f"max {max(values) * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the agent")
+    parser.add_argument('--config', default='coap_agent.conf', help="Agent configuration to start with")
+    parser.add_argument('--runs', type=int, default=10, help="Number of starts (default: 10)")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Seconds to wait for one start")
+    parser.add_argument('--target', type=float, help="Fail if the median startup exceeds this many seconds")
+    parser.add_argument('--imports', action='store_true', help="List the slowest imports")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='agent-startup-')
+    try:
+        scratch_config(args.config, directory)
+        interpreter = [interpreter_startup() for _ in range(args.runs)]
+        startup = [start_agent(directory, args.timeout) for _ in range(args.runs)]
+        print(f"{args.runs} starts, Python {sys.version.split()[0]} on {sys.platform}")
+        print(f"interpreter   {summary(interpreter)}")
+        print(f"agent ready   {summary(startup)}")
+        if args.imports:
+            print(f"{'cumulative ms':>13}  module")
+            for micros, name in slowest_imports(directory, 15):
+                print(f"{micros / 1000:13.1f}  {name}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    median = statistics.median(startup)
+    if args.target is not None and median > args.target:
+        print(f"Median startup {median:.2f}s exceeds the target of {args.target:.2f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,54 @@
 import asyncio
-import shutil
 import os
+import random
+import signal
+import sys
 import configparser
-import psutil
 import logging
-from aiocoap import *
+import logging.handlers
+from aiocoap import Context, Message
 from aiocoap.numbers.codes import Code
+from aiocoap.optiontypes import BlockOption
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
 import base64
+from log_tailer import LogTailer
+from metrics import MetricsCollector
+from scheduler import ReportScheduler
+from spool import Spool
+from compression import (ACCEPT_ENCODING_OPTION, CODEC_NAMES, CONTENT_ENCODING_OPTION, ZSTD,
+                         available_codecs, compress_stream, load_dictionary)
+from report_format import (ACCEPT_FORMAT_OPTION, CONTENT_FORMAT_CBOR, CONTENT_FORMAT_TEXT,
+                           cbor_available, encode_report)
+from aiocoap.numbers.optionnumbers import OptionNumber
 
 # CoAP Agent for IoT Data Logging
 #
 # This CoAP agent handles the following tasks:
 # 1. Authentication: Obtains and renews tokens for secure communication with the CoAP server.
-# 2. System Monitoring: Collects system memory and disk usage.
-# 3. Log Management: Reads, backs up, and clears log files.
-# 4. Data Transmission: Sends collected data and logs to the CoAP server at regular intervals.
+# 2. System Monitoring: Samples system metrics (memory, disk, CPU, load, network, temperature,
+#    watched processes) every second and sends min/avg/max per report (metrics.py).
+# 3. Log Management: Tails log files incrementally, without modifying them (log_tailer.py).
+# 4. Data Transmission: Sends collected data and logs to the CoAP server at regular intervals,
+#    streamed as CoAP Block1 transfers (RFC 7959) with a configurable block size and
+#    compressed (compression.py) when the server supports it. Reports are encoded as
+#    structured CBOR records (report_format.py), with plain text as fallback.
+# 5. Scheduling: Reports are sent when enough new log data is pending, within a maximum
+#    latency, with only a heartbeat at a long interval while the logs are idle (scheduler.py).
+# 6. Spooling: Reports are written to a durable on-disk spool (spool.py) before they are
+#    sent, and drained in order, with bounded parallelism and rate, once the server
+#    acknowledges them. Failed sends are retried with exponential backoff and jitter.
+# 7. Security: Requests can be protected end to end with OSCORE (RFC 8613) using a
+#    pre-shared security context whose sequence numbers are persisted, so restarts
+#    need no handshake.
+# 8. Reloading: SIGHUP applies a changed coap_agent.conf (log files, server, credentials,
+#    thresholds) without a restart; read offsets, the spool and the token are kept.
 #
 # Configuration and credentials are managed via external files:
 # - agente.conf: Configuration settings for the agent.
-# - coap_agent.log: Log file for the agent's operations.
+# - agent.log: Log file for the agent's operations.
+# - tail_state.json: Read offsets of the log files, committed once a report is spooled.
+# - spool/: Reports not yet acknowledged by the server.
 #
 # Dependencies:
 # - aiocoap
@@ -28,144 +57,599 @@ import base64
 
 # Configure logging
 LOG_FILE = 'agent.log'
-logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, 
-                    format='%(asctime)s %(levelname)s:%(message)s')
+# The agent log is rotated instead of cleared; the tailer follows the rotation
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s %(levelname)s:%(message)s',
+                    handlers=[logging.handlers.RotatingFileHandler(
+                        LOG_FILE, maxBytes=1024 * 1024, backupCount=1)])
+
+CONFIG_FILE = 'coap_agent.conf'
+
+# Settings that only take effect at startup; a reload (SIGHUP) keeps their current values
+RESTART_SETTINGS = ('tail_state_file', 'spool_directory', 'spool_segment_bytes', 'spool_max_bytes', 'spool_fsync',
+                    'spool_parallelism', 'metrics_sample_interval', 'metrics_ring_size', 'metrics_mounts',
+                    'metrics_interfaces', 'metrics_temperature', 'metrics_processes', 'metrics_header_mount',
+                    'security_oscore_context')
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuration read from coap_agent.conf by read_config(); SIGHUP swaps in a new object."""
+
+    log_files: tuple  # Including the agent's own log
+    coap_uri_ip: str
+    coap_uri_port: int
+    coap_uri_path_part1: str
+    coap_uri_path_part2: str
+    coap_block_size: int
+    coap_block_size_exp: int
+    coap_request_timeout: float
+    compression_codec: str
+    compression_level: int
+    compression_min_size: int
+    compression_dictionary: bytes  # None without a dictionary
+    report_format: str
+    tail_state_file: str
+    tail_max_read_bytes: int
+    spool_directory: str
+    spool_segment_bytes: int
+    spool_max_bytes: int
+    spool_fsync: bool
+    spool_parallelism: int
+    spool_drain_rate: float
+    spool_backoff_initial: float
+    spool_backoff_max: float
+    spool_stats_interval: float
+    schedule_flush_bytes: int
+    schedule_flush_records: int
+    schedule_max_latency: float
+    schedule_min_interval: float
+    schedule_heartbeat_interval: float
+    schedule_poll_interval: float
+    metrics_sample_interval: float
+    metrics_ring_size: int
+    metrics_mounts: tuple
+    metrics_interfaces: tuple
+    metrics_temperature: bool
+    metrics_processes: tuple
+    metrics_header_mount: str
+    security_oscore_context: str
+    username: str
+    password: str
+    token_renew_margin: int
+
+def read_config(path):
+    """Read the configuration file into Settings.
+
+    Raises an exception if a required setting is missing or a value is invalid.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    # Block1 size: a power of two between 16 and 1024 bytes
+    block_size = config.getint('coap', 'BLOCK_SIZE', fallback=1024)
+    if block_size not in (16, 32, 64, 128, 256, 512, 1024):
+        raise ValueError(f"Invalid BLOCK_SIZE: {block_size}")
+    mounts = tuple(mount.strip() for mount in config.get('metrics', 'MOUNTS', fallback='/').split(',')
+                   if mount.strip()) or ('/',)
+
+    return Settings(
+        # Define file paths and other configuration variables
+        log_files=tuple(file.strip() for file in config['paths']['LOG_FILES'].split(',')) + (LOG_FILE,),
+
+        coap_uri_ip=config['coap']['URI_IP'],
+        coap_uri_port=int(config['coap']['URI_PORT']),
+        coap_uri_path_part1=config['coap']['URI_PATH_PART1'],
+        coap_uri_path_part2=config['coap']['URI_PATH_PART2'],
+        coap_block_size=block_size,
+        coap_block_size_exp=block_size.bit_length() - 5,
+        # Seconds to wait for a response before a request counts as failed
+        coap_request_timeout=config.getfloat('coap', 'REQUEST_TIMEOUT', fallback=30.0),
+
+        # Compression (optional section, defaults apply when missing)
+        # CODEC: auto (zstd if available on both sides, else deflate), zstd, deflate or off
+        compression_codec=config.get('compression', 'CODEC', fallback='auto'),
+        compression_level=config.getint('compression', 'LEVEL', fallback=6),
+        # Smaller payloads are sent uncompressed
+        compression_min_size=config.getint('compression', 'MIN_SIZE', fallback=512),
+        compression_dictionary=load_dictionary(config.get('compression', 'DICTIONARY', fallback='')),
+
+        # Report format (optional section, defaults apply when missing)
+        # FORMAT: auto (CBOR if cbor2 is installed and the server accepts it), cbor or text
+        report_format=config.get('report', 'FORMAT', fallback='auto'),
+
+        # Log tailing (optional section, defaults apply when missing)
+        tail_state_file=config.get('tail', 'STATE_FILE', fallback='tail_state.json'),
+        tail_max_read_bytes=config.getint('tail', 'MAX_READ_BYTES', fallback=1024 * 1024),
+
+        # Report spool (optional section, defaults apply when missing)
+        spool_directory=config.get('spool', 'DIRECTORY', fallback='spool'),
+        spool_segment_bytes=config.getint('spool', 'SEGMENT_BYTES', fallback=1024 * 1024),
+        spool_max_bytes=config.getint('spool', 'MAX_BYTES', fallback=64 * 1024 * 1024),
+        spool_fsync=config.getboolean('spool', 'FSYNC', fallback=True),
+        spool_parallelism=max(1, config.getint('spool', 'PARALLELISM', fallback=1)),
+        spool_drain_rate=config.getfloat('spool', 'DRAIN_RATE', fallback=10.0),  # Reports per second, 0 = unlimited
+        spool_backoff_initial=config.getfloat('spool', 'BACKOFF_INITIAL', fallback=1.0),
+        spool_backoff_max=config.getfloat('spool', 'BACKOFF_MAX', fallback=300.0),
+        spool_stats_interval=config.getfloat('spool', 'STATS_INTERVAL', fallback=60.0),
+
+        # Report scheduling (optional section, defaults apply when missing)
+        schedule_flush_bytes=config.getint('schedule', 'FLUSH_BYTES', fallback=64 * 1024),
+        schedule_flush_records=config.getint('schedule', 'FLUSH_RECORDS', fallback=500),
+        schedule_max_latency=config.getfloat('schedule', 'MAX_LATENCY', fallback=60.0),
+        schedule_min_interval=config.getfloat('schedule', 'MIN_INTERVAL', fallback=5.0),
+        schedule_heartbeat_interval=config.getfloat('schedule', 'HEARTBEAT_INTERVAL', fallback=300.0),
+        schedule_poll_interval=config.getfloat('schedule', 'POLL_INTERVAL', fallback=15.0),  # Without inotify
+
+        # System metrics (optional section, defaults apply when missing)
+        metrics_sample_interval=config.getfloat('metrics', 'SAMPLE_INTERVAL', fallback=1.0),
+        metrics_ring_size=config.getint('metrics', 'RING_SIZE', fallback=900),
+        metrics_mounts=mounts,
+        metrics_interfaces=tuple(nic.strip() for nic in config.get('metrics', 'INTERFACES', fallback='').split(',')
+                                 if nic.strip()),
+        metrics_temperature=config.getboolean('metrics', 'TEMPERATURE', fallback=True),
+        metrics_processes=tuple(name.strip() for name in config.get('metrics', 'PROCESSES', fallback='').split(',')
+                                if name.strip()),
+        # The report header's "Disk Usage" is the root filesystem, or the first configured mount
+        metrics_header_mount='/' if '/' in mounts else mounts[0],
+
+        # Transport security (optional section, plain CoAP when OSCORE_CONTEXT is empty)
+        security_oscore_context=config.get('security', 'OSCORE_CONTEXT', fallback=''),
+
+        # Credentials
+        username=config['auth']['USERNAME'],
+        password=config['auth']['PASSWORD'],
+        # Renew tokens this many seconds before they expire (absorbs clock skew with the server)
+        token_renew_margin=config.getint('auth', 'TOKEN_RENEW_MARGIN', fallback=60),
+    )
 
 # Load configuration from coap_agent.conf
-config = configparser.ConfigParser()
-config.read('coap_agent.conf')
+settings = read_config(CONFIG_FILE)
 
-# Define file paths and other configuration variables
-LOG_FILES = [file.strip() for file in config['paths']['LOG_FILES'].split(',')]
-LOG_FILES.append(LOG_FILE)  # Include the agent.log file
+# Responses after which a spooled report is sent again; any other error response is final
+TOO_MANY_REQUESTS = 157  # 4.29 (RFC 8516)
+RETRY_CODES = {Code.UNAUTHORIZED, Code.REQUEST_ENTITY_INCOMPLETE, TOO_MANY_REQUESTS}
 
-COAP_URI_IP = config['coap']['URI_IP']
-COAP_URI_PORT = int(config['coap']['URI_PORT'])
-COAP_URI_PATH_PART1 = config['coap']['URI_PATH_PART1']
-COAP_URI_PATH_PART2 = config['coap']['URI_PATH_PART2']
+# Transport security
+OSCORE = None  # Security context shared by all client contexts (loaded in main)
+OSCORE_BLOCK_SIZE_EXP = 5  # 512-byte blocks when requests are protected
 
-# Token and credentials
+# Token state
 TOKEN = None
+TOKEN_LOCK = None  # Serializes token renewal between the spool lanes (created in main)
 TOKEN_EXPIRY = datetime.now()
-USERNAME = config['auth']['USERNAME']
-PASSWORD = config['auth']['PASSWORD']
+SERVER_CODECS = set()  # Payload codings advertised by the server
+SERVER_FORMATS = set()  # Report formats advertised by the server
+DEFAULT_TOKEN_LIFETIME = 3600  # Assumed for tokens that do not carry their expiry
+
+def token_expiry(token):
+    """Return when the token must be renewed.
+
+    Signed tokens ("<key id>.<username>.<expiry>.<mac>") carry their expiry
+    time; other tokens are assumed to live DEFAULT_TOKEN_LIFETIME seconds.
+    """
+    parts = token.split('.')
+    if len(parts) == 4 and parts[2].isdigit():
+        expiry = datetime.fromtimestamp(int(parts[2]))
+    else:
+        expiry = datetime.now() + timedelta(seconds=DEFAULT_TOKEN_LIFETIME)
+    return expiry - timedelta(seconds=settings.token_renew_margin)
+
+# Function to create a client context
+async def create_context():
+    """Return a new client context, protecting requests to the server with OSCORE if configured."""
+    context = await Context.create_client_context()
+    protect(context)
+    return context
+
+# Function to protect the requests to the server
+def protect(context):
+    """Protect the context's requests to the configured server with OSCORE, if enabled."""
+    if OSCORE is not None:
+        context.client_credentials[f'coap://{settings.coap_uri_ip}:{settings.coap_uri_port}/*'] = OSCORE
+        if settings.coap_uri_port == 5683:
+            context.client_credentials[f'coap://{settings.coap_uri_ip}/*'] = OSCORE  # The URI omits the default port
+
+# Function to select the client transports
+def client_transports():
+    """Return the aiocoap client transports the agent needs, colon-separated.
+
+    aiocoap's default list also sets up the TCP and TLS clients and, when its
+    modules are installed, OSCORE, which takes most of the time it needs to
+    create a context.
+    """
+    udp = 'udp6' if sys.platform == 'linux' else 'simple6'
+    return f'oscore:{udp}' if settings.security_oscore_context else udp
+
+# Function to load the OSCORE security context
+def load_oscore_context(path):
+    """Load the OSCORE security context directory created by the server's oscore_site.py.
+
+    The sender sequence number persisted in the directory lets a restarted
+    agent continue without any handshake.
+    """
+    try:
+        from aiocoap.oscore import FilesystemSecurityContext
+    except ImportError as e:
+        raise SystemExit(f"OSCORE needs the cryptography, hkdf, cbor and filelock packages: {e}")
+    return FilesystemSecurityContext(path)
 
 # Function to get a token from the server
 async def obtain_token(context):
     """Obtain a token from the CoAP server for authentication."""
-    global TOKEN, TOKEN_EXPIRY
-    auth_header = f"Basic {base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}"
-    request = Message(code=Code.POST, uri=f'coap://{COAP_URI_IP}:{COAP_URI_PORT}/auth', payload=b'')
+    global TOKEN, TOKEN_EXPIRY, SERVER_CODECS, SERVER_FORMATS
+    auth_header = f"Basic {base64.b64encode(f'{settings.username}:{settings.password}'.encode()).decode()}"
+    request = Message(code=Code.POST, uri=f'coap://{settings.coap_uri_ip}:{settings.coap_uri_port}/auth', payload=b'')
     request.opt.uri_query = [f'Authorization={auth_header}']
     try:
-        response = await context.request(request).response
+        response = await asyncio.wait_for(context.request(request).response, settings.coap_request_timeout)
+        if not response.code.is_successful():
+            logging.error(f"Authentication failed: {response.code}")
+            return
         TOKEN = response.payload.decode('utf-8')
-        TOKEN_EXPIRY = datetime.now() + timedelta(seconds=3600)  # Token expiry time
+        TOKEN_EXPIRY = token_expiry(TOKEN)
+        SERVER_CODECS = {option.value[0] for option in response.opt.get_option(ACCEPT_ENCODING_OPTION)
+                         if option.value}
+        SERVER_FORMATS = {int.from_bytes(option.value, 'big')
+                          for option in response.opt.get_option(ACCEPT_FORMAT_OPTION)}
         logging.debug(f"Obtained new token: {TOKEN}")
     except Exception as e:
-        logging.error(f"Failed to obtain token: {e}")
+        logging.error(f"Failed to obtain token: {e!r}")
 
-# Function to read the entire content of a log file
-def read_log_file(log_file):
-    """Read the content of a specified log file."""
-    try:
-        with open(log_file, 'r') as logfile:
-            return logfile.read()
-    except Exception as e:
-        logging.error(f"Error reading log: {e}")
-        return f"Error reading log: {e}"
+# Function to read a header value from the metric aggregates
+def last_value(metrics, name):
+    """Return the most recent value of a metric in the aggregates, or None."""
+    entry = metrics.get(name)
+    return entry[3] if entry else None
 
-# Function to get system memory usage
-def get_memory_usage():
-    """Get the current memory usage of the system."""
-    try:
-        virtual_memory = psutil.virtual_memory()
-        used_memory = (virtual_memory.total - virtual_memory.available) / virtual_memory.total * 100
-        return f"Memory Usage: {used_memory:.2f}%"
-    except Exception as e:
-        logging.error(f"Error getting memory usage: {e}")
-        return f"Error getting memory usage: {e}"
+# Function to format a percentage for the text report
+def format_percent(value):
+    """Return a percentage for the text report header."""
+    return f"{value:.2f}%" if value is not None else "unavailable"
 
-# Function to get disk usage
-def get_disk_usage():
-    """Get the current disk usage of the system."""
-    try:
-        disk_usage = os.popen('df /').read().splitlines()[1].split()
-        total = int(disk_usage[1])
-        used = int(disk_usage[2])
-        used_disk = (used / total) * 100
-        return f"Disk Usage: {used_disk:.2f}%"
-    except Exception as e:
-        logging.error(f"Error getting disk usage: {e}")
-        return f"Error getting disk usage: {e}"
-
-# Function to backup and clear log files
-def backup_and_clear_logs():
-    """Backup and clear specified log files."""
-    for log_file in LOG_FILES:
-        if os.path.exists(log_file):
-            backup_file = log_file + '.bak'
-            shutil.copy(log_file, backup_file)
-            with open(log_file, 'w') as logfile:
-                logfile.write('')
-            logging.debug(f"Backed up and cleared log file: {log_file}")
-        else:
-            logging.warning(f"Log file not found: {log_file}")
-
-# Function to send a CoAP request with the log content
-async def send_request(context, log_content):
-    """Send a CoAP request containing the log content to the server."""
-    global TOKEN, TOKEN_EXPIRY
+class PayloadStream:
+    """Read fixed-size blocks from an iterable of byte strings without copying it whole."""
+
+    def __init__(self, parts):
+        self._parts = iter(parts)
+        self._current = memoryview(b'')
+
+    def _fill(self):
+        while not self._current:
+            part = next(self._parts, None)
+            if part is None:
+                return False
+            self._current = memoryview(part)
+        return True
+
+    def read(self, size):
+        """Return up to size bytes; fewer only at the end of the stream."""
+        pieces = []
+        while size > 0 and self._fill():
+            piece = self._current[:size]
+            self._current = self._current[size:]
+            pieces.append(piece)
+            size -= len(piece)
+        return b''.join(pieces)
+
+    def at_end(self):
+        """Return True if no data is left."""
+        return not self._fill()
+
+# Function to choose the report format
+def choose_format():
+    """Return the Content-Format to encode the report in."""
+    if settings.report_format == 'text' or not cbor_available():
+        return CONTENT_FORMAT_TEXT
+    if settings.report_format == 'cbor' or CONTENT_FORMAT_CBOR in SERVER_FORMATS:
+        return CONTENT_FORMAT_CBOR
+    return CONTENT_FORMAT_TEXT
+
+# Function to build the structured report payload
+def build_cbor_payload(chunks, metrics):
+    """Return the report payload as a stream of CBOR pieces."""
+    return encode_report(datetime.now().timestamp(),
+                         last_value(metrics, 'memory_percent'),
+                         last_value(metrics, f'disk_percent:{settings.metrics_header_mount}'),
+                         chunks, metrics)
+
+# Function to build the text report payload
+def build_payload(chunks, metrics):
+    """Return the report payload as a list of pieces: the header, then each log chunk."""
+    lines = [
+        f"Timestamp: {datetime.now().isoformat()}",
+        f"Memory Usage: {format_percent(last_value(metrics, 'memory_percent'))}",
+        f"Disk Usage: {format_percent(last_value(metrics, f'disk_percent:{settings.metrics_header_mount}'))}",
+    ]
+    if metrics:
+        lines.append("Metrics (min/avg/max/last, samples):")
+        lines += [f"  {name} {low:.2f}/{avg:.2f}/{high:.2f}/{last:.2f} {count}"
+                  for name, (low, avg, high, last, count) in sorted(metrics.items())]
+    lines.append("Logs:\n")
+    return ['\n'.join(lines).encode('utf-8')] + [chunk.data for chunk in chunks]
+
+# Function to choose the payload coding
+def choose_codec(payload_size):
+    """Return the coding to compress a payload with, or None to send it as is."""
+    if settings.compression_codec == 'off' or payload_size < settings.compression_min_size:
+        return None
+    usable = available_codecs() & SERVER_CODECS
+    if settings.compression_codec == 'auto':
+        if ZSTD in usable:
+            return ZSTD
+        return next(iter(usable), None)
+    codec = CODEC_NAMES[settings.compression_codec]
+    return codec if codec in usable else None
+
+# Function to send a payload as a Block1 transfer
+async def send_blockwise(context, request_uri, uri_query, parts, codec=None,
+                         content_format=CONTENT_FORMAT_TEXT):
+    """Send the payload in blocks of settings.coap_block_size bytes and return the final response.
+
+    Blocks are read from parts only as they are sent, so the payload is never
+    assembled in memory. A payload that fits into one block is sent as a
+    regular request. Every block carries the Content-Format and, if codec is
+    set, the Content-Encoding option.
+    """
+    stream = PayloadStream(parts)
+    size_exp = settings.coap_block_size_exp
+    if OSCORE is not None:
+        # Leave room for the OSCORE overhead, so that a protected block fits into one message
+        size_exp = min(size_exp, OSCORE_BLOCK_SIZE_EXP)
+    block = stream.read(2 ** (size_exp + 4))
+    block_number = 0
+    offset = 0
+    while True:
+        more = not stream.at_end()
+        request = Message(code=Code.POST, payload=block, content_format=content_format)
+        request.set_request_uri(request_uri)
+        request.opt.uri_query = uri_query
+        if codec is not None:
+            request.opt.add_option(OptionNumber(CONTENT_ENCODING_OPTION).create_option(value=bytes([codec])))
+        if more or block_number > 0:
+            request.opt.block1 = BlockOption.BlockwiseTuple(block_number, more, size_exp)
+        response = await asyncio.wait_for(context.request(request, handle_blockwise=False).response,
+                                          settings.coap_request_timeout)
+        if not more or response.code != Code.CONTINUE:
+            return response
+
+        # The server may ask for smaller blocks
+        if response.opt.block1 is not None and response.opt.block1.size_exponent < size_exp:
+            size_exp = response.opt.block1.size_exponent
+        offset += len(block)
+        block_number = offset // 2 ** (size_exp + 4)
+        block = stream.read(2 ** (size_exp + 4))
+
+# Function to encode a report
+def build_report(chunks, metrics):
+    """Return the report for the log chunks and metric aggregates as (pieces, Content-Format)."""
+    content_format = choose_format()
+    if content_format == CONTENT_FORMAT_CBOR:
+        return build_cbor_payload(chunks, metrics), content_format
+    return build_payload(chunks, metrics), content_format
+
+# Function to send a spooled report
+async def send_report(context, record):
+    """Send a spooled report to the server.
+
+    Returns 'sent' if the server acknowledged it, 'rejected' if the server
+    refused it for good, 'failed' if no response came, or ('retry', seconds)
+    if the server asked for it to be sent again, with the Max-Age of a
+    5.03/4.29 response as the minimum delay (else 0).
+    """
+    global TOKEN
 
     # Check if the token is expired
-    if TOKEN is None or datetime.now() >= TOKEN_EXPIRY:
-        await obtain_token(context)
-
-    # Build the payload as a plain text string
-    payload = (
-        f"Timestamp: {datetime.now().isoformat()}\n"
-        f"{get_memory_usage()}\n"
-        f"{get_disk_usage()}\n"
-        f"Logs:\n{log_content}"
-    ).encode('utf-8')
-
-    request = Message(code=Code.POST, payload=payload)
-    request_uri = f"coap://{COAP_URI_IP}:{COAP_URI_PORT}/{COAP_URI_PATH_PART1}/{COAP_URI_PATH_PART2}"
-    request.set_request_uri(request_uri)
-    request.opt.uri_query = [f'Token={TOKEN}']
+    async with TOKEN_LOCK:
+        if TOKEN is None or datetime.now() >= TOKEN_EXPIRY:
+            await obtain_token(context)
+    if TOKEN is None:
+        return 'failed'
+
+    request_uri = (f"coap://{settings.coap_uri_ip}:{settings.coap_uri_port}/"
+                   f"{settings.coap_uri_path_part1}/{settings.coap_uri_path_part2}")
+    parts = [record.data]
+    codec = choose_codec(len(record.data))
+    if codec is not None:
+        parts = compress_stream(parts, codec, settings.compression_level, settings.compression_dictionary)
 
     logging.debug(f"Sending request to: {request_uri}")
     try:
-        await context.request(request).response
+        response = await send_blockwise(context, request_uri, [f'Token={TOKEN}'], parts, codec,
+                                        record.content_format)
+    except Exception as e:
+        logging.error(f"Failed to send request: {e!r}")
+        return 'failed'
+    if response.code.is_successful():
         logging.debug("Request sent successfully")
+        return 'sent'
+    logging.error(f"Server rejected request: {response.code}")
+    if response.code == Code.UNAUTHORIZED:
+        TOKEN = None  # Expired early, revoked or signed with a retired key
+    if response.code.class_ == 5 or response.code in RETRY_CODES:
+        max_age = response.opt.max_age if response.code in (Code.SERVICE_UNAVAILABLE, TOO_MANY_REQUESTS) else None
+        return 'retry', max_age or 0
+    return 'rejected'
+
+class SpoolSender:
+    """Drain the spool in order with bounded parallelism and rate.
+
+    Each of the parallel lanes has its own client context (its own UDP
+    port), so their Block1 transfers never mix on the server. After a failed
+    send all lanes pause for an exponentially growing, jittered delay; the
+    failed report is sent again before any later one. A lane whose request
+    got no response continues with a new context: aiocoap keeps requests to a
+    remote queued forever after an ICMP error for it.
+    """
+
+    def __init__(self, spool, contexts, rate, backoff_initial, backoff_max):
+        self.spool = spool
+        self.contexts = contexts
+        self.configure(rate, backoff_initial, backoff_max)
+        self.failures = 0
+        self.sent = 0
+        self.rejected = 0
+        self._resume_at = 0.0  # End of the current backoff
+        self._next_slot = 0.0  # Earliest start of the next send (rate limit)
+        self._wakeup = asyncio.Event()
+
+    def configure(self, rate, backoff_initial, backoff_max):
+        """Set the drain rate (reports per second, 0 = unlimited) and the retry backoff."""
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+    def notify(self):
+        """Wake up idle lanes after a report was spooled."""
+        self._wakeup.set()
+
+    async def run(self):
+        await asyncio.gather(*(self._lane(lane) for lane in range(len(self.contexts))))
+
+    async def _pace(self):
+        """Wait for the end of a backoff and for the next rate slot."""
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = max(self._resume_at, self._next_slot) - loop.time()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._next_slot = max(loop.time(), self._next_slot) + self.interval
+
+    def _back_off(self, minimum):
+        """Pause all lanes: equal jitter over an exponentially growing delay."""
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._resume_at:
+            return  # Another lane already backs off for the same outage
+        delay = min(self.backoff_max, self.backoff_initial * 2 ** self.failures)
+        delay = max(minimum, delay / 2 + random.uniform(0, delay / 2))
+        self.failures += 1
+        self._resume_at = loop.time() + delay
+        logging.warning(f"Sending failed {self.failures} time(s), retrying in {delay:.1f}s")
+
+    async def _lane(self, lane):
+        while True:
+            await self._pace()
+            record = self.spool.next_record()
+            if record is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            result = await send_report(self.contexts[lane], record)
+            if result == 'sent':
+                self.spool.ack(record.rid)
+                self.sent += 1
+                self.failures = 0
+            elif result == 'rejected':
+                logging.error(f"Dropping spooled report from {datetime.fromtimestamp(record.created)}")
+                self.spool.ack(record.rid)
+                self.rejected += 1
+            elif result == 'failed':
+                self.spool.retry(record.rid)
+                self._back_off(0)
+                self.contexts[lane] = await create_context()
+            else:
+                self.spool.retry(record.rid)
+                self._back_off(result[1])
+
+# Function to log the spool metrics
+async def report_spool_stats(spool, sender):
+    """Log the spool depth and delivery counters every settings.spool_stats_interval seconds."""
+    while True:
+        await asyncio.sleep(settings.spool_stats_interval)
+        stats = spool.stats()
+        logging.info(f"Spool: depth={stats['depth']} reports ({stats['depth_bytes']} bytes), "
+                     f"oldest={stats['oldest_age']:.0f}s, in_flight={stats['in_flight']}, "
+                     f"segments={stats['segments']} ({stats['spool_bytes']} bytes), "
+                     f"sent={sender.sent}, rejected={sender.rejected}, evicted={stats['evicted']}, "
+                     f"failures={sender.failures}")
+
+# Function to apply a changed configuration
+def reload_config(tailer, scheduler, sender):
+    """Apply a changed configuration file (SIGHUP) without restarting.
+
+    Read offsets, spooled reports and, unless the server address or the
+    credentials changed, the token are kept, so no log is read again. Nothing
+    changes if the file cannot be read; RESTART_SETTINGS keep their values.
+    """
+    global TOKEN, settings
+    try:
+        loaded = read_config(CONFIG_FILE)
     except Exception as e:
-        logging.error(f"Failed to send request: {e}")
+        logging.error(f"Configuration not reloaded: {e!r}")
+        return
+    kept = {}
+    for name in RESTART_SETTINGS:
+        if getattr(loaded, name) != getattr(settings, name):
+            logging.warning(f"Configuration: {name} only changes on restart")
+            kept[name] = getattr(settings, name)
+    login = (settings.coap_uri_ip, settings.coap_uri_port, settings.username, settings.password)
+    settings = replace(loaded, **kept)
 
-# Main function
-async def main():
-    """Main function to run the CoAP agent."""
-    global TOKEN, TOKEN_EXPIRY
-    context = await Context.create_client_context()
-    
-    # Obtain initial token
-    await obtain_token(context)
+    if (settings.coap_uri_ip, settings.coap_uri_port, settings.username, settings.password) != login:
+        TOKEN = None  # Obtained again from the configured server with the configured credentials
+        for context in sender.contexts:
+            protect(context)
+    tailer.max_read_bytes = settings.tail_max_read_bytes
+    scheduler.configure(settings.log_files, [LOG_FILE], settings.schedule_flush_bytes, settings.schedule_flush_records,
+                        settings.schedule_max_latency, settings.schedule_min_interval,
+                        settings.schedule_heartbeat_interval, settings.schedule_poll_interval)
+    sender.configure(settings.spool_drain_rate, settings.spool_backoff_initial, settings.spool_backoff_max)
+    logging.info(f"Reloaded configuration from {CONFIG_FILE}")
 
+# Function to spool reports as the scheduler makes them due
+async def spool_reports(tailer, spool, sender, scheduler, collector):
+    """Build and spool a report whenever the scheduler says one is due."""
     while True:
-        log_contents = []
-        for log_file in LOG_FILES:
-            log_contents.append(read_log_file(log_file))
+        # Wait until enough log data is pending, it is getting old, or a heartbeat is due
+        reason = await scheduler.wait()
+        logging.debug(f"Report due: {reason}")
 
-        # Concatenate all log contents into a single string
-        all_logs = "".join(log_contents)
+        # Read only what was appended since the last spooled report; heartbeats carry no logs
+        chunks = tailer.collect(settings.log_files) if reason != 'heartbeat' else []
 
-        # Send the content via CoAP
-        await send_request(context, all_logs)
+        # Spool the report and commit the offsets once it is on disk
+        try:
+            spool.append(*build_report(chunks, collector.aggregate()))
+            tailer.commit()
+            sender.notify()
+        except OSError as e:
+            logging.error(f"Failed to spool report: {e}")
 
-        # Backup and clear the log files
-        backup_and_clear_logs()
+# Main function
+async def main():
+    """Main function to run the CoAP agent."""
+    global TOKEN_LOCK, OSCORE
+    TOKEN_LOCK = asyncio.Lock()
+    if settings.security_oscore_context:
+        OSCORE = load_oscore_context(settings.security_oscore_context)
+    os.environ.setdefault('AIOCOAP_CLIENT_TRANSPORT', client_transports())
+    contexts = [await create_context() for _ in range(settings.spool_parallelism)]
+    tailer = LogTailer(settings.tail_state_file, max_read_bytes=settings.tail_max_read_bytes)
+    spool = Spool(settings.spool_directory, segment_bytes=settings.spool_segment_bytes,
+                  max_bytes=settings.spool_max_bytes, fsync=settings.spool_fsync)
+    spool.open()
+    sender = SpoolSender(spool, contexts, settings.spool_drain_rate, settings.spool_backoff_initial,
+                         settings.spool_backoff_max)
+    # The agent's own log grows with every send, so it must not trigger reports
+    scheduler = ReportScheduler(tailer, settings.log_files, passive_paths=[LOG_FILE],
+                                flush_bytes=settings.schedule_flush_bytes,
+                                flush_records=settings.schedule_flush_records,
+                                max_latency=settings.schedule_max_latency, min_interval=settings.schedule_min_interval,
+                                heartbeat_interval=settings.schedule_heartbeat_interval,
+                                poll_interval=settings.schedule_poll_interval)
+    scheduler.start()
+    collector = MetricsCollector(interval=settings.metrics_sample_interval, ring_size=settings.metrics_ring_size,
+                                 mounts=settings.metrics_mounts, interfaces=settings.metrics_interfaces,
+                                 temperature=settings.metrics_temperature, processes=settings.metrics_processes)
+    collector.start()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config, tailer, scheduler, sender)
+    logging.info("Agent started")
 
-        # Wait for 15 seconds before the next iteration
-        await asyncio.sleep(15)
+    # Obtain initial token (also tells which report formats the server accepts)
+    async with TOKEN_LOCK:
+        await obtain_token(contexts[0])
+    await asyncio.gather(sender.run(), report_spool_stats(spool, sender),
+                         spool_reports(tailer, spool, sender, scheduler, collector))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
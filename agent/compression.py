@@ -0,0 +1,114 @@
+import sys
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, deflate is always available
+    zstandard = None
+
+# Payload Compression
+#
+# Compresses report payloads before they are sent to the CoAP server.
+#
+# CoAP has no standard content-coding option, so the agent and the server use
+# two options from the experimental range (the numbers must match the server):
+# - Content-Encoding (65001, critical): coding of the request payload
+# - Accept-Encoding (65000, elective): codings the server advertises in its
+#   /auth response; the agent only compresses with a coding listed there, so
+#   an older server always receives plain payloads.
+#
+# Codings: 1 = deflate (zlib), 2 = zstd (requires the zstandard package).
+# Both can use a pre-trained dictionary built from sample logs; the server
+# must be configured with the same dictionary file.
+#
+# Build a dictionary with:
+#   python3 compression.py train dictionary.bin agent.log [more samples...]
+
+CONTENT_ENCODING_OPTION = 65001
+ACCEPT_ENCODING_OPTION = 65000
+
+IDENTITY = 0
+DEFLATE = 1
+ZSTD = 2
+
+CODEC_NAMES = {'deflate': DEFLATE, 'zstd': ZSTD}
+
+# zlib only uses the last 32 KiB of a preset dictionary
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+
+def available_codecs():
+    """Return the codings this agent can produce."""
+    codecs = {DEFLATE}
+    if zstandard is not None:
+        codecs.add(ZSTD)
+    return codecs
+
+
+def load_dictionary(path):
+    """Read a dictionary file, or return None if no path is configured."""
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def compress_stream(parts, codec, level, dictionary=None):
+    """Yield the compressed form of an iterable of byte strings."""
+    if codec == DEFLATE:
+        if dictionary:
+            compressor = zlib.compressobj(level, zdict=dictionary[-ZLIB_DICTIONARY_SIZE:])
+        else:
+            compressor = zlib.compressobj(level)
+        for part in parts:
+            out = compressor.compress(part)
+            if out:
+                yield out
+        yield compressor.flush()
+    elif codec == ZSTD:
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data).compressobj()
+        for part in parts:
+            out = compressor.compress(part)
+            if out:
+                yield out
+        yield compressor.flush()
+    else:
+        raise ValueError(f"Unsupported coding: {codec}")
+
+
+def train_dictionary(samples, size=ZLIB_DICTIONARY_SIZE):
+    """Build a dictionary from sample log contents (a list of bytes).
+
+    With zstandard installed a zstd dictionary is trained; it can be used by
+    both codings. Otherwise the most frequent lines are concatenated, most
+    valuable last since deflate favours nearby matches.
+    """
+    if zstandard is not None:
+        lines = [line for sample in samples for line in sample.splitlines(keepends=True)]
+        return zstandard.train_dictionary(size, lines).as_bytes()
+    counts = Counter(line for sample in samples for line in sample.splitlines(keepends=True))
+    ranked = sorted(counts, key=lambda line: counts[line] * len(line))
+    selected = []
+    total = 0
+    for line in reversed(ranked):
+        if total + len(line) > size:
+            continue
+        selected.append(line)
+        total += len(line)
+    return b''.join(reversed(selected))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != 'train':
+        print("Usage: python3 compression.py train <dictionary> <sample> [sample...]")
+        sys.exit(1)
+    samples = []
+    for path in sys.argv[3:]:
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+    dictionary = train_dictionary(samples)
+    with open(sys.argv[2], 'wb') as f:
+        f.write(dictionary)
+    print(f"Wrote {len(dictionary)} byte dictionary to {sys.argv[2]}")
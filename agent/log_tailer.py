@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+from collections import namedtuple
+
+# Incremental Log Tailer
+#
+# Reads only the bytes appended to each log file since the last acknowledged
+# report, without ever modifying the source logs.
+#
+# - Per-file state is (device, inode, offset), kept in a small JSON state file.
+# - Reads are chunked and bounded per cycle; anything beyond the limit is
+#   picked up on the next cycle, so memory use does not depend on backlog size.
+# - Only complete lines are returned while a file may still be written to.
+# - Rotation (new inode) is detected; the unread tail of the previous file is
+#   recovered from "<path>.1" when it is still there. Truncation (file shorter
+#   than the stored offset) restarts from the beginning.
+# - collect() only stages the new offsets; commit() makes them durable
+#   (fsync + atomic rename) once the server acknowledged the data, which gives
+#   at-least-once delivery.
+# - pending() estimates the unread bytes and lines without staging anything,
+#   for deciding when a report is worth sending. Lines are counted
+#   incrementally, so repeated calls only read what was appended since.
+
+Chunk = namedtuple('Chunk', ['path', 'offset', 'data'])
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class LogTailer:
+    """Track per-file read offsets and return only new log data."""
+
+    def __init__(self, state_file, max_read_bytes=1024 * 1024):
+        self.state_file = state_file
+        self.max_read_bytes = max_read_bytes
+        self._state = self._load()
+        self._pending = {}
+        self._scanned = {}  # path -> (dev, inode, start, scanned offset, lines)
+
+    def _load(self):
+        """Load committed offsets from the state file."""
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.error(f"Error loading tail state, starting from the beginning: {e}")
+            return {}
+
+    def collect(self, paths):
+        """Return a list of Chunks with the data appended since the last commit."""
+        chunks = []
+        self._pending = {}
+        budget = self.max_read_bytes
+        for path in paths:
+            if budget <= 0:
+                break
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                logging.warning(f"Log file not found: {path}")
+                continue
+            except OSError as e:
+                logging.error(f"Error reading log: {e}")
+                continue
+
+            saved = self._state.get(path)
+            offset = 0
+            if saved and saved['dev'] == st.st_dev and saved['inode'] == st.st_ino:
+                offset = saved['offset']
+                if st.st_size < offset:
+                    logging.warning(f"Log file truncated, reading from the beginning: {path}")
+                    offset = 0
+            elif saved:
+                logging.debug(f"Log file rotated: {path}")
+                read, complete = self._collect_rotated(path, saved, chunks, budget)
+                budget -= read
+                if not complete:
+                    # Finish the rotated file before starting on the new one
+                    self._pending[path] = dict(saved, offset=saved['offset'] + read)
+                    continue
+
+            data, offset_after = self._read(path, offset, st.st_size, budget)
+            if data:
+                chunks.append(Chunk(path, offset, data))
+                budget -= len(data)
+            self._pending[path] = {'dev': st.st_dev, 'inode': st.st_ino, 'offset': offset_after}
+        return chunks
+
+    def pending(self, paths):
+        """Return (bytes, lines) appended to the files since the last commit.
+
+        The unread tail of a rotated file is not included, and counting stops
+        max_read_bytes past the committed offset, so this is an estimate.
+        """
+        total_bytes = total_lines = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            saved = self._state.get(path)
+            start = 0
+            if saved and saved['dev'] == st.st_dev and saved['inode'] == st.st_ino \
+                    and st.st_size >= saved['offset']:
+                start = saved['offset']
+            dev, inode, scan_start, scanned, lines = self._scanned.get(path, (None, None, None, 0, 0))
+            if (dev, inode, scan_start) != (st.st_dev, st.st_ino, start) or scanned > st.st_size:
+                scanned, lines = start, 0
+            end = min(st.st_size, start + self.max_read_bytes)
+            if end > scanned:
+                try:
+                    with open(path, 'rb') as f:
+                        f.seek(scanned)
+                        while scanned < end:
+                            part = f.read(min(READ_CHUNK_SIZE, end - scanned))
+                            if not part:
+                                break
+                            lines += part.count(b'\n')
+                            scanned += len(part)
+                except OSError as e:
+                    logging.error(f"Error reading log: {e}")
+            self._scanned[path] = (st.st_dev, st.st_ino, start, scanned, lines)
+            total_bytes += st.st_size - start
+            total_lines += lines
+        return total_bytes, total_lines
+
+    def _collect_rotated(self, path, saved, chunks, budget):
+        """Read the unread tail of a rotated file if it is still available.
+
+        Returns (bytes read, whether the rotated file is now fully read).
+        """
+        rotated = path + '.1'
+        try:
+            st = os.stat(rotated)
+        except OSError:
+            return 0, True
+        if st.st_dev != saved['dev'] or st.st_ino != saved['inode'] or st.st_size <= saved['offset']:
+            return 0, True
+        # The rotated file is complete, so partial last lines are kept as well
+        data, offset_after = self._read(rotated, saved['offset'], st.st_size, budget, complete_lines=False)
+        if data:
+            chunks.append(Chunk(path, saved['offset'], data))
+        return len(data), offset_after >= st.st_size
+
+    def _read(self, path, offset, size, budget, complete_lines=True):
+        """Read up to budget bytes from offset; returns (data, next offset)."""
+        want = min(size - offset, budget)
+        if want <= 0:
+            return b'', offset
+        parts = []
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while want > 0:
+                    part = f.read(min(READ_CHUNK_SIZE, want))
+                    if not part:
+                        break
+                    parts.append(part)
+                    want -= len(part)
+        except OSError as e:
+            logging.error(f"Error reading log: {e}")
+            return b'', offset
+        data = b''.join(parts)
+        if complete_lines:
+            end = data.rfind(b'\n') + 1
+            # Ship a line longer than the budget anyway rather than stalling
+            if end > 0 or len(data) < budget:
+                data = data[:end]
+        return data, offset + len(data)
+
+    def commit(self):
+        """Durably store the offsets staged by the last collect()."""
+        if not self._pending:
+            return
+        state = dict(self._state)
+        state.update(self._pending)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.state_file)
+        self._state = state
+        self._pending = {}
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+
+import psutil
+
+# System Metrics Collector
+#
+# Samples system metrics at a fixed interval (1 s by default) into a ring
+# buffer of RING_SIZE samples. Each report carries min/avg/max/last of every
+# metric over the samples taken since the previous report, so short spikes
+# between reports are not lost.
+#
+# Sampling stays cheap enough for small devices: only system calls and reads
+# of /proc and /sys files, no subprocesses. Watched processes are looked up by
+# name only every PROCESS_RESCAN seconds (or when one exits), not per sample.
+#
+# Metric names ("<metric>" or "<metric>:<label>"):
+#   cpu_percent, load_1m, memory_percent, disk_percent:<mount>,
+#   net_rx_bytes_per_s[:<interface>], net_tx_bytes_per_s[:<interface>],
+#   temperature_c (hottest sensor), process_cpu_percent:<name>,
+#   process_rss_bytes:<name>
+
+PROCESS_RESCAN = 60.0  # Seconds between lookups of the watched processes
+
+
+def disk_percent(mount):
+    """Return the used space of the filesystem at mount in percent."""
+    st = os.statvfs(mount)
+    total = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    return used / total * 100 if total else 0.0
+
+
+def memory_percent():
+    """Return the memory usage of the system in percent."""
+    virtual_memory = psutil.virtual_memory()
+    return (virtual_memory.total - virtual_memory.available) / virtual_memory.total * 100
+
+
+class MetricsCollector:
+    """Sample system metrics into a ring buffer and aggregate them per report."""
+
+    def __init__(self, interval=1.0, ring_size=900, mounts=('/',), interfaces=(), temperature=True,
+                 processes=()):
+        self.interval = interval
+        self.mounts = list(mounts)
+        self.interfaces = list(interfaces)
+        self.temperature = temperature and hasattr(psutil, 'sensors_temperatures')
+        self.processes = list(processes)
+        self.samples = deque(maxlen=ring_size)  # (time, {name: value})
+        self._last_aggregate = 0.0
+        self._net = None  # (time, {label: (bytes received, bytes sent)})
+        self._tracked = {}  # process name -> list of psutil.Process
+        self._rescan_at = 0.0
+        self._task = None
+        psutil.cpu_percent(None)  # The first call only sets the reference point
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            self.sample()
+            # Keep a steady rhythm even if a sample took a while
+            next_time = max(next_time + self.interval, loop.time())
+            await asyncio.sleep(next_time - loop.time())
+
+    def sample(self):
+        """Take one sample of every metric into the ring buffer."""
+        now = time.time()
+        values = {}
+        self._read(values, 'cpu_percent', lambda: psutil.cpu_percent(None))
+        self._read(values, 'load_1m', lambda: os.getloadavg()[0])
+        self._read(values, 'memory_percent', memory_percent)
+        for mount in self.mounts:
+            self._read(values, f'disk_percent:{mount}', lambda: disk_percent(mount))
+        self._sample_network(now, values)
+        if self.temperature:
+            self._sample_temperature(values)
+        if self.processes:
+            self._sample_processes(now, values)
+        self.samples.append((now, values))
+        return values
+
+    @staticmethod
+    def _read(values, name, metric):
+        try:
+            values[name] = metric()
+        except Exception as e:
+            logging.debug(f"Error getting {name}: {e}")
+
+    def _sample_network(self, now, values):
+        try:
+            if self.interfaces:
+                counters = psutil.net_io_counters(pernic=True)
+                current = {nic: (counters[nic].bytes_recv, counters[nic].bytes_sent)
+                           for nic in self.interfaces if nic in counters}
+            else:
+                counters = psutil.net_io_counters()
+                current = {None: (counters.bytes_recv, counters.bytes_sent)}
+        except Exception as e:
+            logging.debug(f"Error getting network counters: {e}")
+            return
+        if self._net is not None:
+            then, previous = self._net
+            elapsed = now - then
+            for label, (received, sent) in current.items():
+                if label in previous and elapsed > 0:
+                    suffix = f':{label}' if label else ''
+                    # Counters may wrap or reset; skip that interval
+                    if received >= previous[label][0] and sent >= previous[label][1]:
+                        values[f'net_rx_bytes_per_s{suffix}'] = (received - previous[label][0]) / elapsed
+                        values[f'net_tx_bytes_per_s{suffix}'] = (sent - previous[label][1]) / elapsed
+        self._net = (now, current)
+
+    def _sample_temperature(self, values):
+        """Sample the hottest sensor; without sensors, log it once and stop sampling temperature_c."""
+        try:
+            readings = [entry.current for entries in psutil.sensors_temperatures().values() for entry in entries]
+        except AttributeError:
+            readings, reason = None, "not supported on this platform"
+        except Exception as e:
+            # A transient read error; try again on the next sample
+            logging.debug(f"Error getting temperature: {e}")
+            return
+        else:
+            reason = "no temperature sensors"
+        if not readings:
+            logging.info(f"temperature_c is not sampled: {reason}")
+            self.temperature = False
+            return
+        values['temperature_c'] = max(readings)
+
+    def _sample_processes(self, now, values):
+        if now >= self._rescan_at:
+            self._rescan_processes()
+            self._rescan_at = now + PROCESS_RESCAN
+        for name, processes in self._tracked.items():
+            cpu = rss = 0.0
+            alive = []
+            for process in processes:
+                try:
+                    with process.oneshot():
+                        cpu += process.cpu_percent(None)
+                        rss += process.memory_info().rss
+                    alive.append(process)
+                except psutil.Error:
+                    self._rescan_at = now  # Look for a restarted daemon on the next sample
+            self._tracked[name] = alive
+            if alive:
+                values[f'process_cpu_percent:{name}'] = cpu
+                values[f'process_rss_bytes:{name}'] = rss
+
+    def _rescan_processes(self):
+        tracked = {name: [] for name in self.processes}
+        known = {process.pid: process for processes in self._tracked.values() for process in processes}
+        for process in psutil.process_iter(['name']):
+            name = process.info['name']
+            if name in tracked:
+                # Keep the existing object, it holds the reference point for cpu_percent()
+                process = known.get(process.pid, process)
+                if process.pid not in known:
+                    try:
+                        process.cpu_percent(None)
+                    except psutil.Error:
+                        continue
+                tracked[name].append(process)
+        self._tracked = tracked
+
+    def aggregate(self):
+        """Return {name: [min, avg, max, last, count]} over the samples since the previous call.
+
+        Samples older than the ring buffer are no longer included. If no
+        sample was taken since the previous call, one is taken now.
+        """
+        since = self._last_aggregate
+        self._last_aggregate = time.time()
+        window = [values for sampled, values in self.samples if sampled > since]
+        if not window:
+            window = [self.sample()]
+        result = {}
+        for values in window:
+            for name, value in values.items():
+                if value is None or math.isnan(value):
+                    continue
+                entry = result.get(name)
+                if entry is None:
+                    result[name] = [value, value, value, value, 1]
+                else:
+                    entry[0] = min(entry[0], value)
+                    entry[1] += value
+                    entry[2] = max(entry[2], value)
+                    entry[3] = value
+                    entry[4] += 1
+        for entry in result.values():
+            entry[1] /= entry[4]
+        return result
+
+
+if __name__ == '__main__':
+    # Measure the sampling cost on this device: python3 metrics.py [seconds] [process ...]
+    import sys
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    collector = MetricsCollector(processes=sys.argv[2:])
+    started = time.process_time()
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        collector.sample()
+        count += 1
+        time.sleep(collector.interval)
+    cpu = time.process_time() - started
+    for name, (low, avg, high, last, samples) in sorted(collector.aggregate().items()):
+        print(f"{name:40} {low:12.2f} {avg:12.2f} {high:12.2f} {samples:5}")
+    print(f"{count} samples, {cpu / count * 1000:.2f} ms CPU per sample, "
+          f"{cpu / duration * 100:.3f}% CPU at a {collector.interval:g} s interval")
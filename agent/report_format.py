@@ -0,0 +1,84 @@
+try:
+    import cbor2
+except ImportError:  # Without cbor2 reports are sent as text
+    cbor2 = None
+
+# Agent Report Formats
+#
+# Reports are sent either as the legacy free-form text (Content-Format 0,
+# text/plain) or as a versioned CBOR structure (Content-Format 60,
+# application/cbor). The server lists the formats it accepts in the elective
+# Accept-Format option (65002) of its /auth response; the numbers and keys
+# must match the server.
+#
+# CBOR report, schema version 1 (a map with integer keys):
+#   0: schema version (1)
+#   1: timestamp, seconds since the epoch (float)
+#   2: memory usage in percent (float or null)
+#   3: disk usage in percent (float or null)
+#   4: source files, array of paths
+#   5: log records, indefinite-length array of [source index, byte offset, line]
+#      where line is a byte string without the trailing newline
+#   6: optional metric aggregates since the previous report, map of metric
+#      name to [min, avg, max, last, sample count] (see metrics.py)
+#
+# The log records come last and are encoded chunk by chunk, so a report is
+# produced as a stream and never held in memory as a whole.
+
+ACCEPT_FORMAT_OPTION = 65002
+
+CONTENT_FORMAT_TEXT = 0
+CONTENT_FORMAT_CBOR = 60
+
+SCHEMA_VERSION = 1
+KEY_VERSION = 0
+KEY_TIMESTAMP = 1
+KEY_MEMORY = 2
+KEY_DISK = 3
+KEY_SOURCES = 4
+KEY_LOGS = 5
+KEY_METRICS = 6
+
+
+def cbor_available():
+    """Return True if CBOR reports can be produced."""
+    return cbor2 is not None
+
+
+def encode_report(timestamp, memory, disk, chunks, metrics=None):
+    """Yield a CBOR report for the given header values, log chunks and metric aggregates."""
+    sources = []
+    source_index = {}
+    for chunk in chunks:
+        if chunk.path not in source_index:
+            source_index[chunk.path] = len(sources)
+            sources.append(chunk.path)
+
+    dumps = cbor2.dumps
+    header = [
+        dumps(KEY_VERSION), dumps(SCHEMA_VERSION),
+        dumps(KEY_TIMESTAMP), dumps(timestamp),
+        dumps(KEY_MEMORY), dumps(memory),
+        dumps(KEY_DISK), dumps(disk),
+        dumps(KEY_SOURCES), dumps(sources),
+    ]
+    if metrics:
+        header += [dumps(KEY_METRICS), dumps(metrics)]
+    yield b''.join([
+        bytes([0xa0 + len(header) // 2 + 1]),  # Map with the header entries and the log records
+        *header,
+        dumps(KEY_LOGS), b'\x9f',  # Indefinite-length array
+    ])
+    for chunk in chunks:
+        index = source_index[chunk.path]
+        data = chunk.data
+        records = []
+        start = 0
+        while start < len(data):
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = len(data)
+            records.append(dumps([index, chunk.offset + start, data[start:end]]))
+            start = end + 1
+        yield b''.join(records)
+    yield b'\xff'  # End of the log records
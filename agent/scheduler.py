@@ -0,0 +1,171 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+# Adaptive Report Scheduling
+#
+# Decides when the agent collects and spools its next report, so that the
+# report rate follows the log volume instead of a fixed timer:
+#
+# - New log data is noticed through inotify watches on the directories of the
+#   log files (directories, so that rotated and re-created files are seen as
+#   well). Without inotify (other platforms, watch limit reached) the files
+#   are polled every POLL_INTERVAL seconds instead.
+# - A report is sent as soon as FLUSH_BYTES or FLUSH_RECORDS (lines) are
+#   pending, but never sooner than MIN_INTERVAL after the previous report.
+# - Pending data never waits longer than MAX_LATENCY, however little it is.
+# - Without new data only a heartbeat report (metrics, no logs) is sent every
+#   HEARTBEAT_INTERVAL seconds.
+#
+# Files listed as passive (the agent's own log, which every send writes to)
+# are collected with each report but do not trigger reports themselves.
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+
+class LogWatcher:
+    """Call a function when one of the given files changes, using inotify."""
+
+    def __init__(self, paths, on_change):
+        self.paths = paths
+        self.on_change = on_change
+        self._fd = None
+        self._names = {}  # watch descriptor -> names of watched files in that directory
+
+    def start(self):
+        """Add the watches; returns False if inotify is not available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify not available, polling log files instead: {e}")
+            return False
+        if fd < 0:
+            logging.warning(f"inotify not available, polling log files instead: "
+                            f"{os.strerror(ctypes.get_errno())}")
+            return False
+        for path in self.paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            wd = libc.inotify_add_watch(fd, directory.encode(), WATCH_MASK)
+            if wd < 0:
+                logging.warning(f"Cannot watch {directory}, polling log files instead: "
+                                f"{os.strerror(ctypes.get_errno())}")
+                os.close(fd)
+                return False
+            self._names.setdefault(wd, set()).add(name.encode())
+        self._fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._read_events)
+        return True
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        changed = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW or name in self._names.get(wd, ()):
+                changed = True
+        if changed:
+            self.on_change()
+
+    def close(self):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+class ReportScheduler:
+    """Wait until the next report is due, based on the pending log data."""
+
+    def __init__(self, tailer, paths, passive_paths=(), flush_bytes=64 * 1024, flush_records=500,
+                 max_latency=60.0, min_interval=5.0, heartbeat_interval=300.0, poll_interval=15.0):
+        self.tailer = tailer
+        self.paths = None
+        self.watcher = None
+        self._started = False
+        self._watching = False
+        self._event = asyncio.Event()
+        self._last_report = None
+        self._pending_since = None  # When new data was first seen after the last report
+        self.configure(paths, passive_paths, flush_bytes, flush_records, max_latency, min_interval,
+                       heartbeat_interval, poll_interval)
+
+    def configure(self, paths, passive_paths, flush_bytes, flush_records, max_latency, min_interval,
+                  heartbeat_interval, poll_interval):
+        """Set the files and thresholds; once started, changed files are watched right away."""
+        paths = [path for path in paths if path not in passive_paths]
+        self.flush_bytes = flush_bytes
+        self.flush_records = flush_records
+        self.max_latency = max_latency
+        self.min_interval = min_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        if paths != self.paths:
+            self.paths = paths
+            if self.watcher is not None:
+                self.watcher.close()
+            self.watcher = LogWatcher(paths, self._changed)
+            if self._started:
+                self._watching = self.watcher.start()
+        self._event.set()  # Decide again with the new settings
+
+    def start(self):
+        self._started = True
+        self._watching = self.watcher.start()
+        self._event.set()  # Check the files once at startup
+
+    def _changed(self):
+        self._event.set()
+
+    async def wait(self):
+        """Return when the next report is due, with the reason ('threshold', 'latency' or 'heartbeat')."""
+        loop = asyncio.get_running_loop()
+        if self._last_report is None:
+            # The first report (a heartbeat if nothing is pending) is due right away
+            self._last_report = loop.time() - max(self.heartbeat_interval, self.min_interval)
+        while True:
+            self._event.clear()
+            now = loop.time()
+            pending_bytes, pending_lines = self.tailer.pending(self.paths)
+            earliest = self._last_report + self.min_interval
+            if pending_bytes:
+                if self._pending_since is None:
+                    self._pending_since = now
+                if pending_bytes >= self.flush_bytes or pending_lines >= self.flush_records:
+                    reason, due = 'threshold', earliest
+                else:
+                    reason, due = 'latency', max(earliest, self._pending_since + self.max_latency)
+            else:
+                self._pending_since = None
+                reason, due = 'heartbeat', self._last_report + self.heartbeat_interval
+            if due <= now:
+                self._last_report = now
+                self._pending_since = None
+                return reason
+            timeout = due - now
+            if not self._watching:
+                timeout = min(timeout, self.poll_interval)
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+                # Let a burst of writes settle before counting again
+                await asyncio.sleep(min(0.2, self.min_interval))
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        self.watcher.close()
@@ -0,0 +1,279 @@
+import bisect
+import json
+import logging
+import os
+import re
+import struct
+import time
+import zlib
+from collections import deque, namedtuple
+
+# Durable Report Spool
+#
+# Encoded reports are written to the spool before they are sent, so a report
+# survives an unreachable server and agent restarts until the server has
+# acknowledged it.
+#
+# - The spool is a ring of segment files ("spool-<seq>.dat"). Reports are
+#   appended to the newest segment; a new segment is started once it reaches
+#   SEGMENT_BYTES.
+# - Each record is a header (magic, length, CRC-32, Content-Format, creation
+#   time) followed by the encoded report. On open, a torn record at the end of
+#   the newest segment (crash while appending) is cut off.
+# - Records are handed out in order by next_record(); acknowledged records
+#   advance the read position, which is kept in a small JSON state file
+#   (fsync + atomic rename). Several records may be in flight at once; after a
+#   crash the unacknowledged ones are sent again (at-least-once delivery).
+# - Segments whose records are all acknowledged are deleted. When the spool
+#   exceeds MAX_BYTES the oldest segment is evicted, acknowledged or not, so
+#   the disk budget holds during long outages.
+
+Record = namedtuple('Record', ['rid', 'content_format', 'created', 'data'])
+
+RECORD_HEADER = struct.Struct('>4sIIHd')
+RECORD_MAGIC = b'SPL1'
+SEGMENT_PATTERN = re.compile(r'^spool-(\d{8})\.dat$')
+
+
+class Spool:
+    """Size-capped ring of segment files holding unacknowledged reports."""
+
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max(max_bytes, segment_bytes)
+        self.fsync = fsync
+        self.state_file = os.path.join(directory, 'spool_state.json')
+        self._segments = {}  # seq -> list of (offset, length, content_format, created)
+        self._sizes = {}  # seq -> bytes in the segment file
+        self._file = None
+        self._position = (0, 0)  # (seq, offset) of the first unacknowledged record
+        self._next = (0, 0)  # (seq, offset) of the next record to hand out
+        self._retry = deque()  # Records handed out and failed, sent again first
+        self._in_flight = {}  # rid -> True once acknowledged
+        self.appended = 0
+        self.acknowledged = 0
+        self.evicted = 0
+
+    def open(self):
+        """Scan the segments, repair a torn tail and load the read position."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                self._scan(int(match.group(1)))
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self._position = (state['seq'], state['offset'])
+        except FileNotFoundError:
+            self._position = (min(self._segments, default=0), 0)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Error loading spool state, replaying the whole spool: {e}")
+            self._position = (min(self._segments, default=0), 0)
+        if self._position[0] not in self._segments:
+            # Segment already released: continue with the following one
+            following = [seq for seq in self._segments if seq > self._position[0]]
+            self._position = (min(following, default=self._position[0] + 1), 0)
+        self._next = self._position
+        self._release()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f'spool-{seq:08d}.dat')
+
+    def _scan(self, seq):
+        """Index the records of a segment and cut off a torn last record."""
+        records = []
+        offset = 0
+        path = self._path(seq)
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, length, crc, content_format, created = RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if magic != RECORD_MAGIC or len(data) < length or zlib.crc32(data) != crc:
+                    break
+                records.append((offset, length, content_format, created))
+                offset += RECORD_HEADER.size + length
+        if offset < os.path.getsize(path):
+            logging.warning(f"Discarding a torn record at the end of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        self._segments[seq] = records
+        self._sizes[seq] = offset
+
+    def append(self, parts, content_format):
+        """Write a report given as an iterable of byte strings to the spool.
+
+        The report is durable when this returns (fsync unless disabled).
+        """
+        seq = max(self._segments, default=self._position[0])
+        if seq not in self._segments or self._sizes[seq] >= self.segment_bytes:
+            seq = seq + 1 if seq in self._segments else seq
+            self._segments[seq] = []
+            self._sizes[seq] = 0
+        if self._file is None or self._file.name != self._path(seq):
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self._path(seq), 'ab')
+        f = self._file
+        offset = self._sizes[seq]
+        created = time.time()
+        f.seek(offset)
+        f.write(RECORD_HEADER.pack(RECORD_MAGIC, 0, 0, content_format, created))
+        length = 0
+        crc = 0
+        try:
+            for part in parts:
+                f.write(part)
+                length += len(part)
+                crc = zlib.crc32(part, crc)
+            f.flush()
+            # Fill in the header now that length and checksum are known
+            with open(self._path(seq), 'r+b') as header:
+                header.seek(offset)
+                header.write(RECORD_HEADER.pack(RECORD_MAGIC, length, crc, content_format, created))
+                header.flush()
+                if self.fsync:
+                    os.fsync(header.fileno())
+        except BaseException:
+            f.truncate(offset)
+            raise
+        self._segments[seq].append((offset, length, content_format, created))
+        self._sizes[seq] = offset + RECORD_HEADER.size + length
+        self.appended += 1
+        self._evict()
+
+    def _evict(self):
+        """Drop the oldest segments while the spool is over its size budget."""
+        while len(self._segments) > 1 and sum(self._sizes.values()) > self.max_bytes:
+            seq = min(self._segments)
+            lost = sum(1 for offset, *_ in self._segments[seq] if (seq, offset) >= self._position)
+            self.evicted += lost
+            logging.warning(f"Spool over {self.max_bytes} bytes, evicted {lost} unsent reports")
+            self._remove(seq)
+            following = min(self._segments)
+            if self._position < (following, 0):
+                self._position = (following, 0)
+                self._save_position()
+            if self._next < (following, 0):
+                self._next = (following, 0)
+            self._retry = deque(rid for rid in self._retry if rid[0] != seq)
+            self._in_flight = {rid: acked for rid, acked in self._in_flight.items() if rid[0] != seq}
+
+    def _remove(self, seq):
+        del self._segments[seq]
+        del self._sizes[seq]
+        try:
+            os.remove(self._path(seq))
+        except FileNotFoundError:
+            pass
+
+    def _record_at(self, position):
+        """Return the index entry at or after position as (rid, entry), or None."""
+        seq, offset = position
+        for s in sorted(self._segments):
+            if s < seq:
+                continue
+            records = self._segments[s]
+            index = bisect.bisect_left(records, (offset,)) if s == seq else 0
+            if index < len(records):
+                return (s, records[index][0]), records[index]
+        return None
+
+    @staticmethod
+    def _after(rid, entry):
+        # Position right behind a record
+        return rid[0], rid[1] + RECORD_HEADER.size + entry[1]
+
+    def _read(self, rid, entry):
+        offset, length, content_format, created = entry
+        with open(self._path(rid[0]), 'rb') as f:
+            f.seek(offset + RECORD_HEADER.size)
+            return Record(rid, content_format, created, f.read(length))
+
+    def next_record(self):
+        """Return the next Record to send, or None if every record is in flight or acknowledged."""
+        while self._retry:
+            rid = self._retry.popleft()
+            entry = self._entry(rid)
+            if entry is not None:
+                self._in_flight[rid] = False
+                return self._read(rid, entry)
+        found = self._record_at(self._next)
+        if found is None:
+            return None
+        rid, entry = found
+        self._next = self._after(rid, entry)
+        self._in_flight[rid] = False
+        return self._read(rid, entry)
+
+    def _entry(self, rid):
+        records = self._segments.get(rid[0], [])
+        index = bisect.bisect_left(records, (rid[1],))
+        if index < len(records) and records[index][0] == rid[1]:
+            return records[index]
+        return None
+
+    def ack(self, rid):
+        """Mark a record as delivered and advance the read position past delivered records."""
+        if rid not in self._in_flight:
+            return  # Evicted while in flight
+        self._in_flight[rid] = True
+        self.acknowledged += 1
+        moved = False
+        while True:
+            found = self._record_at(self._position)
+            if found is None or not self._in_flight.get(found[0]):
+                break
+            del self._in_flight[found[0]]
+            self._position = self._after(*found)
+            moved = True
+        if moved:
+            self._save_position()
+            self._release()
+
+    def retry(self, rid):
+        """Return a record that could not be delivered; it is handed out again first."""
+        if self._in_flight.pop(rid, None) is not None:
+            self._retry.append(rid)
+            self._retry = deque(sorted(self._retry))
+
+    def _release(self):
+        """Delete segments whose records are all acknowledged."""
+        for seq in sorted(self._segments)[:-1]:
+            if (seq, self._sizes[seq]) > self._position:
+                break
+            self._remove(seq)
+
+    def _save_position(self):
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'seq': self._position[0], 'offset': self._position[1]}, f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp_file, self.state_file)
+
+    def stats(self):
+        """Return the spool depth and counters."""
+        pending = [(seq, entry) for seq in sorted(self._segments) for entry in self._segments[seq]
+                   if (seq, entry[0]) >= self._position]
+        return {
+            'depth': len(pending),
+            'depth_bytes': sum(RECORD_HEADER.size + entry[1] for _, entry in pending),
+            'spool_bytes': sum(self._sizes.values()),
+            'segments': len(self._segments),
+            'oldest_age': time.time() - pending[0][1][3] if pending else 0.0,
+            'in_flight': sum(1 for acked in self._in_flight.values() if not acked),
+            'appended': self.appended,
+            'acknowledged': self.acknowledged,
+            'evicted': self.evicted,
+        }
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
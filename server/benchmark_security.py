@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import base64
+import configparser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiocoap import CON, Context, Message
+from aiocoap.numbers.codes import Code
+
+import oscore_site
+
+# Transport Security Benchmark
+#
+# Compares plain CoAP with OSCORE-protected requests against a scratch server
+# (a copy of coap_server.conf and credentials.txt with the port, output paths
+# and a freshly created OSCORE context pair, REQUIRE off so both kinds of
+# requests are served):
+#
+# - Setup: what an agent pays after a restart before its first report is
+#   accepted, i.e. a new client context and a /auth request. With OSCORE the
+#   security context is loaded from disk once per process (measured
+#   separately); there is no handshake, so no extra round trips.
+# - Messages: latency (p50/p99) of sequential report POSTs, CPU time per
+#   message on the client and on the server, and the size of the request on
+#   the wire.
+#
+# Usage:
+#   python3 benchmark_security.py [--setups 50] [--messages 500] [--payload-size 512]
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def scratch_server(port):
+    # Start a server with one OSCORE context pair in a scratch directory
+    directory = tempfile.mkdtemp(prefix='coap-bench-')
+    _, agent_context = oscore_site.add_context(os.path.join(directory, 'oscore'), 'bench')
+    agent_context = shutil.move(agent_context, os.path.join(directory, 'bench-agent'))
+    config = configparser.ConfigParser()
+    config.read(os.path.join(SERVER_DIR, 'coap_server.conf'))
+    config['coap']['SERVER_PORT'] = str(port)
+    for section in ('store', 'oscore'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config['store']['DIRECTORY'] = os.path.join(directory, 'store')
+    config['oscore']['CONTEXTS'] = os.path.join(directory, 'oscore')
+    config['oscore']['REQUIRE'] = 'no'
+    with open(os.path.join(directory, 'coap_server.conf'), 'w') as f:
+        config.write(f)
+    shutil.copy(os.path.join(SERVER_DIR, 'credentials.txt'), directory)
+    process = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, 'coap_server.py')],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, directory, config['coap'], agent_context
+
+
+def process_cpu(pid):
+    # CPU seconds (user + system) used so far by a process
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+async def create_context(base_uri, security_context):
+    context = await Context.create_client_context()
+    if security_context is not None:
+        context.client_credentials[f'{base_uri}/*'] = security_context
+    return context
+
+
+async def authenticate(context, base_uri, auth):
+    request = Message(code=Code.POST, uri=f"{base_uri}/auth")
+    request.opt.uri_query = [f"Authorization={auth}"]
+    response = await context.request(request).response
+    if not response.code.is_successful():
+        raise RuntimeError(f"/auth failed with {response.code}")
+    return response.payload.decode('utf-8')
+
+
+async def measure_setup(base_uri, auth, security_context, count):
+    # New client contexts per second, each up to an accepted /auth request
+    started = time.monotonic()
+    for _ in range(count):
+        context = await create_context(base_uri, security_context)
+        await authenticate(context, base_uri, auth)
+    return count / (time.monotonic() - started)
+
+
+async def measure_messages(base_uri, data_path, auth, security_context, count, payload, server_pid):
+    # Latencies and CPU cost of sequential report POSTs on one client context
+    context = await create_context(base_uri, security_context)
+    token = await authenticate(context, base_uri, auth)
+    latencies = []
+    errors = 0
+    client_started = time.process_time()
+    server_started = process_cpu(server_pid)
+    for _ in range(count):
+        request = Message(code=Code.POST, uri=f"{base_uri}{data_path}", payload=payload)
+        request.opt.uri_query = [f"Token={token}"]
+        started = time.monotonic()
+        response = await context.request(request).response
+        if response.code == Code.CREATED:
+            latencies.append(time.monotonic() - started)
+        else:
+            errors += 1
+    client_cpu = (time.process_time() - client_started) / count
+    server_cpu = (process_cpu(server_pid) - server_started) / count
+    return sorted(latencies), errors, client_cpu, server_cpu
+
+
+def wire_size(base_uri, data_path, payload, security_context):
+    # Encoded size of a report request, plain or protected
+    request = Message(code=Code.POST, uri=f"{base_uri}{data_path}", payload=payload)
+    request.opt.uri_query = ["Token=" + "x" * 64]
+    if security_context is not None:
+        request, _ = security_context.protect(request)
+    request.mtype, request.mid, request.token = CON, 0, b'\x00' * 4
+    return len(request.encode())
+
+
+async def run(args):
+    if not oscore_site.available():
+        raise SystemExit("OSCORE needs the cryptography, hkdf, cbor and filelock packages")
+    auth = "Basic " + base64.b64encode(args.user.encode('utf-8')).decode('ascii')
+    payload = (b"Timestamp: 2024-01-01T00:00:00\nMemory Usage: 42.00%\nDisk Usage: 37.00%\nLogs:\n"
+               + b"x" * args.payload_size)
+    server, directory, coap, agent_context = scratch_server(args.port)
+    try:
+        await asyncio.sleep(2)  # Wait for the server to bind
+        base_uri = f"coap://{args.host}:{args.port}"
+        data_path = f"/{coap['URI_PATH_PART1']}/{coap['URI_PATH_PART2']}"
+
+        started = time.perf_counter()
+        security_context = oscore_site.oscore.FilesystemSecurityContext(agent_context)
+        load_ms = (time.perf_counter() - started) * 1000
+
+        print(f"{'mode':>6} {'setup/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'client CPU/msg':>15} "
+              f"{'server CPU/msg':>15} {'bytes':>6} {'errors':>7}")
+        for mode, secctx in (('plain', None), ('oscore', security_context)):
+            setup_rate = await measure_setup(base_uri, auth, secctx, args.setups)
+            latencies, errors, client_cpu, server_cpu = await measure_messages(
+                base_uri, data_path, auth, secctx, args.messages, payload, server.pid)
+            print(f"{mode:>6} {setup_rate:>8.0f} {percentile(latencies, 0.5) * 1000:>8.2f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.2f} {client_cpu * 1e6:>12.0f} us "
+                  f"{server_cpu * 1e6:>12.0f} us {wire_size(base_uri, data_path, payload, secctx):>6} {errors:>7}")
+        print(f"OSCORE context load (once per agent start): {load_ms:.1f} ms")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plain CoAP against OSCORE-protected requests")
+    parser.add_argument('--setups', type=int, default=50, help="Client setups (context and /auth) per mode")
+    parser.add_argument('--messages', type=int, default=500, help="Report POSTs per mode")
+    parser.add_argument('--payload-size', type=int, default=512, help="Bytes of log data per report")
+    parser.add_argument('--port', type=int, default=5783, help="Port for the scratch server")
+    parser.add_argument('--host', default='127.0.0.1', help="Address the client sends to")
+    parser.add_argument('--user', default='username:password', help="Credentials as user:password")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import base64
+import configparser
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiocoap import Context, Message
+from aiocoap.numbers.codes import Code
+
+# Worker Scaling Benchmark
+#
+# Measures request throughput of the CoAP server for different --workers
+# settings. For every worker count a server is started in a scratch directory
+# (a copy of coap_server.conf and credentials.txt with the port and output
+# paths changed), and client processes, each with its own UDP socket, keep a
+# fixed number of report POSTs in flight for the given duration. Throughput
+# should scale close to linearly until the workers and clients together
+# saturate the CPU cores, so the clients are best run on a second machine
+# (--host) for larger worker counts.
+#
+# Usage:
+#   python3 benchmark_workers.py [--workers 1 2 4] [--clients 4] [--concurrency 16]
+#                                [--duration 10] [--payload-size 512]
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+async def client_load(base_uri, data_path, auth, concurrency, duration, payload, results):
+    # Keep concurrency POSTs in flight and record their latencies
+    context = await Context.create_client_context()
+    request = Message(code=Code.POST, uri=f"{base_uri}/auth")
+    request.opt.uri_query = [f"Authorization={auth}"]
+    response = await context.request(request).response
+    token = response.payload.decode('utf-8')
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def sender():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            request = Message(code=Code.POST, uri=f"{base_uri}{data_path}", payload=payload)
+            request.opt.uri_query = [f"Token={token}"]
+            started = time.monotonic()
+            try:
+                response = await context.request(request).response
+                if response.code == Code.CREATED:
+                    latencies.append(time.monotonic() - started)
+                else:
+                    errors += 1
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    results.put((latencies, errors))
+
+
+def run_client(*args):
+    asyncio.run(client_load(*args))
+
+
+def scratch_server(port, workers):
+    # Start a server with the given worker count in a scratch directory
+    directory = tempfile.mkdtemp(prefix='coap-bench-')
+    config = configparser.ConfigParser()
+    config.read(os.path.join(SERVER_DIR, 'coap_server.conf'))
+    config['coap']['SERVER_PORT'] = str(port)
+    if not config.has_section('store'):
+        config.add_section('store')
+    config['store']['DIRECTORY'] = os.path.join(directory, 'store')
+    with open(os.path.join(directory, 'coap_server.conf'), 'w') as f:
+        config.write(f)
+    shutil.copy(os.path.join(SERVER_DIR, 'credentials.txt'), directory)
+    process = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, 'coap_server.py'),
+                                '--workers', str(workers)],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, directory, config['coap']
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CoAP server throughput per worker count")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}),
+                        help="Worker counts to measure")
+    parser.add_argument('--clients', type=int, default=os.cpu_count() or 1,
+                        help="Client processes (default: number of CPU cores)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight per client process")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds per measurement")
+    parser.add_argument('--payload-size', type=int, default=512, help="Bytes of log data per report")
+    parser.add_argument('--port', type=int, default=5783, help="Port for the scratch server")
+    parser.add_argument('--host', default='127.0.0.1', help="Address the clients send to")
+    parser.add_argument('--user', default='username:password', help="Credentials as user:password")
+    args = parser.parse_args()
+
+    auth = "Basic " + base64.b64encode(args.user.encode('utf-8')).decode('ascii')
+    payload = (b"Timestamp: 2024-01-01T00:00:00\nMemory Usage: 42.00%\nDisk Usage: 37.00%\nLogs:\n"
+               + b"x" * args.payload_size)
+    baseline = None
+    print(f"{'workers':>7} {'req/s':>10} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for workers in args.workers:
+        server, directory, coap = scratch_server(args.port, workers)
+        try:
+            time.sleep(2 + 0.2 * workers)  # Wait for the workers to bind
+            base_uri = f"coap://{args.host}:{args.port}"
+            data_path = f"/{coap['URI_PATH_PART1']}/{coap['URI_PATH_PART2']}"
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=run_client, args=(
+                base_uri, data_path, auth, args.concurrency, args.duration, payload, results))
+                for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            latencies = []
+            errors = 0
+            for _ in clients:
+                client_latencies, client_errors = results.get()
+                latencies += client_latencies
+                errors += client_errors
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+        latencies.sort()
+        rate = len(latencies) / args.duration
+        baseline = baseline or rate
+        print(f"{workers:>7} {rate:>10.0f} {rate / baseline:>8.2f} "
+              f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
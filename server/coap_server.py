@@ -1,13 +1,36 @@
+import argparse
 import asyncio
-import subprocess
 import configparser
-from aiocoap import *
+import functools
+import json
+import math
+import os
+import signal
+import time
+from aiocoap import Context, Message
 from aiocoap.numbers.codes import Code
 from aiocoap.resource import Resource, Site
-from datetime import datetime, timedelta
-import base64
-import uuid
-import hashlib
+from aiocoap.optiontypes import BlockOption
+from dataclasses import dataclass, replace
+from datetime import datetime
+from log_sink import FSYNC_POLICIES, LogSink, TextFileBackend
+from record_store import RecordStore, StoreReader, format_cursor, parse_cursor, partition_directory
+from live_tail import LiveTail
+from neighbor_table import NeighborTable
+from token_store import SignedTokens, TokenStore
+from workers import WorkerGroup
+import oscore_site
+from oscore_site import OscoreSite
+from credential_store import CredentialStore, CredentialsBusy
+from rate_limit import FairQueue, TokenBuckets
+from timeseries import RESOLUTIONS, TimeSeriesStore
+from instrumentation import (CallbackCounter, InstrumentedSite, LoopLagMonitor, MetricsHTTPServer, Registry,
+                             SamplingProfiler)
+from compression import (ACCEPT_ENCODING_OPTION, IDENTITY, Decoder, DecompressionError, OutputLimitExceeded,
+                         request_encoding, supported_codecs)
+from report_format import (ACCEPT_FORMAT_OPTION, CONTENT_FORMAT_CBOR, CONTENT_FORMAT_TEXT,
+                           ReportDecoder, ReportFormatError, render_text, supported_formats)
+from aiocoap.numbers.optionnumbers import OptionNumber
 
 # CoAP Server Implementation
 #
@@ -20,78 +43,368 @@ import hashlib
 # - coap_server.conf: Configuration settings for the server.
 # - credentials.txt: Contains hashed credentials for user authentication.
 #
+# Further features, each in its own module:
+# - Log sink (log_sink.py): received data is written asynchronously so that
+#   disk I/O never blocks the event loop. Blockwise (RFC 7959) uploads are
+#   streamed into the sink block by block instead of being reassembled.
+# - Record store (record_store.py): segmented storage with a time/client
+#   index, queried with query_logs.py; a single text file is the alternative.
+# - GET /logs (live_tail.py): stored reports, paged with blockwise responses,
+#   and a live tail through Observe with per-observer batching and limits.
+# - Workers (workers.py): --workers N runs N processes sharing the UDP port
+#   through SO_REUSEPORT.
+# - Compression (compression.py): deflate/zstd payloads are decompressed
+#   transparently, block by block for blockwise transfers.
+# - Report formats (report_format.py): legacy text or structured CBOR
+#   records, decoded incrementally and written in the text layout.
+# - MAC addresses (neighbor_table.py): resolved from a cached copy of the
+#   kernel ARP table.
+# - Tokens (token_store.py): stateless and HMAC-signed with rotatable keys,
+#   or random tokens kept in a store with an expiry index and a sweeper.
+# - OSCORE (oscore_site.py): end-to-end protection with per-agent security
+#   contexts and persisted sequence numbers.
+# - Credentials (credential_store.py): offloaded KDF hashing, a verification
+#   cache and hot reload of credentials.txt.
+# - Instrumentation (instrumentation.py): request counts, stage latencies,
+#   queue depths and event loop lag on GET /metrics and an optional local
+#   HTTP endpoint; SIGUSR2 toggles a sampling profiler.
+# - Rate limits (rate_limit.py): token buckets per user and per client IP
+#   (4.29 Too Many Requests with a Max-Age hint); while the sink is
+#   congested, its capacity is shared by deficit round robin.
+# - Time series (timeseries.py): memory and disk usage, metric aggregates and
+#   sensor readings of every report, rolled up per client into 1m/1h/1d
+#   buckets, persisted to disk and served by GET /series.
+# - Reload: SIGHUP re-reads coap_server.conf and credentials.txt in place,
+#   keeping tokens, transfers, queues and rate limit state.
+#
 # Dependencies:
 # - aiocoap
 # - configparser
 
+CONFIG_FILE = 'coap_server.conf'
+
+# Settings that only take effect at startup; a reload (SIGHUP) keeps their current values
+RESTART_SETTINGS = ('server_ip', 'server_port', 'credentials_hash_workers', 'token_format', 'token_sweep_interval',
+                    'token_persist_file', 'sink_backend', 'sink_log_file', 'sink_queue_size', 'store_directory',
+                    'store_segment_bytes', 'store_segment_seconds', 'store_compress_sealed', 'store_retention_days',
+                    'store_max_bytes', 'mac_mode', 'mac_arp_table', 'oscore_contexts', 'oscore_require',
+                    'metrics_http_address', 'metrics_http_port', 'metrics_max_clients', 'metrics_loop_lag_interval',
+                    'metrics_profile_interval', 'metrics_profile_file', 'timeseries_enabled', 'timeseries_directory',
+                    'timeseries_persist_interval', 'timeseries_minute_slots', 'timeseries_hour_slots',
+                    'timeseries_day_slots')
+
+@dataclass(frozen=True)
+class Settings:
+    # Configuration read from coap_server.conf by read_settings(); SIGHUP swaps in a new object
+    # [coap]
+    server_ip: str
+    server_port: int
+    uri_path_part1: str
+    uri_path_part2: str
+    # [credentials]
+    credentials_file: str
+    credentials_cache_size: int
+    credentials_cache_ttl: float
+    credentials_hash_workers: int
+    credentials_reload_interval: float
+    credentials_max_pending: int
+    # [tokens]
+    token_format: str
+    token_expiry_seconds: int
+    token_key_file: str
+    token_revocation_file: str
+    token_max_per_user: int
+    token_sweep_interval: float
+    token_persist_file: str
+    # [sink]
+    sink_backend: str
+    sink_log_file: str
+    sink_queue_size: int
+    sink_flush_interval: float
+    sink_fsync: str
+    sink_retry_after: int
+    # [store]
+    store_directory: str
+    store_segment_bytes: int
+    store_segment_seconds: float
+    store_compress_sealed: bool
+    store_retention_days: float
+    store_max_bytes: int
+    # [query]
+    query_readers: tuple
+    query_page_records: int
+    query_page_bytes: int
+    query_notify_interval: float
+    query_notify_max_bytes: int
+    query_observer_buffer: int
+    query_max_observers: int
+    # [blockwise]
+    block_max_body_size: int
+    block_timeout: float
+    # [compression]
+    compression_dictionary_file: str
+    # [mac]
+    mac_mode: str
+    mac_arp_table: str
+    mac_ttl: float
+    mac_negative_ttl: float
+    # [oscore]
+    oscore_contexts: str
+    oscore_require: bool
+    # [metrics]
+    metrics_http_address: str
+    metrics_http_port: int
+    metrics_max_clients: int
+    metrics_loop_lag_interval: float
+    metrics_profile_interval: float
+    metrics_profile_file: str
+    # [limits]
+    limits_user_requests_per_second: float
+    limits_user_request_burst: int
+    limits_user_bytes_per_second: float
+    limits_user_byte_burst: int
+    limits_ip_requests_per_second: float
+    limits_ip_request_burst: int
+    limits_ip_bytes_per_second: float
+    limits_ip_byte_burst: int
+    limits_max_clients: int
+    limits_fair_watermark: float
+    limits_fair_quantum: int
+    limits_fair_max_pending: int
+    limits_fair_max_wait: float
+    # [timeseries]
+    timeseries_enabled: bool
+    timeseries_directory: str
+    timeseries_persist_interval: float
+    timeseries_minute_slots: int
+    timeseries_hour_slots: int
+    timeseries_day_slots: int
+    timeseries_max_series: int
+    timeseries_max_series_per_client: int
+    timeseries_json_fields: tuple
+    timeseries_json_label: str
+    timeseries_max_pending: int
+    compression_dictionary: bytes  # Contents of compression_dictionary_file, None without one
+
+def read_settings(path):
+    # Read the configuration file into Settings; raises if it is invalid
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    sink_fsync = config.get('sink', 'FSYNC', fallback='interval')
+    if sink_fsync not in FSYNC_POLICIES:
+        raise ValueError(f"Invalid fsync policy: {sink_fsync}")
+
+    # Pre-trained compression dictionary shared with the agents
+    compression_dictionary_file = config.get('compression', 'DICTIONARY', fallback='')  # Must match the agents
+    compression_dictionary = None
+    if compression_dictionary_file:
+        with open(compression_dictionary_file, 'rb') as f:
+            compression_dictionary = f.read()
+
+    return Settings(
+        # CoAP endpoint
+        server_ip=config['coap']['SERVER_IP'],
+        server_port=int(config['coap']['SERVER_PORT']),
+        uri_path_part1=config['coap']['URI_PATH_PART1'],
+        uri_path_part2=config['coap']['URI_PATH_PART2'],
+
+        # Credential configuration (optional section, defaults apply when missing)
+        credentials_file=config.get('credentials', 'FILE', fallback='credentials.txt'),
+        credentials_cache_size=config.getint('credentials', 'CACHE_SIZE', fallback=1024),
+        credentials_cache_ttl=config.getfloat('credentials', 'CACHE_TTL', fallback=300.0),
+        credentials_hash_workers=config.getint('credentials', 'HASH_WORKERS', fallback=2),
+        credentials_reload_interval=config.getfloat('credentials', 'RELOAD_CHECK_INTERVAL', fallback=2.0),
+        credentials_max_pending=config.getint('credentials', 'MAX_PENDING', fallback=32),
+
+        # Token configuration (optional section, defaults apply when missing)
+        token_format=config.get('tokens', 'FORMAT', fallback='signed'),  # signed or random
+        token_expiry_seconds=config.getint('tokens', 'EXPIRY_SECONDS', fallback=3600),  # Token validity period
+        token_key_file=config.get('tokens', 'KEY_FILE', fallback='token_keys.txt'),  # Created when missing
+        token_revocation_file=config.get('tokens', 'REVOCATION_FILE', fallback=''),  # Empty = no revocations
+        token_max_per_user=config.getint('tokens', 'MAX_PER_USER', fallback=0),  # 0 = unlimited
+        token_sweep_interval=config.getfloat('tokens', 'SWEEP_INTERVAL', fallback=60.0),
+        token_persist_file=config.get('tokens', 'PERSIST_FILE', fallback=''),  # Empty = no persistence
+
+        # Log sink configuration (optional section, defaults apply when missing)
+        sink_backend=config.get('sink', 'BACKEND', fallback='store'),  # store or file
+        sink_log_file=config.get('sink', 'LOG_FILE', fallback='coap_logging.txt'),
+        sink_queue_size=config.getint('sink', 'QUEUE_SIZE', fallback=10000),
+        sink_flush_interval=config.getfloat('sink', 'FLUSH_INTERVAL', fallback=1.0),
+        sink_fsync=sink_fsync,
+        sink_retry_after=config.getint('sink', 'RETRY_AFTER', fallback=5),  # Max-Age sent with 5.03
+
+        # Record store configuration (optional section, used with BACKEND = store)
+        store_directory=config.get('store', 'DIRECTORY', fallback='store'),
+        store_segment_bytes=config.getint('store', 'SEGMENT_BYTES', fallback=64 * 1024 * 1024),
+        store_segment_seconds=config.getfloat('store', 'SEGMENT_SECONDS', fallback=3600.0),
+        store_compress_sealed=config.getboolean('store', 'COMPRESS_SEALED', fallback=True),
+        store_retention_days=config.getfloat('store', 'RETENTION_DAYS', fallback=30.0),  # 0 = keep forever
+        store_max_bytes=config.getint('store', 'MAX_BYTES', fallback=0),  # 0 = no size budget
+
+        # Query resource configuration (optional section, defaults apply when missing)
+        query_readers=tuple(u.strip() for u in config.get('query', 'READERS', fallback='').split(',') if u.strip()),  # Empty = all users
+        query_page_records=config.getint('query', 'PAGE_RECORDS', fallback=100),
+        query_page_bytes=config.getint('query', 'PAGE_BYTES', fallback=256 * 1024),
+        query_notify_interval=config.getfloat('query', 'NOTIFY_INTERVAL', fallback=1.0),  # Minimum seconds between notifications
+        query_notify_max_bytes=config.getint('query', 'NOTIFY_MAX_BYTES', fallback=1024),
+        query_observer_buffer=config.getint('query', 'OBSERVER_BUFFER_BYTES', fallback=64 * 1024),
+        query_max_observers=config.getint('query', 'MAX_OBSERVERS', fallback=16),
+
+        # Blockwise transfer configuration (optional section, defaults apply when missing)
+        block_max_body_size=config.getint('blockwise', 'MAX_BODY_SIZE', fallback=64 * 1024 * 1024),
+        block_timeout=config.getfloat('blockwise', 'TIMEOUT', fallback=60.0),  # Seconds before an incomplete transfer is dropped
+
+        # Compression configuration (optional section, defaults apply when missing)
+        compression_dictionary_file=compression_dictionary_file,
+
+        # MAC resolution configuration (optional section, defaults apply when missing)
+        mac_mode=config.get('mac', 'MODE', fallback='lazy'),
+        mac_arp_table=config.get('mac', 'ARP_TABLE', fallback='/proc/net/arp'),
+        mac_ttl=config.getfloat('mac', 'TTL', fallback=30.0),
+        mac_negative_ttl=config.getfloat('mac', 'NEGATIVE_TTL', fallback=10.0),
+
+        # OSCORE configuration (optional section, disabled when CONTEXTS is empty)
+        oscore_contexts=config.get('oscore', 'CONTEXTS', fallback=''),  # One subdirectory per agent
+        oscore_require=config.getboolean('oscore', 'REQUIRE', fallback=False),  # Refuse plain requests
+
+        # Instrumentation configuration (optional section, defaults apply when missing)
+        metrics_http_address=config.get('metrics', 'HTTP_ADDRESS', fallback='127.0.0.1'),
+        metrics_http_port=config.getint('metrics', 'HTTP_PORT', fallback=0),  # 0 = no HTTP endpoint
+        metrics_max_clients=config.getint('metrics', 'MAX_CLIENTS', fallback=1000),  # Per-client series
+        metrics_loop_lag_interval=config.getfloat('metrics', 'LOOP_LAG_INTERVAL', fallback=0.5),
+        metrics_profile_interval=config.getfloat('metrics', 'PROFILE_INTERVAL', fallback=0.005),
+        metrics_profile_file=config.get('metrics', 'PROFILE_FILE', fallback='profile-{pid}.txt'),
+
+        # Rate limit configuration (optional section, defaults apply when missing; 0 = unlimited)
+        limits_user_requests_per_second=config.getfloat('limits', 'USER_REQUESTS_PER_SECOND', fallback=0.0),
+        limits_user_request_burst=config.getint('limits', 'USER_REQUEST_BURST', fallback=100),
+        limits_user_bytes_per_second=config.getfloat('limits', 'USER_BYTES_PER_SECOND', fallback=0.0),
+        limits_user_byte_burst=config.getint('limits', 'USER_BYTE_BURST', fallback=8 * 1024 * 1024),
+        limits_ip_requests_per_second=config.getfloat('limits', 'IP_REQUESTS_PER_SECOND', fallback=0.0),
+        limits_ip_request_burst=config.getint('limits', 'IP_REQUEST_BURST', fallback=500),
+        limits_ip_bytes_per_second=config.getfloat('limits', 'IP_BYTES_PER_SECOND', fallback=0.0),
+        limits_ip_byte_burst=config.getint('limits', 'IP_BYTE_BURST', fallback=32 * 1024 * 1024),
+        limits_max_clients=config.getint('limits', 'MAX_CLIENTS', fallback=100000),  # Buckets kept per scope
+        limits_fair_watermark=config.getfloat('limits', 'FAIR_WATERMARK', fallback=0.5),  # Fraction of QUEUE_SIZE
+        limits_fair_quantum=config.getint('limits', 'FAIR_QUANTUM', fallback=4096),
+        limits_fair_max_pending=config.getint('limits', 'FAIR_MAX_PENDING', fallback=64),
+        limits_fair_max_wait=config.getfloat('limits', 'FAIR_MAX_WAIT', fallback=2.0),
+
+        # Time series configuration (optional section, defaults apply when missing)
+        timeseries_enabled=config.getboolean('timeseries', 'ENABLED', fallback=True),
+        timeseries_directory=config.get('timeseries', 'DIRECTORY', fallback='timeseries'),  # Empty = not persisted
+        timeseries_persist_interval=config.getfloat('timeseries', 'PERSIST_INTERVAL', fallback=60.0),
+        timeseries_minute_slots=config.getint('timeseries', 'MINUTE_SLOTS', fallback=120),
+        timeseries_hour_slots=config.getint('timeseries', 'HOUR_SLOTS', fallback=192),
+        timeseries_day_slots=config.getint('timeseries', 'DAY_SLOTS', fallback=90),
+        timeseries_max_series=config.getint('timeseries', 'MAX_SERIES', fallback=200000),
+        timeseries_max_series_per_client=config.getint('timeseries', 'MAX_SERIES_PER_CLIENT', fallback=64),
+        timeseries_json_fields=tuple(f.strip() for f in config.get('timeseries', 'JSON_FIELDS', fallback='temperature, humidity').split(',') if f.strip()),
+        timeseries_json_label=config.get('timeseries', 'JSON_LABEL', fallback='sensor_id'),
+        timeseries_max_pending=config.getint('timeseries', 'MAX_PENDING', fallback=10000),
+        compression_dictionary=compression_dictionary,
+    )
+
 # Load configuration from coap_server.conf
-config = configparser.ConfigParser()
-config.read('coap_server.conf')
+settings = read_settings(CONFIG_FILE)
+
+# Elective option carrying the cursor of the next result page (experimental range)
+NEXT_CURSOR_OPTION = 65004
 
-# Define configuration variables
-SERVER_IP = config['coap']['SERVER_IP']
-SERVER_PORT = int(config['coap']['SERVER_PORT'])
-URI_PATH_PART1 = config['coap']['URI_PATH_PART1']
-URI_PATH_PART2 = config['coap']['URI_PATH_PART2']
-TOKEN_EXPIRY_SECONDS = 3600  # Token validity period
+CONTENT_FORMAT_JSON = 50  # application/json
+TOO_MANY_REQUESTS = Code(157)  # 4.29 (RFC 8516)
+
+# Metrics of this process (instrumentation.py)
+metrics = Registry()
+REQUESTS = metrics.counter('coap_requests_total', "CoAP requests by resource and response code",
+                           ('resource', 'code'))
+REQUEST_SECONDS = metrics.histogram('coap_request_duration_seconds', "Time to render a CoAP request",
+                                    ('resource',))
+AUTHENTICATIONS = metrics.counter('coap_authentications_total',
+                                  "Authentications by method (token, fallback credentials, /auth login) and result",
+                                  ('method', 'result'))
+STAGE_SECONDS = metrics.histogram('coap_stage_duration_seconds', "Time spent in request processing stages",
+                                  ('stage',))
+INGESTED_BYTES = metrics.counter('coap_ingested_bytes_total', "Report payload bytes received per client",
+                                 ('client',), max_series=settings.metrics_max_clients)
+RATE_LIMITED = metrics.counter('coap_rate_limited_total',
+                               "Requests refused with 4.29 by scope (user or IP rate limit, fair queue share)",
+                               ('scope',))
+LOOP_LAG = metrics.histogram('coap_event_loop_lag_seconds', "Delay of event loop timers")
+LOOP_LAG_LAST = metrics.gauge('coap_event_loop_lag_last_seconds', "Most recent delay of an event loop timer")
 
 # Load hashed credentials from credentials.txt
-def load_credentials():
-    # Load user credentials from a file
-    credentials = {}
-    with open('credentials.txt', 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):  # Ignore empty lines and comments
-                parts = line.split(':')
-                if len(parts) == 2:
-                    username, hashed_password = parts
-                    credentials[username] = hashed_password
-                else:
-                    print(f"Warning: Ignoring invalid credential line: {line}")
-    return credentials
-
-credentials = load_credentials()
-
-# Token storage
-tokens = {}
+credentials = CredentialStore(settings.credentials_file, cache_size=settings.credentials_cache_size,
+                              cache_ttl=settings.credentials_cache_ttl,
+                              hash_workers=settings.credentials_hash_workers,
+                              reload_check_interval=settings.credentials_reload_interval,
+                              max_pending=settings.credentials_max_pending)
+
+# Token issuing and validation: signed tokens need no per-token state
+def signed_tokens():
+    return SignedTokens(settings.token_key_file, settings.token_expiry_seconds,
+                        revocation_file=settings.token_revocation_file or None)
+
+if settings.token_format == 'signed':
+    tokens = signed_tokens()
+else:
+    tokens = TokenStore(settings.token_expiry_seconds, max_per_user=settings.token_max_per_user,
+                        persist_path=settings.token_persist_file or None)
+
+# Per-user and per-IP rate limits
+user_limits = TokenBuckets(settings.limits_user_requests_per_second, settings.limits_user_request_burst,
+                           settings.limits_user_bytes_per_second, settings.limits_user_byte_burst,
+                           settings.limits_max_clients)
+ip_limits = TokenBuckets(settings.limits_ip_requests_per_second, settings.limits_ip_request_burst,
+                         settings.limits_ip_bytes_per_second, settings.limits_ip_byte_burst,
+                         settings.limits_max_clients)
+
+# IP -> MAC resolver
+neighbor_table = NeighborTable(settings.mac_arp_table, ttl=settings.mac_ttl, negative_ttl=settings.mac_negative_ttl,
+                               mode=settings.mac_mode)
 
 # Get MAC address from IP
 def get_mac(ip):
-    # Retrieve MAC address using ARP
+    # Retrieve MAC address from the cached ARP table
+    started = time.perf_counter()
     try:
         ipv4_part = ip.split(":")[-1]
-        pid = subprocess.Popen(["arp", "-n", ipv4_part], stdout=subprocess.PIPE)
-        s = pid.communicate()[0].decode('utf-8')
-        lines = s.split('\n')
-
-        for line in lines:
-            if ipv4_part in line:
-                parts = line.split()
-                mac = parts[2] if len(parts) > 2 else None
-                return mac if mac != "(incomplete)" else None
-        return None
+        return neighbor_table.lookup(ipv4_part)
     except Exception as e:
         print(f"Error getting MAC address for IP {ip}: {e}")
         return None
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, ('mac_lookup',))
 
-# Hash password
-def hash_password(password):
-    # Hash password using SHA-256
-    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+# Client IPv4 address of a request
+def client_address(request):
+    client_ip = request.remote.sockaddr[0]
+    return client_ip.split(":")[-1] if "::" in client_ip else client_ip
+
+# 4.29 response telling the client when to retry
+def too_many_requests(seconds, scope):
+    RATE_LIMITED.inc((scope,))
+    return Message(code=TOO_MANY_REQUESTS, payload=b"Too many requests", max_age=max(1, math.ceil(seconds)))
+
+# 5.03 response while too many password verifications are pending
+def credentials_busy():
+    return Message(code=Code.SERVICE_UNAVAILABLE, payload=b"Server busy", max_age=1)
+
+# Check a request against the rate limits of its client IP or user
+def rate_limit(buckets, key, size, scope):
+    # Return a 4.29 response if the key is over its limit, else None
+    wait = buckets.acquire(key, size)
+    return too_many_requests(wait, scope) if wait else None
 
 # Validate credentials
-def validate_credentials(auth_header):
+async def validate_credentials(auth_header):
     # Validate user credentials from authorization header
+    # CredentialsBusy is passed on, so that the request is answered with 5.03
     try:
-        encoded_credentials = auth_header.split(" ")[1]
-        decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-        username, password = decoded_credentials.split(":")
-        hashed_password = hash_password(password)
-        if username in credentials and credentials[username] == hashed_password:
-            return username
-        else:
-            return None
+        return await credentials.verify(auth_header)
+    except CredentialsBusy:
+        raise
     except Exception as e:
         print(f"Error validating credentials: {e}")
         return None
@@ -99,100 +412,706 @@ def validate_credentials(auth_header):
 # Generate token
 def generate_token(username):
     # Generate a new token for the user
-    token = str(uuid.uuid4())
-    tokens[token] = (username, datetime.now() + timedelta(seconds=TOKEN_EXPIRY_SECONDS))
-    return token
+    return tokens.issue(username)
 
 # Validate token
 def validate_token(token):
-    # Check if the token is valid and not expired
-    if token in tokens:
-        username, expiry = tokens[token]
-        if datetime.now() < expiry:
-            return username
-        else:
-            del tokens[token]
-            return None
-    else:
-        return None
+    # Return the token's username if it is valid and not expired
+    return tokens.validate(token)
+
+# Authenticate a data or query request
+async def authenticate(request):
+    # Return (username, token) from the Token or Authorization query option
+    started = time.perf_counter()
+    try:
+        return await _authenticate(request)
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, ('auth',))
+
+async def _authenticate(request):
+    token = None
+    auth_header = None
+    for option in request.opt.uri_query:
+        if option.startswith("Token="):
+            token = option.split("=", 1)[1]
+        elif option.startswith("Authorization="):
+            auth_header = option.split("=", 1)[1]
+
+    username = validate_token(token) if token else None
+    if token:
+        AUTHENTICATIONS.inc(('token', 'ok' if username else 'failed'))
+    if not username:
+        if not auth_header:
+            return None, None
+        username = await validate_credentials(auth_header)
+        AUTHENTICATIONS.inc(('fallback', 'ok' if username else 'failed'))
+        if not username:
+            return None, None
+        token = generate_token(username)
+    return username, token
 
 class AuthResource(Resource):
     # Resource for handling authentication requests
     async def render_post(self, request):
         # Process POST request for authentication
         try:
+            # Logins cost a password hash, so they count against the client's IP limit
+            limited = rate_limit(ip_limits, client_address(request), 0, 'ip')
+            if limited:
+                return limited
+
             auth_header = None
             for option in request.opt.uri_query:
                 if option.startswith("Authorization="):
                     auth_header = option.split("=", 1)[1]
                     break
 
-            username = validate_credentials(auth_header)
+            username = await validate_credentials(auth_header)
+            AUTHENTICATIONS.inc(('login', 'ok' if username else 'failed'))
             if username:
                 token = generate_token(username)
-                return Message(code=Code.CONTENT, payload=token.encode('utf-8'))
+                response = Message(code=Code.CONTENT, payload=token.encode('utf-8'))
+                # Advertise the payload codings this server can decode
+                for codec in supported_codecs():
+                    response.opt.add_option(OptionNumber(ACCEPT_ENCODING_OPTION).create_option(value=bytes([codec])))
+                # Advertise the report formats this server can decode
+                for content_format in supported_formats():
+                    response.opt.add_option(OptionNumber(ACCEPT_FORMAT_OPTION).create_option(
+                        value=content_format.to_bytes((content_format.bit_length() + 7) // 8, 'big')))
+                return response
             else:
                 return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
+        except CredentialsBusy:
+            return credentials_busy()
         except Exception as e:
             print(f"Error processing authentication request: {e}")
             return Message(code=Code.INTERNAL_SERVER_ERROR)
 
+class PayloadPipeline:
+    # Decompresses and decodes one report payload, piece by piece
+    def __init__(self, request):
+        codec = request_encoding(request)
+        self.decompressor = None
+        if codec != IDENTITY:
+            self.decompressor = Decoder(codec, settings.compression_dictionary, settings.block_max_body_size)
+        content_format = request.opt.content_format
+        if content_format == CONTENT_FORMAT_CBOR:
+            self.report = ReportDecoder()
+        elif content_format in (None, CONTENT_FORMAT_TEXT):
+            self.report = None
+        else:
+            raise ReportFormatError(f"Unsupported content format: {content_format}")
+
+    def feed(self, data, last):
+        # Return (text, events) for the next piece of the payload: the text to log and, for CBOR
+        # reports, the decoded header and record events (None for text reports)
+        if self.decompressor is not None:
+            # The decoder raises OutputLimitExceeded at the first piece beyond the limit
+            data = b''.join(self.decompressor.decode(data))
+            if last:
+                self.decompressor.finish()
+        if self.report is None:
+            return data, None
+        events = self.report.feed(data)
+        if last:
+            self.report.finish()
+        # The stored reports and the live tail keep the text layout, rendered from the events
+        return render_text(events), events
+
+class BlockAssembly:
+    # State of one incoming Block1 transfer
+    def __init__(self, stream, head, token, pipeline, extractor):
+        self.stream = stream
+        self.head = head
+        self.token = token
+        self.pipeline = pipeline
+        self.extractor = extractor  # None when time series are disabled
+        self.preview = bytearray()  # Beginning of the report for the live tail
+        self.next_block = 0
+        self.timer = None
+
+    def add_preview(self, data):
+        if len(self.preview) < settings.query_notify_max_bytes:
+            self.preview += data[:settings.query_notify_max_bytes - len(self.preview)]
+
+    def extract(self, data, events, last):
+        if self.extractor is not None:
+            self.extractor.feed(data, events)
+            if last:
+                self.extractor.finish()
+
 class PostResource(Resource):
     # Resource for handling data submission requests
+    def __init__(self, sink, live_tail, series):
+        super().__init__()
+        self.sink = sink
+        self.live_tail = live_tail
+        self.series = series  # None when time series are disabled
+        self.assemblies = {}
+        # Shares the sink between clients once it is filled beyond the watermark
+        self.fair_queue = FairQueue(lambda: self.watermark - sink.depth)
+        self.configure()
+
+    def configure(self):
+        # Apply the fair queue settings (at startup and on reload)
+        self.watermark = max(1, int(self.sink.queue_size * settings.limits_fair_watermark))
+        self.fair_queue.quantum = settings.limits_fair_quantum
+        self.fair_queue.max_pending = settings.limits_fair_max_pending
+        self.fair_queue.max_wait = settings.limits_fair_max_wait
+
+    async def needs_blockwise_assembly(self, request):
+        # Block1 transfers are streamed into the sink by this resource
+        return False
+
     async def render_post(self, request):
         # Process POST request for data submission
         try:
-            token = None
-            auth_header = None
-            for option in request.opt.uri_query:
-                if option.startswith("Token="):
-                    token = option.split("=", 1)[1]
-                elif option.startswith("Authorization="):
-                    auth_header = option.split("=", 1)[1]
+            block1 = request.opt.block1
+            size = len(request.payload)
+            if block1 is not None and block1.block_number > 0:
+                key = (request.remote, tuple(request.opt.uri_query))
+                assembly = self.assemblies.get(key)
+                if assembly is None:
+                    return Message(code=Code.REQUEST_ENTITY_INCOMPLETE)
+                # The transfer was admitted with its first block; later blocks are charged, not refused
+                meta = assembly.stream.meta
+                user_limits.charge(meta['user'], size)
+                ip_limits.charge(meta['ip'], size)
+                refused = await self.schedule((meta['user'], meta['ip']), size)
+                if refused:
+                    return refused
+                if self.assemblies.get(key) is not assembly:
+                    return Message(code=Code.REQUEST_ENTITY_INCOMPLETE)  # Replaced or expired while waiting
+                return self.receive_block(key, assembly, request, block1)
 
-            if token and validate_token(token):
-                username = validate_token(token)
-            elif auth_header:
-                username = validate_credentials(auth_header)
-                if username:
-                    token = generate_token(username)
-                else:
-                    return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
-            else:
+            client_ip = client_address(request)
+            # Checked before authenticating, so that a flood costs no token or credential checks
+            limited = rate_limit(ip_limits, client_ip, size, 'ip')
+            if limited:
+                return limited
+            username, token = await authenticate(request)
+            if not username:
                 return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
-            
-            payload = request.payload.decode('utf-8')
-            client_ip = request.remote.sockaddr[0]
-            client_ip = client_ip.split(":")[-1] if "::" in client_ip else client_ip
+            limited = rate_limit(user_limits, username, size, 'user')
+            if limited:
+                return limited
+            refused = await self.schedule((username, client_ip), size)
+            if refused:
+                return refused
+
             client_mac = get_mac(client_ip)
+            received = datetime.now()
+            head = f"Reception date: {received.isoformat()}\nClient IP: {client_ip}\nClient MAC: {client_mac}\nPayload:\n"
+            meta = {'ts': received.timestamp(), 'ip': client_ip, 'mac': client_mac, 'user': username}
+
+            if block1 is not None:
+                return self.start_transfer(request, block1, head, meta, token)
 
+            INGESTED_BYTES.inc((client_ip,), size)
+            if self.sink.full():
+                print(f"Log sink queue full, rejecting POST from {client_ip}")
+                return self.busy()
+            started = time.perf_counter()
+            try:
+                data, events = PayloadPipeline(request).feed(request.payload, True)
+                STAGE_SECONDS.observe(time.perf_counter() - started, ('decode',))
+            except OutputLimitExceeded:
+                return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, size1=settings.block_max_body_size)
+            except (DecompressionError, ReportFormatError) as e:
+                print(f"Error decoding POST request from {client_ip}: {e}")
+                return Message(code=Code.BAD_REQUEST, payload=b"Invalid payload")
+            if len(data) > settings.block_max_body_size:
+                return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, size1=settings.block_max_body_size)
+            payload = data.decode('utf-8', errors='replace')
             print(f"Received POST request: {payload}")
-            log_entry = f"Reception date: {datetime.now().isoformat()}\nClient IP: {client_ip}\nClient MAC: {client_mac}\nPayload:\n{payload}\n"
+            log_entry = f"{head}{payload}\n"
 
-            with open('coap_logging.txt', 'a') as logfile:
-                logfile.write(log_entry)
-                logfile.write("\n---\n")
+            log_entry += "\n---\n"
+            if not self.sink.submit(log_entry, meta):
+                print(f"Log sink queue full, rejecting POST from {client_ip}")
+                return self.busy()
+            self.live_tail.publish(meta, log_entry.encode('utf-8'))
+            if self.series is not None:
+                extractor = self.series.extractor(client_ip, meta['ts'])
+                extractor.feed(data, events)
+                extractor.finish()
 
             response_payload = f"Token={token}".encode('utf-8')
             return Message(code=Code.CREATED, payload=response_payload)
+        except CredentialsBusy:
+            return credentials_busy()
         except Exception as e:
             print(f"Error processing POST request: {e}")
             return Message(code=Code.INTERNAL_SERVER_ERROR)
 
-async def main():
-    # Start the CoAP server
+    async def schedule(self, client, size):
+        # Wait for the client's turn while the sink is congested; returns a refusal or None
+        if self.fair_queue.over_share(client):
+            return too_many_requests(settings.sink_retry_after, 'share')
+        started = time.perf_counter()
+        admitted = await self.fair_queue.admit(client, size)
+        STAGE_SECONDS.observe(time.perf_counter() - started, ('fair_queue',))
+        return None if admitted else self.busy()
+
+    def busy(self):
+        # 5.03 response telling the client when to retry
+        return Message(code=Code.SERVICE_UNAVAILABLE, payload=b"Server busy",
+                       max_age=settings.sink_retry_after)
+
+    def start_transfer(self, request, block1, head, meta, token):
+        # Begin a Block1 transfer, replacing an unfinished one from the same client
+        key = (request.remote, tuple(request.opt.uri_query))
+        previous = self.assemblies.pop(key, None)
+        if previous is not None:
+            self.drop_transfer(previous)
+        try:
+            pipeline = PayloadPipeline(request)
+        except (DecompressionError, ReportFormatError) as e:
+            print(f"Error starting blockwise transfer: {e}")
+            return Message(code=Code.BAD_REQUEST, payload=str(e).encode('utf-8'))
+        extractor = self.series.extractor(meta['ip'], meta['ts']) if self.series is not None else None
+        assembly = BlockAssembly(self.sink.open_stream(meta), head, token, pipeline, extractor)
+        self.assemblies[key] = assembly
+        return self.receive_block(key, assembly, request, block1)
+
+    def receive_block(self, key, assembly, request, block1):
+        # Append one block to the transfer and acknowledge it
+        if block1.block_number == assembly.next_block - 1 and block1.more:
+            # Repeated block whose acknowledgement was lost
+            return Message(code=Code.CONTINUE, block1=block1)
+        if block1.block_number != assembly.next_block:
+            return Message(code=Code.REQUEST_ENTITY_INCOMPLETE)
+        # Checked before decoding so that a retried block finds the decoder unchanged
+        if self.sink.full():
+            return self.busy()
+
+        INGESTED_BYTES.inc((assembly.stream.meta['ip'],), len(request.payload))
+        started = time.perf_counter()
+        try:
+            data, events = assembly.pipeline.feed(request.payload, not block1.more)
+            STAGE_SECONDS.observe(time.perf_counter() - started, ('decode',))
+        except OutputLimitExceeded:
+            self.assemblies.pop(key, None)
+            self.drop_transfer(assembly)
+            return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, size1=settings.block_max_body_size)
+        except (DecompressionError, ReportFormatError) as e:
+            self.assemblies.pop(key, None)
+            self.drop_transfer(assembly)
+            print(f"Error decoding blockwise transfer: {e}")
+            return Message(code=Code.BAD_REQUEST, payload=b"Invalid payload")
+        if assembly.stream.size + len(data) > settings.block_max_body_size:
+            self.assemblies.pop(key, None)
+            self.drop_transfer(assembly)
+            return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, size1=settings.block_max_body_size)
+
+        if block1.more:
+            if not assembly.stream.append(data):
+                return self.busy()
+            assembly.add_preview(data)
+            assembly.extract(data, events, False)
+            assembly.next_block += 1
+            if assembly.timer is not None:
+                assembly.timer.cancel()
+            assembly.timer = asyncio.get_running_loop().call_later(
+                settings.block_timeout, self.expire_transfer, key, assembly)
+            return Message(code=Code.CONTINUE, block1=block1)
+
+        if not assembly.stream.finish(assembly.head, "\n\n---\n", data):
+            return self.busy()
+        assembly.add_preview(data)
+        assembly.extract(data, events, True)
+        head = assembly.head.encode('utf-8')
+        self.live_tail.publish(assembly.stream.meta, head + assembly.preview,
+                               len(head) + assembly.stream.size)
+        self.assemblies.pop(key, None)
+        if assembly.timer is not None:
+            assembly.timer.cancel()
+        print(f"Received blockwise POST request: {assembly.stream.size} bytes")
+        response_payload = f"Token={assembly.token}".encode('utf-8')
+        return Message(code=Code.CREATED, payload=response_payload,
+                       block1=BlockOption.BlockwiseTuple(block1.block_number, False, block1.size_exponent))
+
+    def drop_transfer(self, assembly):
+        # Discard the data of an unfinished transfer
+        if assembly.timer is not None:
+            assembly.timer.cancel()
+        assembly.stream.abort()
+
+    def expire_transfer(self, key, assembly):
+        # Called when a transfer received no block for settings.block_timeout seconds
+        if self.assemblies.get(key) is assembly:
+            del self.assemblies[key]
+            self.drop_transfer(assembly)
+            print(f"Dropped incomplete blockwise transfer after {assembly.stream.size} bytes")
+
+def parse_time(value):
+    # ISO 8601 local time or seconds since the epoch
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def query_params(request):
+    # Query options as a dict
+    return dict(option.split("=", 1) for option in request.opt.uri_query if "=" in option)
+
+async def authorize_reader(request):
+    # Return the username if the request may read stored reports and metrics
+    username, _ = await authenticate(request)
+    if username and settings.query_readers and username not in settings.query_readers:
+        return None
+    return username
+
+class LogsResource(Resource):
+    # Resource serving stored reports (GET) and a live tail of new ones (Observe)
+    #
+    # Query options: Token= or Authorization=, client= (IP or MAC), user=,
+    # since= and until= (ISO 8601 or epoch seconds), after= (page cursor)
+    def __init__(self, reader, live_tail):
+        super().__init__()
+        self.reader = reader  # None when the record store is not used
+        self.live_tail = live_tail
+        self.observers = {}  # (remote, token) -> (TailObserver, initial response sent)
+
+    async def authorize(self, request):
+        return await authorize_reader(request)
+
+    async def add_observation(self, request, serverobservation):
+        # Register a live tail; called by aiocoap before render_get
+        try:
+            if not await self.authorize(request):
+                return
+        except CredentialsBusy:
+            return  # render_get answers
+        params = query_params(request)
+        observer = self.live_tail.subscribe(params.get('client'), params.get('user'),
+                                            serverobservation.trigger)
+        if observer is None:
+            print("Observer limit reached, serving /logs without Observe")
+            return
+        key = (request.remote, request.token)
+        self.observers[key] = [observer, False]
+
+        def cancel():
+            self.observers.pop(key, None)
+            self.live_tail.unsubscribe(observer)
+        serverobservation.accept(cancel)
+
+    async def render_get(self, request):
+        try:
+            observation = self.observers.get((request.remote, request.token))
+            if observation is not None and observation[1]:
+                # Notification: send the reports buffered for this observer
+                return Message(code=Code.CONTENT, payload=observation[0].take(),
+                               content_format=CONTENT_FORMAT_TEXT)
+
+            if not await self.authorize(request):
+                return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
+            params = query_params(request)
+            try:
+                since = parse_time(params['since']) if 'since' in params else None
+                until = parse_time(params['until']) if 'until' in params else None
+                after = parse_cursor(params['after']) if 'after' in params else None
+            except ValueError:
+                return Message(code=Code.BAD_REQUEST, payload=b"Invalid since, until or after")
+
+            if observation is not None:
+                observation[1] = True
+                if since is None:
+                    # A live tail without since= starts with the next report
+                    return Message(code=Code.CONTENT, payload=b"", content_format=CONTENT_FORMAT_TEXT)
+            if self.reader is None:
+                return Message(code=Code.NOT_IMPLEMENTED, payload=b"Queries require the record store backend")
+
+            # Index and segment reads are blocking file I/O
+            payload, cursor = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.reader.page, since, until, params.get('client'), params.get('user'),
+                                        after, settings.query_page_records, settings.query_page_bytes))
+            response = Message(code=Code.CONTENT, payload=payload, content_format=CONTENT_FORMAT_TEXT)
+            if cursor is not None:
+                response.opt.add_option(OptionNumber(NEXT_CURSOR_OPTION).create_option(
+                    value=format_cursor(cursor).encode('utf-8')))
+            return response
+        except CredentialsBusy:
+            return credentials_busy()
+        except Exception as e:
+            print(f"Error processing GET request: {e}")
+            return Message(code=Code.INTERNAL_SERVER_ERROR)
+
+class SeriesResource(Resource):
+    # Resource serving the time series extracted from received reports, as JSON
+    #
+    # Query options: Token= or Authorization=, metric= (without it, the
+    # metrics and their number of clients are listed), client= (IP), since=
+    # and until= (ISO 8601 or epoch seconds, default: the last day),
+    # resolution= (1m, 1h or 1d), summary=1 (one min/avg/max/count per client)
+    def __init__(self, series):
+        super().__init__()
+        self.series = series  # None when time series are disabled
+
+    async def render_get(self, request):
+        try:
+            if not await authorize_reader(request):
+                return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
+            if self.series is None:
+                return Message(code=Code.NOT_IMPLEMENTED, payload=b"Time series are disabled")
+            params = query_params(request)
+            try:
+                since = parse_time(params['since']) if 'since' in params else None
+                until = parse_time(params['until']) if 'until' in params else None
+            except ValueError:
+                return Message(code=Code.BAD_REQUEST, payload=b"Invalid since or until")
+            resolution = params.get('resolution')
+            if resolution is not None and resolution not in RESOLUTIONS:
+                return Message(code=Code.BAD_REQUEST, payload=b"Invalid resolution")
+
+            # Runs on the time series thread, after the reports received so far
+            result = await self.series.run(self.series.query, params.get('metric'), params.get('client'),
+                                           since, until, resolution, params.get('summary') == '1')
+            return Message(code=Code.CONTENT, payload=json.dumps(result, separators=(',', ':')).encode('utf-8'),
+                           content_format=CONTENT_FORMAT_JSON)
+        except CredentialsBusy:
+            return credentials_busy()
+        except Exception as e:
+            print(f"Error processing GET request: {e}")
+            return Message(code=Code.INTERNAL_SERVER_ERROR)
+
+class MetricsResource(Resource):
+    # Resource serving the metrics of this process in the Prometheus text format
+    #
+    # Query options: Token= or Authorization= of a user allowed to read reports
+    async def render_get(self, request):
+        try:
+            if not await authorize_reader(request):
+                return Message(code=Code.UNAUTHORIZED, payload=b"Unauthorized")
+            return Message(code=Code.CONTENT, payload=metrics.expose(), content_format=CONTENT_FORMAT_TEXT)
+        except CredentialsBusy:
+            return credentials_busy()
+        except Exception as e:
+            print(f"Error processing metrics request: {e}")
+            return Message(code=Code.INTERNAL_SERVER_ERROR)
+
+def register_gauges(sink, post, live_tail, series):
+    # Metrics read from the server's components when exposed
+    metrics.gauge('coap_sink_queue_depth', "Entries waiting to be written by the log sink",
+                  callback=lambda: sink.depth)
+    metrics.register(CallbackCounter(
+        'coap_sink_dropped_total', "Acknowledged entries the log sink failed to write",
+        callback=lambda: sink.dropped))
+    metrics.gauge('coap_blockwise_transfers', "Incomplete Block1 transfers", callback=lambda: len(post.assemblies))
+    metrics.gauge('coap_live_tail_observers', "Live tail observers", callback=lambda: len(live_tail.observers))
+    metrics.gauge('coap_tokens', "Token store counters (live tokens, evictions, keys, revocations)", ('stat',),
+                  callback=lambda: {(name,): value for name, value in tokens.stats().items()})
+    metrics.gauge('coap_fair_queue_waiting', "Requests waiting for their turn at the congested log sink",
+                  callback=lambda: post.fair_queue.waiting)
+    metrics.register(CallbackCounter(
+        'coap_fair_queue_timeouts_total', "Requests refused with 5.03 after waiting FAIR_MAX_WAIT seconds",
+        callback=lambda: post.fair_queue.timeouts))
+    metrics.gauge('coap_rate_limit_buckets', "Clients with a token bucket, by scope", ('scope',),
+                  callback=lambda: {('user',): len(user_limits.buckets), ('ip',): len(ip_limits.buckets)})
+    metrics.register(CallbackCounter(
+        'coap_credential_cache_lookups_total', "Credential verification cache lookups", ('result',),
+        callback=lambda: {('hit',): credentials.cache_hits, ('miss',): credentials.cache_misses}))
+    metrics.gauge('coap_credential_verifications_pending', "Password verifications waiting for or running on the hash pool",
+                  callback=lambda: credentials.pending)
+    metrics.register(CallbackCounter(
+        'coap_credential_busy_total', "Requests refused with 5.03 because MAX_PENDING verifications were pending",
+        callback=lambda: credentials.busy))
+    if series is not None:
+        metrics.gauge('coap_timeseries_series', "Time series extracted from reports", callback=lambda: series.count)
+        metrics.gauge('coap_timeseries_pending', "Report pieces waiting to be parsed into time series",
+                      callback=lambda: series.pending)
+        metrics.register(CallbackCounter(
+            'coap_timeseries_skipped_total', "Reports left out of the time series by reason",
+            ('reason',), callback=lambda: {('behind',): series.skipped, ('limit',): series.dropped}))
+
+def reload_config(site, post, live_tail, series, sink):
+    # Apply a changed configuration and credentials file (SIGHUP); issued tokens, transfers, queued
+    # reports and rate limit buckets are kept. Nothing changes if a file cannot be read.
+    global settings
+    try:
+        loaded = read_settings(CONFIG_FILE)
+        loaded_credentials = credentials.read(loaded.credentials_file)
+        loaded_keys = None
+        if isinstance(tokens, SignedTokens):
+            loaded_keys = tokens.read(loaded.token_key_file, loaded.token_revocation_file or None)
+    except Exception as e:
+        print(f"Configuration not reloaded: {e}")
+        return
+    kept = {}
+    for name in RESTART_SETTINGS:
+        if getattr(loaded, name) != getattr(settings, name):
+            print(f"Configuration: {name} only changes on restart")
+            kept[name] = getattr(settings, name)
+    old_path = (settings.uri_path_part1, settings.uri_path_part2)
+    settings = replace(loaded, **kept)
+
+    # Move the data resource; clients still posting to the old path get 4.04 from then on
+    new_path = (settings.uri_path_part1, settings.uri_path_part2)
+    if new_path != old_path:
+        site.move_resource(old_path, new_path, post)
+    credentials.cache_size = settings.credentials_cache_size
+    credentials.cache_ttl = settings.credentials_cache_ttl
+    credentials.reload_check_interval = settings.credentials_reload_interval
+    credentials.max_pending = settings.credentials_max_pending
+    credentials.reload(loaded_credentials)
+    tokens.expiry_seconds = settings.token_expiry_seconds
+    if loaded_keys is not None:
+        tokens.reload(loaded_keys)
+    else:
+        tokens.max_per_user = settings.token_max_per_user
+    user_limits.configure(settings.limits_user_requests_per_second, settings.limits_user_request_burst,
+                          settings.limits_user_bytes_per_second, settings.limits_user_byte_burst,
+                          settings.limits_max_clients)
+    ip_limits.configure(settings.limits_ip_requests_per_second, settings.limits_ip_request_burst,
+                        settings.limits_ip_bytes_per_second, settings.limits_ip_byte_burst,
+                        settings.limits_max_clients)
+    post.configure()
+    sink.flush_interval = settings.sink_flush_interval
+    sink.fsync_policy = settings.sink_fsync
+    live_tail.notify_interval = settings.query_notify_interval
+    live_tail.max_notify_bytes = settings.query_notify_max_bytes
+    live_tail.buffer_bytes = settings.query_observer_buffer
+    live_tail.max_observers = settings.query_max_observers
+    neighbor_table.ttl = settings.mac_ttl
+    neighbor_table.negative_ttl = settings.mac_negative_ttl
+    if series is not None:
+        series.max_series = settings.timeseries_max_series
+        series.max_series_per_client = settings.timeseries_max_series_per_client
+        series.json_fields = settings.timeseries_json_fields
+        series.json_label = settings.timeseries_json_label
+        series.max_pending = settings.timeseries_max_pending
+    print(f"Reloaded configuration from {CONFIG_FILE} and credentials from {settings.credentials_file}")
+
+async def main(worker=None, group=None):
+    # Start the CoAP server; worker is the index of this process in a WorkerGroup
+    if settings.sink_backend == 'store':
+        # Each worker writes its own partition of the store
+        directory = settings.store_directory
+        if worker is not None:
+            directory = partition_directory(directory, worker)
+        backend = RecordStore(directory, segment_bytes=settings.store_segment_bytes,
+                              segment_seconds=settings.store_segment_seconds,
+                              compress_sealed=settings.store_compress_sealed,
+                              retention_seconds=settings.store_retention_days * 86400,
+                              max_bytes=settings.store_max_bytes // (group.count if group else 1))
+    elif worker is None:
+        backend = TextFileBackend(settings.sink_log_file)
+    else:
+        base, ext = os.path.splitext(settings.sink_log_file)
+        backend = TextFileBackend(f"{base}.worker-{worker}{ext}")
+    sink = LogSink(backend, queue_size=settings.sink_queue_size,
+                   flush_interval=settings.sink_flush_interval, fsync_policy=settings.sink_fsync,
+                   on_write=lambda seconds: STAGE_SECONDS.observe(seconds, ('sink_write',)))
+    sink.start()
+    live_tail = LiveTail(notify_interval=settings.query_notify_interval,
+                         max_notify_bytes=settings.query_notify_max_bytes,
+                         buffer_bytes=settings.query_observer_buffer, max_observers=settings.query_max_observers)
+    hub = live_tail
+    if group is not None:
+        # Share received reports with live tail observers on the other workers
+        live_tail = group.relay(worker, live_tail)
+        live_tail.start()
+    restored = tokens.load()
+    if restored:
+        print(f"Restored {restored} tokens from {settings.token_persist_file}")
+    tokens.start(settings.token_sweep_interval)
+    series = None
+    if settings.timeseries_enabled:
+        # Each worker keeps the series of the reports it received
+        directory = settings.timeseries_directory
+        if directory and worker is not None:
+            directory = partition_directory(directory, worker)
+        series = TimeSeriesStore(directory, (settings.timeseries_minute_slots, settings.timeseries_hour_slots,
+                                             settings.timeseries_day_slots),
+                                 max_series=settings.timeseries_max_series,
+                                 max_series_per_client=settings.timeseries_max_series_per_client,
+                                 json_fields=settings.timeseries_json_fields, json_label=settings.timeseries_json_label,
+                                 max_pending=settings.timeseries_max_pending)
+        restored = series.start(settings.timeseries_persist_interval)
+        if restored:
+            print(f"Restored {restored} time series from {directory}")
+
     root = Site()
     root.add_resource(('auth',), AuthResource())
-    root.add_resource((URI_PATH_PART1, URI_PATH_PART2), PostResource())
+    post = PostResource(sink, live_tail, series)
+    root.add_resource((settings.uri_path_part1, settings.uri_path_part2), post)
+    reader = StoreReader(settings.store_directory) if settings.sink_backend == 'store' else None
+    root.add_resource(('logs',), LogsResource(reader, live_tail))
+    root.add_resource(('metrics',), MetricsResource())
+    root.add_resource(('series',), SeriesResource(series))
+    register_gauges(sink, post, hub, series)
+    site = instrumented = InstrumentedSite(root, {('auth',): 'auth',
+                                                  (settings.uri_path_part1, settings.uri_path_part2): 'data',
+                                                  ('logs',): 'logs', ('metrics',): 'metrics', ('series',): 'series'},
+                                           REQUESTS, REQUEST_SECONDS)
+    if settings.oscore_contexts:
+        contexts = oscore_site.load_contexts(settings.oscore_contexts)
+        site = OscoreSite(site, contexts, require=settings.oscore_require)
+        print(f"Loaded {len(contexts)} OSCORE contexts from {settings.oscore_contexts}")
+
+    lag_monitor = LoopLagMonitor(LOOP_LAG, LOOP_LAG_LAST, settings.metrics_loop_lag_interval)
+    lag_monitor.start()
+    profiler = SamplingProfiler(settings.metrics_profile_file.format(pid=os.getpid()),
+                                settings.metrics_profile_interval)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, profiler.toggle)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config, instrumented, post, hub,
+                                                series, sink)
+    http_server = None
+    if settings.metrics_http_port:
+        # Each worker serves its own metrics on the next port
+        http_server = MetricsHTTPServer(metrics, settings.metrics_http_address,
+                                        settings.metrics_http_port + (worker or 0))
 
     try:
-        context = await Context.create_server_context(root, bind=(SERVER_IP, SERVER_PORT))
-        print(f"CoAP server started at {SERVER_IP}:{SERVER_PORT}")
+        if http_server is not None:
+            await http_server.start()
+            print(f"Metrics served at http://{settings.metrics_http_address}:{http_server.port}/metrics")
+        context = await Context.create_server_context(site, bind=(settings.server_ip, settings.server_port))
+        if worker is None:
+            print(f"CoAP server started at {settings.server_ip}:{settings.server_port}")
+        else:
+            print(f"CoAP server worker {worker} (pid {os.getpid()}) started at "
+                  f"{settings.server_ip}:{settings.server_port}")
         await asyncio.Future()
     except OSError as e:
         print(f"Error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        lag_monitor.close()
+        if profiler.running:
+            profiler.stop()
+        if http_server is not None:
+            await http_server.close()
+        await tokens.close()
+        await sink.close()
+        if series is not None:
+            await series.close()
+        credentials.close()
+
+def run_worker(group, worker):
+    asyncio.run(main(worker, group))
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="CoAP server for IoT data logging")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of server processes sharing the port (default: 1)")
+    args = parser.parse_args()
+
+    if settings.oscore_contexts and not oscore_site.available():
+        raise SystemExit("OSCORE needs the cryptography, hkdf, cbor and filelock packages")
+    if args.workers > 1:
+        if settings.oscore_contexts:
+            # Sequence numbers and replay windows cannot be shared between processes
+            raise SystemExit("OSCORE cannot be combined with --workers")
+        # Tokens issued by one worker must be valid in all of them
+        if settings.token_format != 'signed':
+            print("Random tokens cannot be shared between workers, using signed tokens")
+            tokens = signed_tokens()
+        os.environ['AIOCOAP_REUSE_PORT'] = '1'
+        group = WorkerGroup(args.workers)
+        print(f"Starting {args.workers} workers")
+        group.run(functools.partial(run_worker, group))
+    else:
+        asyncio.run(main())
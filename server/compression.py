@@ -0,0 +1,126 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, deflate is always available
+    zstandard = None
+
+# Payload Decompression
+#
+# Transparent decompression of agent payloads.
+#
+# CoAP has no standard content-coding option, so the agent and the server use
+# two options from the experimental range (the numbers must match the agent):
+# - Content-Encoding (65001, critical): coding of the request payload
+# - Accept-Encoding (65000, elective): codings this server supports, sent in
+#   /auth responses so agents only compress when the server can decode it.
+#
+# Codings: 1 = deflate (zlib), 2 = zstd (requires the zstandard package).
+# Decoders work incrementally so blockwise transfers are decompressed block by
+# block, and output is produced in bounded pieces. With max_output_size the
+# decoder stops as soon as its total output exceeds it (zstd output is streamed
+# into a sink that counts it), so a small compressed body cannot expand into
+# an unbounded amount of memory.
+
+CONTENT_ENCODING_OPTION = 65001
+ACCEPT_ENCODING_OPTION = 65000
+
+IDENTITY = 0
+DEFLATE = 1
+ZSTD = 2
+
+# zlib only uses the last 32 KiB of a preset dictionary
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+# Maximum size of one piece of decompressed output
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+
+class DecompressionError(Exception):
+    pass
+
+
+class OutputLimitExceeded(DecompressionError):
+    pass
+
+
+class _OutputSink:
+    # Collects the output of a zstd stream writer, refusing it beyond the limit
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.pieces = []
+
+    def write(self, data):
+        self.decoder.count(len(data))
+        self.pieces.append(data)
+        return len(data)
+
+
+def supported_codecs():
+    # Codings this server can decode
+    codecs = [DEFLATE]
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    return codecs
+
+
+def request_encoding(request):
+    # Coding of the request payload from the Content-Encoding option
+    options = request.opt.get_option(CONTENT_ENCODING_OPTION)
+    if not options or not options[0].value:
+        return IDENTITY
+    return options[0].value[0]
+
+
+class Decoder:
+    # Incremental decoder for one payload
+    def __init__(self, codec, dictionary=None, max_output_size=None):
+        self.codec = codec
+        self.max_output_size = max_output_size
+        self.output_size = 0
+        if codec == DEFLATE:
+            if dictionary:
+                self._obj = zlib.decompressobj(zdict=dictionary[-ZLIB_DICTIONARY_SIZE:])
+            else:
+                self._obj = zlib.decompressobj()
+        elif codec == ZSTD and zstandard is not None:
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._sink = _OutputSink(self)
+            self._obj = zstandard.ZstdDecompressor(dict_data=dict_data).stream_writer(
+                self._sink, write_size=OUTPUT_CHUNK_SIZE)
+        else:
+            raise DecompressionError(f"Unsupported content encoding: {codec}")
+
+    def count(self, size):
+        # Account for size bytes of output
+        self.output_size += size
+        if self.max_output_size is not None and self.output_size > self.max_output_size:
+            raise OutputLimitExceeded(f"Decompressed payload exceeds {self.max_output_size} bytes")
+
+    def decode(self, data):
+        # Yield the decompressed output for the next piece of input
+        try:
+            if self.codec == DEFLATE:
+                out = self._obj.decompress(data, OUTPUT_CHUNK_SIZE)
+                if out:
+                    self.count(len(out))
+                    yield out
+                while self._obj.unconsumed_tail:
+                    out = self._obj.decompress(self._obj.unconsumed_tail, OUTPUT_CHUNK_SIZE)
+                    if out:
+                        self.count(len(out))
+                        yield out
+            else:
+                self._obj.write(data)
+                pieces, self._sink.pieces = self._sink.pieces, []
+                yield from pieces
+        except DecompressionError:
+            raise
+        except Exception as e:
+            raise DecompressionError(f"Invalid compressed payload: {e}")
+
+    def finish(self):
+        # Check that the compressed stream was complete
+        if self.codec == DEFLATE and not self._obj.eof:
+            raise DecompressionError("Truncated compressed payload")
+
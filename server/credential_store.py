@@ -0,0 +1,201 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Credential Store
+#
+# Verifies the Basic credentials sent by agents against credentials.txt.
+#
+# - Passwords are hashed with a slow KDF (scrypt or PBKDF2-SHA256). Legacy
+#   unsalted SHA-256 entries are still accepted so existing files keep working.
+# - The KDF runs on a thread pool so that hashing never blocks the event loop.
+#   At most max_pending verifications wait for it; beyond that verify() raises
+#   CredentialsBusy, which the server answers with 5.03 instead of queueing
+#   unbounded work during a flood of bad passwords.
+# - Unknown usernames are checked against a dummy hash, so they take as long
+#   as a wrong password and do not reveal which usernames exist.
+# - Successful verifications are remembered in a short-lived, bounded LRU
+#   keyed by (username, digest of the Authorization header), so an agent that
+#   keeps sending the same header does not pay for the KDF on every request.
+#   Failed verifications are remembered in a separate LRU of the same size,
+#   so repeated bad headers cost no KDF either and cannot evict good entries.
+# - credentials.txt is reloaded when its mtime changes; a reload clears the
+#   verification cache so removed users and changed passwords apply at once.
+#
+# Supported hash formats in credentials.txt (username:hash):
+#   scrypt$<n>$<r>$<p>$<salt b64>$<hash b64>
+#   pbkdf2_sha256$<iterations>$<salt b64>$<hash b64>
+#   <64 hex characters>  (legacy SHA-256)
+#
+# New hashes can be generated with:
+#   python3 credential_store.py [scrypt|pbkdf2]
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+
+# Checked for unknown users: same cost as a real scrypt entry, never matches
+DUMMY_HASH = (f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${base64.b64encode(os.urandom(SALT_BYTES)).decode('ascii')}"
+              f"${base64.b64encode(os.urandom(64)).decode('ascii')}")
+
+
+# Contents of a credentials file, read by CredentialStore.read() for reload()
+LoadedCredentials = namedtuple('LoadedCredentials', ['path', 'credentials', 'mtime'])
+
+
+class CredentialsBusy(Exception):
+    # Raised by CredentialStore.verify() while max_pending verifications are waiting
+    pass
+
+
+# Hash password
+def hash_password(password, scheme='scrypt'):
+    # Produce a credentials.txt hash string for the password
+    salt = os.urandom(SALT_BYTES)
+    b64 = lambda raw: base64.b64encode(raw).decode('ascii')
+    if scheme == 'scrypt':
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=salt,
+                                n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${b64(salt)}${b64(digest)}"
+    if scheme == 'pbkdf2':
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${b64(salt)}${b64(digest)}"
+    raise ValueError(f"Unknown hash scheme: {scheme}")
+
+
+# Verify password
+def verify_password(password, stored):
+    # Check a password against a stored hash string (runs on the hash pool)
+    password = password.encode('utf-8')
+    parts = stored.split('$')
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        expected = base64.b64decode(parts[5])
+        digest = hashlib.scrypt(password, salt=base64.b64decode(parts[4]), n=n, r=r, p=p,
+                                maxmem=128 * n * r * p + 1024 * 1024, dklen=len(expected))
+    elif parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        expected = base64.b64decode(parts[3])
+        digest = hashlib.pbkdf2_hmac('sha256', password, base64.b64decode(parts[2]),
+                                     int(parts[1]), dklen=len(expected))
+    elif len(parts) == 1:
+        expected = stored.lower().encode('ascii')
+        digest = hashlib.sha256(password).hexdigest().encode('ascii')
+    else:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+class CredentialStore:
+    # Hot-reloaded credentials with offloaded hashing and a verification cache
+    def __init__(self, path, cache_size=1024, cache_ttl=300.0, hash_workers=2,
+                 reload_check_interval=2.0, max_pending=32):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.reload_check_interval = reload_check_interval
+        self.max_pending = max_pending
+        self._credentials = {}
+        self._mtime = None
+        self._last_check = 0.0
+        self._cache = OrderedDict()  # Successful verifications
+        self._failures = OrderedDict()  # Failed verifications
+        self._executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix='kdf')
+        self.pending = 0  # Verifications waiting for or running on the hash pool
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.busy = 0
+        self.reload()
+
+    def read(self, path):
+        # Parse a credentials file into LoadedCredentials for reload()
+        credentials = {}
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):  # Ignore empty lines and comments
+                    parts = line.split(':')
+                    if len(parts) == 2:
+                        username, hashed_password = parts
+                        credentials[username] = hashed_password
+                    else:
+                        print(f"Warning: Ignoring invalid credential line: {line}")
+        return LoadedCredentials(path, credentials, mtime)
+
+    def reload(self, loaded=None):
+        # Replace the credentials with the file's contents, or with the LoadedCredentials read() returned
+        loaded = loaded or self.read(self.path)
+        self.path = loaded.path
+        self._credentials = loaded.credentials
+        self._mtime = loaded.mtime
+        self._cache.clear()
+        self._failures.clear()
+
+    def maybe_reload(self):
+        # Reload the file if its mtime changed (checked at most once per interval)
+        now = time.monotonic()
+        if now - self._last_check < self.reload_check_interval:
+            return
+        self._last_check = now
+        try:
+            if os.stat(self.path).st_mtime_ns != self._mtime:
+                self.reload()
+                print(f"Reloaded credentials from {self.path}")
+        except Exception as e:
+            print(f"Error reloading credentials: {e}")
+
+    async def verify(self, auth_header):
+        # Return the username for a valid "Basic <base64>" header, else None
+        self.maybe_reload()
+        encoded_credentials = auth_header.split(" ")[1]
+        decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
+        username, password = decoded_credentials.split(":", 1)
+        stored = self._credentials.get(username)
+
+        key = (username, hashlib.sha256(auth_header.encode('utf-8')).digest())
+        now = time.monotonic()
+        for cache, result in ((self._cache, username), (self._failures, None)):
+            expires = cache.get(key)
+            if expires is not None:
+                if now < expires:
+                    cache.move_to_end(key)
+                    self.cache_hits += 1
+                    return result
+                del cache[key]
+        self.cache_misses += 1
+
+        if self.pending >= self.max_pending:
+            self.busy += 1
+            raise CredentialsBusy(f"{self.pending} password verifications pending")
+        self.pending += 1
+        try:
+            valid = await asyncio.get_running_loop().run_in_executor(
+                self._executor, verify_password, password, DUMMY_HASH if stored is None else stored)
+        finally:
+            self.pending -= 1
+        # Discard the result if the password was changed while hashing
+        if self._credentials.get(username) != stored:
+            return None
+
+        cache = self._cache if valid else self._failures
+        cache[key] = now + self.cache_ttl
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return username if valid else None
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    import getpass
+    scheme = sys.argv[1] if len(sys.argv) > 1 else 'scrypt'
+    print(hash_password(getpass.getpass('Password: '), scheme))
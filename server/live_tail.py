@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+
+# Live Tail
+#
+# Fan-out of newly received reports to CoAP observers of the /logs resource.
+#
+# Ingestion only appends each accepted report to the pending buffer of every
+# matching observer, which is cheap and never waits for the network. Each
+# observer is notified by its own timer, at most once per NOTIFY_INTERVAL, and
+# a notification carries as many buffered reports as fit into NOTIFY_MAX_BYTES
+# (a notification must fit into a single CoAP message). A slow observer only
+# grows its own bounded buffer: when it exceeds BUFFER_BYTES the oldest reports
+# are dropped and the next notification says how many were lost, so one slow
+# observer can neither slow down ingestion nor delay the other observers.
+#
+# Reports longer than NOTIFY_MAX_BYTES are truncated in notifications; the
+# complete report can be paged from the record store with a regular GET.
+
+
+class TailObserver:
+    # Pending reports and notification timing of one observer
+    def __init__(self, hub, client, user, notify):
+        self.hub = hub
+        self.client = client
+        self.user = user
+        self.notify = notify  # Called to send a notification, which then calls take()
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.last_sent = 0.0
+        self.timer = None
+
+    def matches(self, meta):
+        if self.client is not None and self.client not in (meta.get('ip'), meta.get('mac')):
+            return False
+        return self.user is None or meta.get('user') == self.user
+
+    def take(self):
+        # Return the payload of the next notification and reschedule if reports remain
+        max_bytes = self.hub.max_notify_bytes
+        pieces = []
+        size = 0
+        if self.dropped:
+            notice = f"[{self.dropped} reports dropped]\n".encode('utf-8')
+            pieces.append(notice)
+            size += len(notice)
+            self.dropped = 0
+        first = True
+        while self.pending:
+            stored, total = self.pending[0]
+            # The first report is always sent, cut to the space left
+            room = max_bytes - size if first else max_bytes
+            data = stored
+            if len(stored) < total or len(stored) > room:
+                marker = f"\n[... truncated, {total} bytes]\n".encode('utf-8')
+                data = stored[:max(0, room - len(marker))] + marker
+            if not first and size + len(data) > max_bytes:
+                break
+            self.pending.popleft()
+            self.pending_bytes -= len(stored)
+            pieces.append(data)
+            size += len(data)
+            first = False
+        if self.pending:
+            self.hub._schedule(self)
+        return b''.join(pieces)
+
+
+class LiveTail:
+    # Registry of observers with per-observer batching and rate limits
+    def __init__(self, notify_interval=1.0, max_notify_bytes=1024,
+                 buffer_bytes=64 * 1024, max_observers=16):
+        self.notify_interval = notify_interval
+        self.max_notify_bytes = max_notify_bytes
+        self.buffer_bytes = buffer_bytes
+        self.max_observers = max_observers
+        self.observers = set()
+
+    def subscribe(self, client, user, notify):
+        # Register an observer; None when the observer limit is reached
+        if len(self.observers) >= self.max_observers:
+            return None
+        observer = TailObserver(self, client, user, notify)
+        self.observers.add(observer)
+        return observer
+
+    def unsubscribe(self, observer):
+        self.observers.discard(observer)
+        if observer.timer is not None:
+            observer.timer.cancel()
+            observer.timer = None
+
+    def publish(self, meta, data, total=None):
+        # Queue a received report for the matching observers; data may be the
+        # beginning of a longer report of total bytes
+        if not self.observers:
+            return
+        total = len(data) if total is None else total
+        data = bytes(data[:self.max_notify_bytes])
+        for observer in self.observers:
+            if not observer.matches(meta):
+                continue
+            observer.pending.append((data, total))
+            observer.pending_bytes += len(data)
+            while observer.pending_bytes > self.buffer_bytes:
+                dropped, _ = observer.pending.popleft()
+                observer.pending_bytes -= len(dropped)
+                observer.dropped += 1
+            self._schedule(observer)
+
+    def _schedule(self, observer):
+        # Arm the observer's timer, respecting the minimum notification interval
+        if observer.timer is not None:
+            return
+        delay = max(0.0, observer.last_sent + self.notify_interval - time.monotonic())
+        observer.timer = asyncio.get_running_loop().call_later(delay, self._fire, observer)
+
+    def _fire(self, observer):
+        observer.timer = None
+        if observer not in self.observers or not observer.pending:
+            return
+        observer.last_sent = time.monotonic()
+        observer.notify()
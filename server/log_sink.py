@@ -0,0 +1,286 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Asynchronous Log Sink
+#
+# Decouples request handling from disk I/O for the CoAP server.
+# Request handlers enqueue finished log entries into a bounded in-memory queue
+# and return immediately; a background task drains the queue in batches and
+# hands them to a dedicated writer thread, which appends them to a storage
+# backend through large buffered writes, so a slow disk never stalls the
+# event loop.
+#
+# Backends:
+# - TextFileBackend: appends every entry to one text file (coap_logging.txt)
+# - RecordStore (record_store.py): segmented store with a time/client index
+#
+# Flush and fsync behaviour:
+# - FLUSH_INTERVAL: maximum number of seconds written data may sit in the
+#   user-space buffer before it is flushed to the operating system.
+# - FSYNC policy:
+#     never    - flush only, leave write-back to the operating system
+#     interval - fsync together with every periodic flush (default)
+#     always   - fsync after every coalesced batch
+#
+# When the queue is full, submit() returns False and the caller is expected to
+# answer with 5.03 Service Unavailable so that clients back off.
+#
+# Large entries that arrive in pieces (blockwise transfers) are written through
+# a SinkStream: each piece is spooled to an anonymous temporary file on the
+# writer thread as it arrives, and the finished entry is handed to the backend
+# in one piece, so entries from different clients never interleave and the
+# server never holds a whole transfer in memory.
+#
+# Every entry carries metadata (reception timestamp, client IP and MAC,
+# username) that backends may index.
+#
+# on_write, if given, is called on the event loop with the seconds each batch
+# took to write (for instrumentation).
+#
+# An entry the backend fails to write (e.g. a full disk) is dropped on its
+# own; the rest of its batch is still written. Dropped entries were already
+# acknowledged, so they are counted in LogSink.dropped and reported.
+
+FSYNC_POLICIES = ('never', 'interval', 'always')
+
+
+class TextFileBackend:
+    # Appends entries to a single text file; runs on the sink's writer thread
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.buffer_size = buffer_size
+        self._file = None
+
+    def open(self):
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+
+    def append(self, parts, meta):
+        # Write one entry made of bytes and spooled file parts
+        for part in parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                self._file.write(part)
+            else:
+                part.seek(0)
+                shutil.copyfileobj(part, self._file)
+
+    def flush(self, sync):
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush(True)
+        self._file.close()
+
+
+class SinkStream:
+    # One entry written incrementally through the sink
+    def __init__(self, sink, meta):
+        self.sink = sink
+        self.meta = meta
+        self.size = 0
+        self._spool = None  # Only touched on the writer thread
+        self._error = None  # Set on the writer thread when spooling a piece failed
+
+    def append(self, data):
+        # Queue a piece of the entry; False means the queue is full
+        if not self.sink._put(('append', self, data)):
+            return False
+        self.size += len(data)
+        return True
+
+    def finish(self, head, tail, data=b''):
+        # Queue writing head, the spooled data, the final piece and tail as one log entry
+        if not self.sink._put(('finish', self, head, tail, data)):
+            return False
+        self.size += len(data)
+        return True
+
+    def abort(self):
+        # Discard the spooled data
+        return self.sink._put(('abort', self))
+
+
+class LogSink:
+    # Bounded queue plus background writer in front of a storage backend
+    def __init__(self, backend, queue_size=10000, flush_interval=1.0,
+                 fsync_policy='interval', batch_bytes=1024 * 1024, on_write=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {fsync_policy}")
+        self.backend = backend
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.batch_bytes = batch_bytes
+        self.on_write = on_write
+        self._queue = None
+        self._task = None
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self.dropped = 0
+        # A single worker thread keeps writes strictly ordered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-sink')
+
+    @property
+    def depth(self):
+        # Number of entries waiting to be written
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        # Open the backend and start the background writer task
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self.backend.open()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def full(self):
+        # True if the next submit() would be rejected
+        return self._queue.full()
+
+    def open_stream(self, meta):
+        # Start an entry that is written piece by piece
+        return SinkStream(self, meta)
+
+    def submit(self, entry, meta):
+        # Enqueue a log entry without blocking; False means the queue is full
+        return self._put(('write', entry, meta))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def close(self):
+        # Stop the writer, write out everything still queued and close the backend
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Entries were acknowledged when queued, so write all of them, batch_bytes at a time
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._drain([])
+            if not batch:
+                break
+            self._count_dropped(*await loop.run_in_executor(self._executor, self._write, batch))
+        await loop.run_in_executor(self._executor, self._flush, self.fsync_policy != 'never')
+        await loop.run_in_executor(self._executor, self.backend.close)
+        self._executor.shutdown(wait=True)
+
+    def _drain(self, batch, size=0):
+        # Pull queued entries into the batch until it reaches batch_bytes
+        while size < self.batch_bytes:
+            try:
+                entry = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            batch.append(entry)
+            size += _entry_size(entry)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                entry = await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                if self._dirty:
+                    await loop.run_in_executor(self._executor, self._flush, self.fsync_policy != 'never')
+                continue
+
+            batch = self._drain([entry], _entry_size(entry))
+            try:
+                started = time.perf_counter()
+                self._count_dropped(*await loop.run_in_executor(self._executor, self._write, batch))
+                if self.on_write is not None:
+                    self.on_write(time.perf_counter() - started)
+                if self.fsync_policy == 'always':
+                    await loop.run_in_executor(self._executor, self._flush, True)
+                elif time.monotonic() - self._last_flush >= self.flush_interval:
+                    await loop.run_in_executor(self._executor, self._flush, self.fsync_policy == 'interval')
+            except Exception as e:
+                print(f"Error writing log batch: {e}")
+
+    def _count_dropped(self, dropped, error):
+        # Runs on the event loop with the result of _write()
+        if dropped:
+            self.dropped += dropped
+            print(f"Dropped {dropped} log entries: {error}")
+
+    def _write(self, batch):
+        # Runs on the writer thread; returns the number of entries dropped and the last error
+        dropped, error = 0, None
+        for op in batch:
+            kind = op[0]
+            if kind == 'write':
+                try:
+                    self.backend.append([op[1].encode('utf-8')], op[2])
+                except Exception as e:
+                    dropped, error = dropped + 1, e
+                continue
+            stream = op[1]
+            if kind == 'append':
+                if stream._error is not None:
+                    continue
+                try:
+                    if stream._spool is None:
+                        stream._spool = tempfile.TemporaryFile(dir=self.backend.directory)
+                    stream._spool.write(op[2])
+                except Exception as e:
+                    # The entry is incomplete now; it is dropped when it finishes
+                    stream._error = e
+                    if stream._spool is not None:
+                        _close_quietly(stream._spool)
+                        stream._spool = None
+                continue
+            spool, stream._spool = stream._spool, None
+            try:
+                if kind == 'finish' and stream._error is not None:
+                    dropped, error = dropped + 1, stream._error
+                elif kind == 'finish':
+                    parts = [op[2].encode('utf-8')]
+                    if spool is not None:
+                        parts.append(spool)
+                    parts += [op[4], op[3].encode('utf-8')]
+                    self.backend.append(parts, stream.meta)
+            except Exception as e:
+                dropped, error = dropped + 1, e
+            finally:
+                if spool is not None:
+                    _close_quietly(spool)
+        self._dirty = True
+        return dropped, error
+
+    def _flush(self, sync):
+        # Runs on the writer thread
+        self.backend.flush(sync)
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+
+def _close_quietly(spool):
+    # Closing flushes the spool's buffer, which fails on a full disk; the data is discarded anyway
+    try:
+        spool.close()
+    except OSError:
+        pass
+
+
+def _entry_size(entry):
+    # Approximate number of bytes an entry or stream operation adds to a batch
+    if entry[0] == 'write':
+        return len(entry[1])
+    if entry[0] == 'append':
+        return len(entry[2])
+    if entry[0] == 'finish':
+        return len(entry[4])
+    return 0
@@ -0,0 +1,85 @@
+import time
+
+# Neighbor Table Resolver
+#
+# Resolves client IP addresses to MAC addresses from the kernel ARP table
+# (/proc/net/arp) instead of spawning `arp -n` for every request.
+# The table is read into an in-memory IP -> MAC map that is refreshed once it
+# is older than the configured TTL, so lookups are plain dictionary hits.
+# Addresses that are not in the table are cached negatively for a short time
+# so that clients without an ARP entry (loopback, routed networks) do not
+# trigger a re-read on every request.
+#
+# Modes:
+# - lazy: refresh the table on demand when it is stale (default)
+# - off:  never resolve, every lookup returns None
+
+MODES = ('lazy', 'off')
+
+# Minimum number of seconds between two re-reads triggered by unknown addresses
+MISS_REFRESH_INTERVAL = 1.0
+
+
+class NeighborTable:
+    # Cached IP -> MAC map backed by the kernel neighbor table
+    def __init__(self, path='/proc/net/arp', ttl=30.0, negative_ttl=10.0, mode='lazy'):
+        if mode not in MODES:
+            raise ValueError(f"Invalid MAC resolution mode: {mode}")
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.mode = mode
+        self._table = {}
+        self._negative = {}
+        self._loaded_at = None
+        self._error_reported = False
+
+    def lookup(self, ip):
+        # Return the MAC address for an IPv4 address, or None if unknown
+        if self.mode == 'off':
+            return None
+
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.ttl:
+            self.refresh(now)
+
+        mac = self._table.get(ip)
+        if mac is not None:
+            return mac
+
+        expiry = self._negative.get(ip)
+        if expiry is not None and now < expiry:
+            return None
+
+        # The entry may have appeared since the last read
+        if now - self._loaded_at >= MISS_REFRESH_INTERVAL:
+            self.refresh(now)
+            mac = self._table.get(ip)
+        if mac is None:
+            self._negative[ip] = now + self.negative_ttl
+        return mac
+
+    def refresh(self, now=None):
+        # Re-read the kernel ARP table and drop expired negative entries
+        now = time.monotonic() if now is None else now
+        table = {}
+        try:
+            with open(self.path, 'r') as f:
+                next(f, None)  # Skip header line
+                for line in f:
+                    parts = line.split()
+                    # IP address, HW type, Flags, HW address, Mask, Device
+                    if len(parts) < 4:
+                        continue
+                    ip, flags, mac = parts[0], parts[2], parts[3]
+                    # ATF_COM (0x2) marks a completed entry
+                    if int(flags, 16) & 0x2 and mac != '00:00:00:00:00:00':
+                        table[ip] = mac
+        except (OSError, ValueError) as e:
+            if not self._error_reported:
+                print(f"Error reading neighbor table {self.path}: {e}")
+                self._error_reported = True
+        self._table = table
+        self._negative = {ip: expiry for ip, expiry in self._negative.items()
+                          if expiry > now and ip not in table}
+        self._loaded_at = now
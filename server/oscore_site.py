@@ -0,0 +1,171 @@
+import json
+import os
+import secrets
+import sys
+import time
+
+from aiocoap import Message, error
+from aiocoap.numbers.codes import Code
+
+try:
+    from aiocoap import oscore
+except ImportError:  # OSCORE needs the cryptography, hkdf, cbor and filelock packages
+    oscore = None
+
+# OSCORE Transport Security
+#
+# Object Security for CoAP (RFC 8613) protects requests and responses end to
+# end with pre-shared keys, so credentials and tokens in the Uri-Query are no
+# longer readable on the network. Unlike DTLS there is no handshake: an agent
+# and the server each keep a security context (keys plus sequence numbers and
+# replay window) in a directory, and a restarted agent resumes with its
+# persisted sequence number. Sequence numbers are persisted in growing steps,
+# so few messages cause a disk write; after an unclean shutdown the server
+# recovers its replay window with one Echo round trip (RFC 8613 B.1.2).
+#
+# OscoreSite wraps the resource site: protected requests are decrypted with
+# the context matching their key ID, passed to the site as plain requests and
+# their responses are protected again. Plain requests are passed through, or
+# refused when OSCORE is required.
+#
+# - Each agent has its own context directory below CONTEXTS (server side) and
+#   a matching one on the device, created with:
+#       python3 oscore_site.py add <CONTEXTS directory> <agent name>
+# - Block1 uploads are protected block by block; the data resource assembles
+#   them as usual (agents use blocks of at most 512 bytes, so that a protected
+#   block fits into one message). Responses larger than one block are split
+#   with Block2 inside the protection, from a copy kept for BLOCK2_CACHE_SECONDS.
+# - Observe is not supported on protected requests (they get a single
+#   response), since every notification would need its own sequence number.
+# - A context directory can only be used by one process, so OSCORE does not
+#   combine with --workers.
+
+BLOCK2_SIZE_EXP = 5  # 512-byte blocks for large protected responses, so each fits into one message
+BLOCK2_CACHE_SECONDS = 60.0
+SERVER_SENDER_ID = b'\x00'
+
+
+def available():
+    return oscore is not None
+
+
+def load_contexts(directory):
+    # Load every context directory below directory
+    contexts = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            contexts.append(oscore.FilesystemSecurityContext(path))
+    return contexts
+
+
+class OscoreSite:
+    # Site front end that unprotects OSCORE requests and protects their responses
+    def __init__(self, site, contexts, require=False):
+        self.site = site
+        self.contexts = {(context.recipient_id, context.id_context): context for context in contexts}
+        self.require = require
+        self.protected = 0
+        self.rejected = 0
+        self._responses = {}  # (key ID, path, query) -> (full response, expiry) for Block2
+
+    async def needs_blockwise_assembly(self, request):
+        if request.opt.object_security is not None:
+            # Blockwise of the content happens inside the protection; outer blocks
+            # only appear when a client sends a protected message larger than one block
+            return request.opt.block1 is not None
+        return await self.site.needs_blockwise_assembly(request)
+
+    async def add_observation(self, request, serverobservation):
+        if request.opt.object_security is None and not self.require:
+            await self.site.add_observation(request, serverobservation)
+
+    async def render(self, request):
+        if request.opt.object_security is None:
+            if self.require:
+                return Message(code=Code.UNAUTHORIZED, payload=b"OSCORE required")
+            return await self.site.render(request)
+
+        try:
+            kid, id_context = oscore.verify_start(request)
+            context = self.contexts[(kid, id_context)]
+        except (ValueError, KeyError):
+            self.rejected += 1
+            return Message(code=Code.UNAUTHORIZED, payload=b"Unknown security context")
+        try:
+            inner, request_id = context.unprotect(request)
+        except oscore.ReplayErrorWithEcho as e:
+            return e.to_message()  # Replay window recovery after a restart
+        except oscore.ProtectionInvalid as e:
+            self.rejected += 1
+            print(f"Rejected OSCORE request from {request.remote}: {e}")
+            return Message(code=Code.BAD_REQUEST, payload=b"Decryption failed")
+        inner.remote = request.remote
+        inner.opt.observe = None
+
+        try:
+            response = await self._render_inner(kid, inner)
+        except error.RenderableError as e:
+            response = e.to_message()
+        except Exception as e:
+            print(f"Error rendering protected request: {e}")
+            response = Message(code=Code.INTERNAL_SERVER_ERROR)
+        self.protected += 1
+        protected, _ = context.protect(response, request_id)
+        return protected
+
+    async def _render_inner(self, kid, request):
+        block2 = request.opt.block2
+        key = (kid, tuple(request.opt.uri_path), tuple(request.opt.uri_query))
+        now = time.monotonic()
+        for stale in [k for k, (_, expiry) in self._responses.items() if expiry < now]:
+            del self._responses[stale]
+
+        if block2 is not None and block2.block_number > 0:
+            cached = self._responses.get(key)
+            if cached is None:
+                return Message(code=Code.REQUEST_ENTITY_INCOMPLETE)
+            return cached[0]._extract_block(block2.block_number, block2.size_exponent, 1024)
+
+        response = await self.site.render(request)
+        size_exp = min(block2.size_exponent, BLOCK2_SIZE_EXP) if block2 is not None else BLOCK2_SIZE_EXP
+        if len(response.payload) <= 2 ** (size_exp + 4):
+            return response
+        self._responses[key] = (response, now + BLOCK2_CACHE_SECONDS)
+        return response._extract_block(0, size_exp, 1024)
+
+
+def add_context(directory, name):
+    # Create a context pair: <directory>/<name> for the server and <name>-agent for the device
+    existing = []
+    if os.path.isdir(directory):
+        for entry in os.listdir(directory):
+            try:
+                with open(os.path.join(directory, entry, 'secret.json')) as f:
+                    existing.append(bytes.fromhex(json.load(f)['recipient-id_hex']))
+            except (OSError, ValueError, KeyError):
+                continue
+    agent_id = (max((int.from_bytes(i, 'big') for i in existing), default=0) + 1)
+    agent_id = agent_id.to_bytes((agent_id.bit_length() + 7) // 8, 'big')
+    secret = secrets.token_bytes(32)
+    salt = secrets.token_bytes(8)
+    server_dir = os.path.join(directory, name)
+    agent_dir = f"{name}-agent"
+    for path, sender, recipient in ((server_dir, SERVER_SENDER_ID, agent_id),
+                                    (agent_dir, agent_id, SERVER_SENDER_ID)):
+        os.makedirs(path, mode=0o700)
+        fd = os.open(os.path.join(path, 'secret.json'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'sender-id_hex': sender.hex(), 'recipient-id_hex': recipient.hex(),
+                       'secret_hex': secret.hex(), 'salt_hex': salt.hex()}, f)
+    return server_dir, agent_dir
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != 'add':
+        print("Usage: python3 oscore_site.py add <contexts directory> <agent name>")
+        sys.exit(1)
+    server_dir, agent_dir = add_context(sys.argv[2], sys.argv[3])
+    print(f"Created {server_dir} for the server and {agent_dir} for the agent.")
+    print(f"Move {agent_dir} to the device (never copy it; each context must only be used in one place)"
+          f" and set [security] OSCORE_CONTEXT to its path.")
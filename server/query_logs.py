@@ -0,0 +1,51 @@
+import argparse
+import sys
+from datetime import datetime
+
+from record_store import StoreReader
+
+# Record Store Query Tool
+#
+# Prints the reports received by the CoAP server from its record store
+# (record_store.py), filtered by the time they were stored, client and
+# username. The per-segment indexes are used to skip whole segments and index
+# blocks outside the time range and to seek directly to the matching records,
+# so queries do not scan the stored data.
+#
+# Usage:
+#   python3 query_logs.py [--store store] [--client IP|MAC] [--user NAME]
+#                         [--since 2024-01-01T10:00] [--until 2024-01-01T11:00]
+#                         [--count]
+
+
+def parse_time(value):
+    # ISO 8601 local time to seconds since the epoch
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO timestamp: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query reports stored by the CoAP server")
+    parser.add_argument('--store', default='store', help="Record store directory (default: store)")
+    parser.add_argument('--client', help="Client IP or MAC address")
+    parser.add_argument('--user', help="Username the client authenticated as")
+    parser.add_argument('--since', type=parse_time, help="Earliest reception time (ISO 8601)")
+    parser.add_argument('--until', type=parse_time, help="Latest reception time (ISO 8601)")
+    parser.add_argument('--count', action='store_true', help="Only print the number of matching records")
+    args = parser.parse_args()
+
+    reader = StoreReader(args.store)
+    if args.count:
+        print(sum(1 for _ in reader.find(args.since, args.until, args.client, args.user)))
+        return
+
+    out = sys.stdout.buffer
+    for _, data in reader.query(args.since, args.until, args.client, args.user):
+        out.write(data)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# Per-Client Rate Limits and Fair Scheduling
+#
+# TokenBuckets limits every key (a username or a client IP address) to a rate
+# of requests and a rate of payload bytes, each with a burst allowance. A
+# request is admitted while the key has a request token and its byte bucket
+# is not in debt; its payload is then charged, so one large report may take
+# the byte bucket below zero and the next report waits until it is repaid.
+# Rejected requests are told how many seconds to wait, which the server sends
+# as the Max-Age of a 4.29 Too Many Requests response.
+#
+# Buckets are kept in one ordered dict of [request tokens, byte tokens, last
+# update] lists, least recently used first. A bucket is refilled only when
+# its key is seen again, and the oldest buckets are evicted once they have
+# refilled completely (a full bucket is the same as none), or when more than
+# max_entries keys are tracked.
+#
+# FairQueue shares the log sink between clients once it is congested (its
+# queue is above a watermark). Work is then held in one queue per client and
+# released by deficit round robin: every turn adds quantum bytes to a client's
+# allowance, and its waiting work is released while the allowance covers it,
+# so a client with a small report is served within one round however much
+# another client has queued. Clients with max_pending items waiting are
+# refused, and work that waited max_wait seconds is dropped. While the sink
+# has room nothing is queued, so the fair queue costs nothing at normal load.
+
+
+class TokenBuckets:
+    # Request and byte token buckets per key, evicted once idle
+    def __init__(self, requests_per_second=0.0, request_burst=0, bytes_per_second=0.0, byte_burst=0,
+                 max_entries=100000):
+        self.configure(requests_per_second, request_burst, bytes_per_second, byte_burst, max_entries)
+        self.buckets = OrderedDict()  # key -> [request tokens, byte tokens, last update]
+        self.limited = 0
+
+    def configure(self, requests_per_second, request_burst, bytes_per_second, byte_burst, max_entries):
+        # Set the limits; existing buckets keep their tokens (capped at the new bursts when next seen)
+        self.request_rate = requests_per_second  # 0 = unlimited
+        self.request_burst = max(request_burst, 1)
+        self.byte_rate = bytes_per_second  # 0 = unlimited
+        self.byte_burst = byte_burst
+        self.max_entries = max_entries
+
+    @property
+    def enabled(self):
+        return self.request_rate > 0 or self.byte_rate > 0
+
+    def _bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self._evict(now)
+            bucket = self.buckets[key] = [self.request_burst, self.byte_burst, now]
+            return bucket
+        elapsed = now - bucket[2]
+        bucket[0] = min(self.request_burst, bucket[0] + elapsed * self.request_rate)
+        bucket[1] = min(self.byte_burst, bucket[1] + elapsed * self.byte_rate)
+        bucket[2] = now
+        self.buckets.move_to_end(key)
+        return bucket
+
+    def _full(self, bucket, now):
+        # True if the bucket has refilled completely by now
+        elapsed = now - bucket[2]
+        return ((not self.request_rate or bucket[0] + elapsed * self.request_rate >= self.request_burst)
+                and (not self.byte_rate or bucket[1] + elapsed * self.byte_rate >= self.byte_burst))
+
+    def _evict(self, now):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) < self.max_entries and not self._full(bucket, now):
+                break
+            del self.buckets[key]
+
+    def acquire(self, key, size=0, now=None):
+        # Admit one request with size payload bytes; returns 0 or the seconds to wait
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        bucket = self._bucket(key, now)
+        wait = 0.0
+        if self.request_rate and bucket[0] < 1:
+            wait = (1 - bucket[0]) / self.request_rate
+        if self.byte_rate and bucket[1] < 0:
+            wait = max(wait, -bucket[1] / self.byte_rate)
+        if wait:
+            self.limited += 1
+            return wait
+        if self.request_rate:
+            bucket[0] -= 1
+        if self.byte_rate:
+            bucket[1] -= size
+        return 0.0
+
+    def charge(self, key, size, now=None):
+        # Charge payload bytes of an admitted transfer without refusing them
+        if self.byte_rate:
+            self._bucket(key, time.monotonic() if now is None else now)[1] -= size
+
+
+class FairQueue:
+    # Deficit round robin admission of ingest work while the log sink is congested
+    def __init__(self, room, quantum=4096, max_pending=64, max_wait=2.0, poll_interval=0.005):
+        self.room = room  # Callable: number of entries the sink takes before it is congested
+        self.quantum = quantum
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.queues = {}  # client -> deque of (cost, future)
+        self.deficits = {}
+        self.active = deque()  # Clients with waiting work, in round robin order
+        self.waiting = 0
+        self.timeouts = 0
+        self._released = 0  # Released work that has not reached the sink yet
+        self._resume = False  # The first active client's turn was interrupted
+        self._task = None
+
+    def over_share(self, client):
+        # True if the client already has max_pending items waiting
+        queue = self.queues.get(client)
+        return queue is not None and len(queue) >= self.max_pending
+
+    async def admit(self, client, cost):
+        # Wait for the client's turn; False if the work waited max_wait seconds
+        if not self.active and self.room() > 0:
+            return True
+        queue = self.queues.get(client)
+        if queue is None:
+            queue = self.queues[client] = deque()
+            self.deficits[client] = 0
+            self.active.append(client)
+        future = asyncio.get_running_loop().create_future()
+        queue.append((cost, future))
+        self.waiting += 1
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        finally:
+            if future.done() and not future.cancelled():
+                # Released; the caller submits its work before yielding to the event loop again
+                self._released -= 1
+
+    async def _run(self):
+        try:
+            while self.active:
+                room = self.room() - self._released
+                if room <= 0:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                self._release(room)
+                await asyncio.sleep(0)
+        finally:
+            self._task = None
+
+    def _release(self, room):
+        while room > 0 and self.active:
+            client = self.active[0]
+            queue = self.queues[client]
+            if not self._resume:
+                self.deficits[client] += self.quantum
+            self._resume = False
+            while queue and room > 0:
+                cost, future = queue[0]
+                if future.done():  # Timed out
+                    queue.popleft()
+                    self.waiting -= 1
+                    continue
+                if cost > self.deficits[client]:
+                    break
+                queue.popleft()
+                self.waiting -= 1
+                self.deficits[client] -= cost
+                future.set_result(True)
+                self._released += 1
+                room -= 1
+            while queue and queue[0][1].done():
+                queue.popleft()
+                self.waiting -= 1
+            if not queue:
+                # Allowance is not kept while a client has nothing waiting
+                self.active.popleft()
+                del self.queues[client]
+                del self.deficits[client]
+            elif room > 0:
+                self.active.rotate(-1)
+            else:
+                self._resume = True
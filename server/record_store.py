@@ -0,0 +1,430 @@
+import gzip
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Segmented Record Store
+#
+# Storage engine for received reports, used as a log sink backend.
+#
+# Records are appended to segment files (segment-<seq>.log) in the same text
+# layout as coap_logging.txt, so segments stay readable with standard tools.
+# A new segment is started when the current one reaches SEGMENT_BYTES or is
+# older than SEGMENT_SECONDS.
+#
+# Every segment has a sparse index (segment-<seq>.idx) with one JSON line per
+# block of up to INDEX_BLOCK_RECORDS records rather than per record. A block
+# holds one column per field: the time the record was stored, client IP,
+# client MAC, username and the record's offset and length in the segment
+# (record boundaries cannot be recovered from the text layout). Queries read
+# the first block of each segment to skip segments outside the requested time
+# range, skip blocks by their time range, clients and users, filter the
+# records of the remaining blocks and then seek directly to them (through
+# mmap for uncompressed segments).
+#
+# Timestamps are taken when a record is appended and never decrease within a
+# partition, so segments and blocks are in time order; a blockwise transfer
+# is stored, and timestamped, when its last block arrives. A block is written
+# to the index only after the data of its records was written to the segment
+# (and synced first when the sink syncs), so the index never points past the
+# data. The store starts a new segment when it is opened, so records left
+# unindexed by a crash are never overwritten.
+#
+# Sealed segments are gzip-compressed in the background, and whole segments
+# are removed once they are older than the retention period or the store
+# exceeds its size budget.
+#
+# When the server runs several worker processes, each worker writes its own
+# partition (a worker-<n> subdirectory), so records are never interleaved.
+# The reader merges all partitions; its page cursors hold one position per
+# partition.
+
+SEGMENT_PATTERN = re.compile(r'^segment-(\d+)\.(log|log\.gz|idx)$')
+PARTITION_PATTERN = re.compile(r'^worker-\d+$')
+INDEX_BLOCK_RECORDS = 256
+
+
+def _segment_name(seq, suffix):
+    return f"segment-{seq:08d}.{suffix}"
+
+
+def list_segments(directory):
+    # Return {seq: set of suffixes} for the segments in the directory
+    segments = {}
+    for name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(name)
+        if match:
+            segments.setdefault(int(match.group(1)), set()).add(match.group(2))
+    return segments
+
+
+def partition_directory(directory, worker):
+    # Directory written by the given worker process
+    return os.path.join(directory, f"worker-{worker}")
+
+
+def format_cursor(cursor):
+    # {partition: (seq, offset)} as text, "." standing for the store itself
+    return ','.join(f"{name or '.'}:{seq}:{off}" for name, (seq, off) in sorted(cursor.items()))
+
+
+def parse_cursor(text):
+    # Inverse of format_cursor; raises ValueError for malformed cursors
+    cursor = {}
+    for part in text.split(','):
+        name, seq, off = part.split(':')
+        if name != '.' and not PARTITION_PATTERN.match(name):
+            raise ValueError(f"Invalid partition in cursor: {name}")
+        cursor['' if name == '.' else name] = (int(seq), int(off))
+    return cursor
+
+
+class RecordStore:
+    # Append side of the store; all methods except close() run on the sink's writer thread
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, segment_seconds=3600,
+                 compress_sealed=True, retention_seconds=30 * 86400, max_bytes=0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compress_sealed = compress_sealed
+        self.retention_seconds = retention_seconds
+        self.max_bytes = max_bytes  # 0 disables the size budget
+        self._seq = None
+        self._data = None
+        self._index = None
+        self._offset = 0
+        self._opened_at = 0.0
+        self._pending = []  # Index entries of the records not yet written to the index
+        self._last_ts = 0.0
+        # Compression and retention run off the writer thread
+        self._maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store-maintenance')
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self):
+        # Continue after the existing segments and tidy up old ones
+        segments = list_segments(self.directory)
+        self._seq = max(segments, default=0) + 1  # Created on the first append
+        self._last_ts = _last_timestamp(self.directory, segments)
+        for seq, suffixes in sorted(segments.items()):
+            if self.compress_sealed and 'log' in suffixes:
+                self._maintenance.submit(self._compress, seq)
+        self._maintenance.submit(self._apply_retention)
+
+    def append(self, parts, meta):
+        # Write one record made of bytes and spooled file parts
+        if self._data is None:
+            self._open_segment(self._seq)
+        elif (self._offset >= self.segment_bytes or
+                time.time() - self._opened_at >= self.segment_seconds):
+            self._roll()
+        start = self._offset
+        for part in parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                self._data.write(part)
+                self._offset += len(part)
+            else:
+                part.seek(0)
+                shutil.copyfileobj(part, self._data)
+                self._offset += os.fstat(part.fileno()).st_size
+        # Stored time, never decreasing even if the clock steps back
+        self._last_ts = max(time.time(), self._last_ts)
+        self._pending.append(dict(meta, ts=self._last_ts, off=start, len=self._offset - start))
+        if len(self._pending) >= INDEX_BLOCK_RECORDS:
+            self._data.flush()
+            self._write_block()
+
+    def flush(self, sync):
+        if self._data is None:
+            return
+        self._data.flush()
+        if sync:
+            os.fsync(self._data.fileno())
+        self._write_block()
+        self._index.flush()
+        if sync:
+            os.fsync(self._index.fileno())
+
+    def _write_block(self):
+        # Index the pending records; their data must have been flushed
+        if not self._pending:
+            return
+        block = {key: [entry.get(key) for entry in self._pending] for key in self._pending[0]}
+        self._index.write(json.dumps(block, separators=(',', ':')) + '\n')
+        self._pending = []
+
+    def close(self):
+        if self._data is not None:
+            self.flush(True)
+            self._data.close()
+            self._index.close()
+        self._maintenance.shutdown(wait=True)
+
+    def _open_segment(self, seq):
+        self._seq = seq
+        self._data = open(os.path.join(self.directory, _segment_name(seq, 'log')), 'ab', buffering=1024 * 1024)
+        self._index = open(os.path.join(self.directory, _segment_name(seq, 'idx')), 'a')
+        self._offset = self._data.tell()
+        self._opened_at = time.time()
+
+    def _roll(self):
+        # Seal the current segment and start the next one
+        self.flush(True)
+        self._data.close()
+        self._index.close()
+        sealed = self._seq
+        self._open_segment(sealed + 1)
+        if self.compress_sealed:
+            self._maintenance.submit(self._compress, sealed)
+        self._maintenance.submit(self._apply_retention)
+
+    def _compress(self, seq):
+        # Replace a sealed segment by its gzip-compressed copy
+        try:
+            source = os.path.join(self.directory, _segment_name(seq, 'log'))
+            target = os.path.join(self.directory, _segment_name(seq, 'log.gz'))
+            with open(source, 'rb') as src, gzip.open(target + '.tmp', 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(target + '.tmp', target)
+            os.remove(source)
+        except Exception as e:
+            print(f"Error compressing segment {seq}: {e}")
+
+    def _apply_retention(self):
+        # Remove the oldest sealed segments beyond the retention period or size budget
+        try:
+            segments = sorted(list_segments(self.directory).items())
+            sizes = {}
+            for seq, suffixes in segments:
+                sizes[seq] = sum(os.path.getsize(os.path.join(self.directory, _segment_name(seq, s)))
+                                 for s in suffixes)
+            total = sum(sizes.values())
+            now = time.time()
+            for seq, suffixes in segments:
+                if seq >= self._seq:
+                    break
+                data_suffix = 'log.gz' if 'log.gz' in suffixes else 'log'
+                mtime = os.path.getmtime(os.path.join(self.directory, _segment_name(seq, data_suffix)))
+                expired = self.retention_seconds and now - mtime > self.retention_seconds
+                over_budget = self.max_bytes and total > self.max_bytes
+                if not expired and not over_budget:
+                    break
+                for suffix in suffixes:
+                    os.remove(os.path.join(self.directory, _segment_name(seq, suffix)))
+                total -= sizes[seq]
+                print(f"Removed segment {seq} ({'expired' if expired else 'size budget'})")
+        except Exception as e:
+            print(f"Error applying retention: {e}")
+
+
+class StoreReader:
+    # Query side of the store; safe to use while the server is writing
+    def __init__(self, directory):
+        self.directory = directory
+
+    def partitions(self):
+        # Return [(name, directory)] of the store itself and its worker partitions
+        partitions = []
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return partitions
+        if any(SEGMENT_PATTERN.match(name) for name in names):
+            partitions.append(('', self.directory))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if PARTITION_PATTERN.match(name) and os.path.isdir(path):
+                partitions.append((name, path))
+        return partitions
+
+    def find(self, since=None, until=None, client=None, user=None, after=None):
+        # Yield (partition, seq, index entry) for matching records, merged in
+        # time order across partitions, starting after the cursor if given
+        after = after or {}
+        streams = []
+        for name, directory in self.partitions():
+            entries = _find_in_partition(directory, since, until, client, user, after.get(name))
+            streams.append(((entry['ts'], name, seq, entry) for seq, entry in entries))
+        for _, name, seq, entry in heapq.merge(*streams, key=lambda item: item[:3]):
+            yield name, seq, entry
+
+    def query(self, since=None, until=None, client=None, user=None):
+        # Yield (index entry, record bytes) for matching records
+        readers = _Readers(self.directory)
+        try:
+            for name, seq, entry in self.find(since, until, client, user):
+                data = readers.get(name, seq).read(entry['off'], entry['len'])
+                if data is not None:
+                    yield entry, data
+        finally:
+            readers.close()
+
+    def page(self, since=None, until=None, client=None, user=None, after=None,
+             max_records=100, max_bytes=256 * 1024):
+        # Return (record data, cursor) for one page of matching records; the
+        # cursor continues the query after this page and is None on the last
+        # page. A page always holds at least one record if any matches.
+        pieces = []
+        size = 0
+        cursor = dict(after or {})
+        readers = _Readers(self.directory)
+        try:
+            for name, seq, entry in self.find(since, until, client, user, after):
+                if pieces and (len(pieces) >= max_records or size + entry['len'] > max_bytes):
+                    return b''.join(pieces), cursor
+                data = readers.get(name, seq).read(entry['off'], entry['len'])
+                if data is None:
+                    break  # Not flushed yet
+                pieces.append(data)
+                size += len(data)
+                cursor[name] = (seq, entry['off'])
+        finally:
+            readers.close()
+        return b''.join(pieces), None
+
+
+def _block(line):
+    # Index block of one index line; a line of a store written before blocks holds one record
+    block = json.loads(line)
+    if not isinstance(block['ts'], list):
+        block = {key: [value] for key, value in block.items()}
+    return block
+
+
+def _last_timestamp(directory, segments):
+    # Timestamp of the last indexed record of the newest segment, 0.0 without one
+    for seq in sorted(segments, reverse=True):
+        try:
+            with open(os.path.join(directory, _segment_name(seq, 'idx')), 'rb') as f:
+                f.seek(max(0, f.seek(0, os.SEEK_END) - 1024 * 1024))
+                lines = f.read().split(b'\n')[:-1]
+        except FileNotFoundError:
+            continue
+        for line in reversed(lines):
+            try:
+                return _block(line)['ts'][-1]
+            except (ValueError, KeyError, IndexError):
+                continue  # Torn or partially read line
+    return 0.0
+
+
+def _segment_starts(directory):
+    # Return [(seq, first timestamp)] for segments with a non-empty index
+    starts = []
+    for seq, suffixes in sorted(list_segments(directory).items()):
+        if 'idx' not in suffixes:
+            continue
+        try:
+            with open(os.path.join(directory, _segment_name(seq, 'idx')), 'r') as f:
+                first = f.readline()
+        except FileNotFoundError:
+            continue  # Removed by retention meanwhile
+        if first.endswith('\n'):
+            starts.append((seq, _block(first)['ts'][0]))
+    return starts
+
+
+def _find_in_partition(directory, since, until, client, user, after):
+    # Yield (seq, index entry) for matching records of one partition in
+    # write order, starting after the (seq, offset) position if given
+    starts = _segment_starts(directory)
+    for i, (seq, first_ts) in enumerate(starts):
+        if after is not None and seq < after[0]:
+            continue
+        # Segment i covers [first_ts, first timestamp of segment i + 1)
+        next_ts = starts[i + 1][1] if i + 1 < len(starts) else None
+        if until is not None and first_ts > until:
+            break
+        if since is not None and next_ts is not None and next_ts < since:
+            continue
+        try:
+            index = open(os.path.join(directory, _segment_name(seq, 'idx')), 'r')
+        except FileNotFoundError:
+            continue  # Removed by retention meanwhile
+        with index as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # Block still being written
+                block = _block(line)
+                times = block['ts']
+                if since is not None and times[-1] < since:
+                    continue
+                if until is not None and times[0] > until:
+                    return
+                if after is not None and seq == after[0] and block['off'][-1] <= after[1]:
+                    continue
+                if client is not None and client not in block.get('ip', ()) and client not in block.get('mac', ()):
+                    continue
+                if user is not None and user not in block.get('user', ()):
+                    continue
+                keys = list(block)
+                for values in zip(*block.values()):
+                    entry = dict(zip(keys, values))
+                    if after is not None and seq == after[0] and entry['off'] <= after[1]:
+                        continue
+                    if since is not None and entry['ts'] < since:
+                        continue
+                    if until is not None and entry['ts'] > until:
+                        return
+                    if client is not None and client not in (entry.get('ip'), entry.get('mac')):
+                        continue
+                    if user is not None and entry.get('user') != user:
+                        continue
+                    yield seq, entry
+
+
+class _Readers:
+    # Open segment readers, one per partition
+    def __init__(self, directory):
+        self.directory = directory
+        self._open = {}
+
+    def get(self, partition, seq):
+        current = self._open.get(partition)
+        if current is None or current[0] != seq:
+            if current is not None:
+                current[1].close()
+            current = self._open[partition] = (seq, _SegmentReader(
+                os.path.join(self.directory, partition), seq))
+        return current[1]
+
+    def close(self):
+        for _, reader in self._open.values():
+            reader.close()
+        self._open.clear()
+
+
+class _SegmentReader:
+    # Reads records from a plain (mmap) or gzip-compressed segment
+    def __init__(self, directory, seq):
+        self._mmap = None
+        self._gzip = None
+        path = os.path.join(directory, _segment_name(seq, 'log'))
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            gz_path = os.path.join(directory, _segment_name(seq, 'log.gz'))
+            if os.path.exists(gz_path):
+                self._gzip = gzip.open(gz_path, 'rb')
+
+    def read(self, offset, length):
+        if self._mmap is not None:
+            if offset + length > len(self._mmap):
+                return None  # Not flushed yet
+            return self._mmap[offset:offset + length]
+        if self._gzip is not None:
+            self._gzip.seek(offset)
+            return self._gzip.read(length)
+        return None
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._gzip is not None:
+            self._gzip.close()
@@ -0,0 +1,206 @@
+import io
+from datetime import datetime
+
+try:
+    import cbor2
+except ImportError:  # Without cbor2 only the text format is accepted
+    cbor2 = None
+
+# Agent Report Formats
+#
+# Agents send reports either as the legacy free-form text (Content-Format 0,
+# text/plain) or as a versioned CBOR structure (Content-Format 60,
+# application/cbor). The accepted formats are advertised to agents in the
+# elective Accept-Format option (65002) of /auth responses; the numbers and
+# keys must match the agent.
+#
+# CBOR report, schema version 1 (a map with integer keys):
+#   0: schema version (1)
+#   1: timestamp, seconds since the epoch (float)
+#   2: memory usage in percent (float or null)
+#   3: disk usage in percent (float or null)
+#   4: source files, array of paths
+#   5: log records, indefinite-length array of [source index, byte offset, line]
+#      where line is a byte string without the trailing newline
+#   6: optional metric aggregates since the previous report, map of metric
+#      name to [min, avg, max, last, sample count]
+#
+# The log records come last so that the decoder below can process a report
+# incrementally, record by record, as blockwise transfers arrive.
+
+ACCEPT_FORMAT_OPTION = 65002
+
+CONTENT_FORMAT_TEXT = 0
+CONTENT_FORMAT_CBOR = 60
+
+SCHEMA_VERSION = 1
+KEY_VERSION = 0
+KEY_TIMESTAMP = 1
+KEY_MEMORY = 2
+KEY_DISK = 3
+KEY_SOURCES = 4
+KEY_LOGS = 5
+KEY_METRICS = 6
+
+
+class ReportFormatError(Exception):
+    pass
+
+
+def supported_formats():
+    # Content formats this server accepts on the data path
+    formats = [CONTENT_FORMAT_TEXT]
+    if cbor2 is not None:
+        formats.append(CONTENT_FORMAT_CBOR)
+    return formats
+
+
+class ReportDecoder:
+    # Incremental decoder for CBOR reports
+    #
+    # feed() returns a list of events: ('header', dict) once all fields before
+    # the log records are known, then ('record', (source, offset, line)) for
+    # every complete record.
+    def __init__(self):
+        if cbor2 is None:
+            raise ReportFormatError("CBOR reports require the cbor2 package")
+        self.header = {}
+        self._buffer = bytearray()
+        self._pairs = None  # Map entries still expected
+        self._in_logs = False
+        self._header_sent = False
+
+    @property
+    def done(self):
+        return self._pairs == 0
+
+    def feed(self, data):
+        self._buffer += data
+        events = []
+        fp = io.BytesIO(self._buffer)
+        decoder = cbor2.CBORDecoder(fp)
+        pos = 0
+        try:
+            while pos < len(self._buffer) and not self.done:
+                if self._pairs is None:
+                    initial = self._buffer[pos]
+                    if initial >> 5 != 5 or initial & 0x1f > 23:
+                        raise ReportFormatError("Report is not a CBOR map")
+                    self._pairs = initial & 0x1f
+                    pos += 1
+                    fp.seek(pos)
+                elif self._in_logs:
+                    if self._buffer[pos] == 0xff:
+                        self._in_logs = False
+                        self._pairs -= 1
+                        pos += 1
+                        fp.seek(pos)
+                        continue
+                    record = decoder.decode()
+                    pos = fp.tell()
+                    events.append(('record', self._record(record)))
+                else:
+                    key = decoder.decode()
+                    if key == KEY_LOGS:
+                        if fp.tell() >= len(self._buffer):
+                            raise cbor2.CBORDecodeEOF()
+                        if self._buffer[fp.tell()] != 0x9f:
+                            raise ReportFormatError("Log records must be an indefinite-length array")
+                        pos = fp.tell() + 1
+                        fp.seek(pos)
+                        self._in_logs = True
+                        events.append(self._header_event())
+                        continue
+                    value = decoder.decode()
+                    pos = fp.tell()
+                    self.header[key] = value
+                    self._pairs -= 1
+        except cbor2.CBORDecodeEOF:
+            pass  # Wait for more data
+        except cbor2.CBORDecodeError as e:
+            raise ReportFormatError(f"Invalid CBOR report: {e}")
+        del self._buffer[:pos]
+        if self.done and not self._header_sent:
+            events.append(self._header_event())
+        return events
+
+    def finish(self):
+        # Check that the report was complete
+        if not self.done or self._buffer:
+            raise ReportFormatError("Truncated or trailing data in CBOR report")
+
+    def _header_event(self):
+        header = self.header
+        if header.get(KEY_VERSION) != SCHEMA_VERSION:
+            raise ReportFormatError(f"Unsupported report schema version: {header.get(KEY_VERSION)}")
+        # Well-formed CBOR can still carry the wrong types; check them here so rendering cannot fail
+        timestamp = header.get(KEY_TIMESTAMP)
+        try:
+            if not _is_number(timestamp):
+                raise TypeError
+            datetime.fromtimestamp(timestamp)
+        except (TypeError, ValueError, OverflowError, OSError):
+            raise ReportFormatError(f"Invalid report timestamp: {timestamp!r}")
+        for key in (KEY_MEMORY, KEY_DISK):
+            if header.get(key) is not None and not _is_number(header[key]):
+                raise ReportFormatError(f"Invalid usage value: {header[key]!r}")
+        sources = header.get(KEY_SOURCES, [])
+        if not isinstance(sources, list) or not all(isinstance(source, str) for source in sources):
+            raise ReportFormatError("Source files must be an array of strings")
+        metrics = header.get(KEY_METRICS)
+        if metrics is not None:
+            if not isinstance(metrics, dict):
+                raise ReportFormatError("Metric aggregates must be a map")
+            for name, entry in metrics.items():
+                if (not isinstance(name, str) or not isinstance(entry, list) or len(entry) != 5
+                        or not all(_is_number(number) for number in entry)):
+                    raise ReportFormatError(f"Invalid metric aggregate: {name!r}")
+        self._header_sent = True
+        return ('header', header)
+
+    def _record(self, record):
+        try:
+            source, offset, line = record
+            if type(source) is not int or type(offset) is not int or not isinstance(line, bytes):
+                raise TypeError
+            if source < 0:
+                raise IndexError
+            return self.header.get(KEY_SOURCES, [])[source], offset, line
+        except (TypeError, ValueError, IndexError):
+            raise ReportFormatError(f"Invalid log record: {record!r}")
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+def _percent(value):
+    return f"{value:.2f}%" if value is not None else "unavailable"
+
+
+def _metrics(metrics):
+    # Metric aggregates in the layout of text reports; checked by ReportDecoder
+    if not metrics:
+        return ""
+    lines = ["Metrics (min/avg/max/last, samples):\n"]
+    for name, (low, avg, high, last, count) in sorted(metrics.items()):
+        lines.append(f"  {name} {low:.2f}/{avg:.2f}/{high:.2f}/{last:.2f} {count}\n")
+    return "".join(lines)
+
+
+def render_text(events):
+    # Render decoded report events in the legacy text layout
+    pieces = []
+    for kind, value in events:
+        if kind == 'header':
+            timestamp = datetime.fromtimestamp(value[KEY_TIMESTAMP]).isoformat()
+            pieces.append(
+                f"Timestamp: {timestamp}\n"
+                f"Memory Usage: {_percent(value.get(KEY_MEMORY))}\n"
+                f"Disk Usage: {_percent(value.get(KEY_DISK))}\n"
+                f"{_metrics(value.get(KEY_METRICS))}"
+                f"Logs:\n".encode('utf-8'))
+        else:
+            pieces.append(value[2])
+            pieces.append(b'\n')
+    return b''.join(pieces)
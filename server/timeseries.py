@@ -0,0 +1,630 @@
+import argparse
+import asyncio
+import functools
+import json
+import math
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import compress
+from operator import truediv
+
+from report_format import KEY_DISK, KEY_MEMORY, KEY_METRICS
+
+# Report Time Series
+#
+# Extracts the numeric fields of received reports into one time series per
+# client (IP address) and metric, so dashboards and alerts can read them
+# without scanning the stored reports:
+#
+# - memory_percent and disk_percent from the report header (keys 2 and 3 of
+#   CBOR reports, or "Memory Usage:" and "Disk Usage:" of text reports)
+# - the metric aggregates of the report (key 6), by their name, weighted by
+#   their sample count; they replace the header value of the same name
+# - JSON_FIELDS of JSON log lines, such as the temperature and humidity of
+#   the sensor simulators, as <field>:<JSON_LABEL value> (e.g.
+#   temperature:Sensor1), at the timestamp of the reading
+#
+# Every series is kept as rollups of 1 minute, 1 hour and 1 day buckets
+# holding the minimum, sum, maximum and number of samples. The buckets of a
+# resolution form one ring per series, with a fixed number of slots, and the
+# rings of all series are stored column by column in typed arrays, so a
+# series costs 28 bytes per slot and no Python objects. A sample newer
+# than the ring empties the slots it passes over; a sample older than the
+# ring is ignored.
+#
+# Parsing and all access to the rings run on one worker thread, in the order
+# they were submitted, so the event loop only hands over the decoded pieces
+# of a report: the header and record events of CBOR reports, or the text of
+# text reports. Samples are recorded when the report is complete. If the
+# thread falls behind by MAX_PENDING pieces, reports are skipped and counted:
+# the series are best effort and never slow down ingestion. Series beyond
+# MAX_SERIES, or beyond MAX_SERIES_PER_CLIENT of one client, are not created
+# and their samples are counted as dropped.
+#
+# The rings are written to DIRECTORY/series.bin every PERSIST_INTERVAL
+# seconds and at shutdown (temporary file, fsync, rename) and restored at
+# start. If the ring sizes were changed, the stored buckets are re-added. A
+# snapshot that cannot be read is renamed to series.bin.corrupt and the rings
+# start empty.
+#
+# Queries return the buckets of one metric between since and until, for one
+# or all clients, at the finest resolution whose ring still covers since
+# unless one is given, or one summary (min/avg/max/count) per client.
+#
+# Usage:
+#   python3 timeseries.py [--directory timeseries] [--metric NAME] [--client IP]
+#                         [--since 2024-01-01T10:00] [--until 2024-01-01T11:00]
+#                         [--resolution 1m|1h|1d] [--summary]
+# Without --metric, the stored metrics and their number of clients are
+# listed. The persisted rings of all worker partitions are merged.
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+SNAPSHOT_MAGIC = b'TSR1'
+SNAPSHOT_FILE = 'series.bin'
+PARTITION_PATTERN = re.compile(r'^worker-\d+$')
+MAX_LINE = 64 * 1024  # Longer log lines are not parsed
+MAX_SKEW = 300.0  # Readings further in the future are taken at reception time
+
+_decode_json = json.JSONDecoder().raw_decode
+
+
+class Rollup:
+    # One resolution of all series: a ring of slots per series, stored column by column
+    def __init__(self, seconds, slots):
+        self.seconds = seconds
+        self.slots = slots
+        self.newest = array('q')  # Newest bucket of each series, -1 before its first sample
+        self.counts = array('I')
+        self.totals = array('d')
+        self.lows = array('d')
+        self.highs = array('d')
+
+    def columns(self):
+        return (self.newest, self.counts, self.totals, self.lows, self.highs)
+
+    def grow(self):
+        # Add the ring of one more series
+        self.newest.append(-1)
+        for column in (self.counts, self.totals, self.lows, self.highs):
+            column.frombytes(bytes(column.itemsize * self.slots))
+
+    def add(self, series, t, total, count, low, high):
+        bucket = int(t // self.seconds)
+        newest = self.newest[series]
+        base = series * self.slots
+        if bucket > newest:
+            # Empty the slots of the buckets passed over since the newest sample
+            counts = self.counts
+            for b in range(max(newest + 1, bucket - self.slots + 1), bucket + 1):
+                counts[base + b % self.slots] = 0
+            self.newest[series] = bucket
+        elif bucket <= newest - self.slots:
+            return
+        i = base + bucket % self.slots
+        if self.counts[i]:
+            self.totals[i] += total
+            if low < self.lows[i]:
+                self.lows[i] = low
+            if high > self.highs[i]:
+                self.highs[i] = high
+        else:
+            self.totals[i] = total
+            self.lows[i] = low
+            self.highs[i] = high
+        self.counts[i] += count
+
+    def covers(self, t, now):
+        # True if the ring still holds the bucket of time t
+        return t // self.seconds > now // self.seconds - self.slots
+
+    def window(self, series, since, until):
+        # (first bucket, counts, totals, lows, highs) of the slots from since to until, oldest first
+        newest = self.newest[series]
+        seconds, slots = self.seconds, self.slots
+        first = max(int(since // seconds), newest - slots + 1)
+        last = min(int(until // seconds), newest)
+        if newest < 0 or last < first:
+            return first, (), (), (), ()
+        base = series * slots
+        start, end = base + first % slots, base + last % slots + 1
+        if start < end:
+            return (first, self.counts[start:end], self.totals[start:end], self.lows[start:end],
+                    self.highs[start:end])
+        # The window wraps around the end of the ring
+        wrap = base + slots
+        return (first, self.counts[start:wrap] + self.counts[base:end], self.totals[start:wrap] + self.totals[base:end],
+                self.lows[start:wrap] + self.lows[base:end], self.highs[start:wrap] + self.highs[base:end])
+
+    def points(self, series, since, until):
+        # [(bucket start, min, avg, max, count)] of the buckets from since to until with samples
+        first, counts, totals, lows, highs = self.window(series, since, until)
+        if not counts:
+            return []
+        starts = range(first * self.seconds, (first + len(counts)) * self.seconds, self.seconds)
+        selected = list(compress(counts, counts))
+        return list(zip(compress(starts, counts), compress(lows, counts),
+                        map(truediv, compress(totals, counts), selected), compress(highs, counts), selected))
+
+    def summary(self, series, since, until):
+        # (min, avg, max, count) over the buckets from since to until, None without samples
+        _, counts, totals, lows, highs = self.window(series, since, until)
+        count = sum(counts)
+        if not count:
+            return None
+        return (min(compress(lows, counts)), sum(compress(totals, counts)) / count,
+                max(compress(highs, counts)), count)
+
+
+class ReportExtractor:
+    # Samples of one report, parsed piece by piece on the store's thread
+    def __init__(self, store, client, received):
+        self.store = store
+        self.client = client
+        self.received = received
+        self.skip = False  # Set on the event loop when a piece could not be queued
+        self._partial = b''
+        self._overlong = False
+        self._section = None  # None before the first line, then 'header', 'metrics' or 'logs'
+        self._header = {}  # metric -> (total, count, low, high)
+        self._readings = {}  # (metric, minute) -> [total, count, low, high, time]
+        self._minutes = {}  # Timestamp prefix up to the minute -> seconds since the epoch
+
+    def feed(self, data, events=None):
+        # Queue the next decoded piece of the report: its events for CBOR reports, else its text
+        if self.skip:
+            return
+        if not (self.store.submit(self._parse, data) if events is None else self.store.submit(self._events, events)):
+            self.skip = True
+
+    def finish(self):
+        # Queue recording the samples of the complete report
+        if self.skip or not self.store.submit(self._finish):
+            self.store.skipped += 1
+
+    def _parse(self, data):
+        # Text reports only; CBOR reports arrive as events with their fields decoded
+        lines = data.split(b'\n')
+        if self._overlong:
+            self._overlong = len(lines) == 1
+            self._partial = b''
+            del lines[0]
+            if not lines:
+                return
+        lines[0] = self._partial + lines[0]
+        self._partial = lines.pop()
+        if len(self._partial) > MAX_LINE:
+            self._partial = b''
+            self._overlong = True
+        for line in lines:
+            self._line(line)
+
+    def _events(self, events):
+        for kind, value in events:
+            if kind == 'header':
+                self._report_header(value)
+            elif value[2][:1] == b'{' and len(value[2]) <= MAX_LINE:
+                self._reading(value[2])
+
+    def _report_header(self, header):
+        # Fields of a decoded CBOR header
+        for metric, key in (('memory_percent', KEY_MEMORY), ('disk_percent', KEY_DISK)):
+            if type(header.get(key)) in (int, float):
+                self._percent(metric, float(header[key]))
+        metrics = header.get(KEY_METRICS)
+        if not isinstance(metrics, dict):
+            return
+        for name, entry in metrics.items():
+            try:
+                low, avg, high, _, count = entry
+                self._aggregate(str(name), float(low), float(avg), float(high), int(count))
+            except (TypeError, ValueError):
+                continue
+
+    def _finish(self):
+        if self._partial:
+            self._line(self._partial)
+        add = self.store.add
+        for metric, (total, count, low, high) in self._header.items():
+            add(self.client, metric, self.received, total, count, low, high)
+        for (metric, _), (total, count, low, high, t) in self._readings.items():
+            add(self.client, metric, t, total, count, low, high)
+
+    def _line(self, line):
+        if self._section == 'logs':
+            if line[:1] == b'{':
+                self._reading(line)
+            return
+        if self._section is None:
+            # Reports without the header are all log lines
+            self._section = 'header' if line.startswith(b'Timestamp: ') else 'logs'
+            if self._section == 'logs':
+                self._line(line)
+        elif line.startswith(b'Memory Usage: '):
+            self._text_percent('memory_percent', line[14:])
+        elif line.startswith(b'Disk Usage: '):
+            self._text_percent('disk_percent', line[12:])
+        elif line == b'Logs:':
+            self._section = 'logs'
+        elif line.startswith(b'Metrics '):
+            self._section = 'metrics'
+        elif self._section == 'metrics' and line.startswith(b'  '):
+            self._text_aggregate(line)
+
+    def _text_percent(self, metric, text):
+        try:
+            value = float(text.rstrip(b'%'))
+        except ValueError:
+            return  # "unavailable"
+        self._percent(metric, value)
+
+    def _text_aggregate(self, line):
+        # "  name min/avg/max/last count"
+        try:
+            name, values, count = line.split()
+            low, avg, high, _ = (float(value) for value in values.split(b'/'))
+            count = int(count)
+        except ValueError:
+            return
+        self._aggregate(name.decode('utf-8', errors='replace'), low, avg, high, count)
+
+    def _percent(self, metric, value):
+        if metric not in self._header and math.isfinite(value):
+            self._header[metric] = (value, 1, value, value)
+
+    def _aggregate(self, name, low, avg, high, count):
+        if count > 0 and math.isfinite(avg):
+            self._header[name] = (avg * count, count, low, high)
+
+    def _reading(self, line):
+        try:
+            record = _decode_json(line.decode('utf-8'))[0]
+        except ValueError:
+            return
+        if not isinstance(record, dict):
+            return
+        label = record.get(self.store.json_label)
+        t = self.received
+        timestamp = record.get('timestamp')
+        if isinstance(timestamp, str):
+            t = self._time(timestamp)
+            if t > self.received + MAX_SKEW:
+                t = self.received
+        for field in self.store.json_fields:
+            value = record.get(field)
+            if type(value) not in (int, float) or not math.isfinite(value):
+                continue
+            metric = f"{field}:{label}" if isinstance(label, str) else field
+            key = (metric, int(t // 60))
+            entry = self._readings.get(key)
+            if entry is None:
+                self._readings[key] = [value, 1, value, value, t]
+            else:
+                entry[0] += value
+                entry[1] += 1
+                if value < entry[2]:
+                    entry[2] = value
+                if value > entry[3]:
+                    entry[3] = value
+
+    def _time(self, timestamp):
+        # Seconds since the epoch of an ISO timestamp, converting each minute once
+        try:
+            base = self._minutes.get(timestamp[:16])
+            if base is None:
+                base = self._minutes[timestamp[:16]] = datetime.fromisoformat(timestamp[:16]).timestamp()
+            return base + float(timestamp[17:]) if len(timestamp) > 17 else base
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()  # With a time zone
+        except ValueError:
+            return self.received
+
+
+class TimeSeriesStore:
+    # Per-client series of report fields with 1m/1h/1d rollups, owned by one worker thread
+    def __init__(self, directory, slots=(120, 192, 90), max_series=200000, max_series_per_client=64,
+                 json_fields=('temperature', 'humidity'), json_label='sensor_id', max_pending=10000):
+        self.directory = directory
+        self.path = os.path.join(directory, SNAPSHOT_FILE) if directory else None
+        self.rollups = [Rollup(seconds, count) for seconds, count in zip(RESOLUTIONS.values(), slots)]
+        self.max_series = max_series
+        self.max_series_per_client = max_series_per_client
+        self.json_fields = tuple(json_fields)
+        self.json_label = json_label
+        self.max_pending = max_pending
+        self.metrics = {}  # metric -> {client: series number}
+        self.keys = []  # series number -> (client, metric)
+        self.per_client = {}  # client -> number of series
+        self.skipped = 0  # Reports not parsed because the thread was behind; only changed on the event loop
+        self.dropped = 0  # Samples of series over the limits; only changed on the worker thread
+        self._submitted = 0  # Only changed on the event loop
+        self._completed = 0  # Only changed on the worker thread
+        self._dirty = False
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='timeseries')
+
+    @property
+    def pending(self):
+        # Pieces waiting to be parsed
+        return self._submitted - self._completed
+
+    @property
+    def count(self):
+        return len(self.keys)
+
+    def extractor(self, client, received):
+        # Start extracting the samples of one report received from client at received (epoch seconds)
+        return ReportExtractor(self, client, received)
+
+    def submit(self, function, *args):
+        # Queue work for the worker thread; False if it is MAX_PENDING pieces behind
+        if self.pending >= self.max_pending:
+            return False
+        try:
+            self._executor.submit(self._call, function, args)
+        except RuntimeError:
+            return False  # Shut down
+        self._submitted += 1
+        return True
+
+    def _call(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            print(f"Error extracting time series: {e}")
+        finally:
+            self._completed += 1
+
+    async def run(self, function, *args):
+        # Run function on the worker thread, after the work queued before it
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(function, *args))
+
+    def _series(self, client, metric):
+        # Series number of client's metric, created on first use; None over the limits
+        clients = self.metrics.get(metric)
+        if clients is not None:
+            series = clients.get(client)
+            if series is not None:
+                return series
+        if len(self.keys) >= self.max_series or self.per_client.get(client, 0) >= self.max_series_per_client:
+            return None
+        series = len(self.keys)
+        for rollup in self.rollups:
+            rollup.grow()
+        self.keys.append((client, metric))
+        self.metrics.setdefault(metric, {})[client] = series
+        self.per_client[client] = self.per_client.get(client, 0) + 1
+        return series
+
+    def add(self, client, metric, t, total, count=1, low=None, high=None):
+        # Record count samples summing to total, with their minimum and maximum; worker thread only
+        series = self._series(client, metric)
+        if series is None:
+            self.dropped += 1
+            return
+        low = total / count if low is None else low
+        high = total / count if high is None else high
+        for rollup in self.rollups:
+            rollup.add(series, t, total, count, low, high)
+        self._dirty = True
+
+    def rollup_for(self, since, now, resolution=None):
+        # The rollup of the given resolution, or the finest one that still covers since
+        if resolution is not None:
+            seconds = RESOLUTIONS[resolution]
+            return next(rollup for rollup in self.rollups if rollup.seconds == seconds)
+        for rollup in self.rollups:
+            if rollup.covers(since, now):
+                return rollup
+        return self.rollups[-1]
+
+    def query(self, metric=None, client=None, since=None, until=None, resolution=None, summary=False):
+        # Buckets (or summaries) of a metric per client; without metric, the clients per metric
+        if metric is None:
+            return {'metrics': {name: len(clients) for name, clients in sorted(self.metrics.items())}}
+        now = time.time()
+        until = now if until is None else until
+        since = until - 86400 if since is None else since
+        rollup = self.rollup_for(since, now, resolution)
+        clients = self.metrics.get(metric, {})
+        if client is not None:
+            clients = {client: clients[client]} if client in clients else {}
+        series = {}
+        for name, number in clients.items():
+            points = rollup.summary(number, since, until) if summary else rollup.points(number, since, until)
+            if points:
+                series[name] = points
+        return {'metric': metric, 'resolution': rollup.seconds, 'since': since, 'until': until,
+                'series': series}
+
+    def start(self, persist_interval=60.0):
+        # Restore the persisted rings and start persisting them periodically
+        sizes = [(rollup.seconds, rollup.slots) for rollup in self.rollups]
+        try:
+            restored = self.load()
+        except Exception as e:
+            # The series are best effort: a damaged snapshot is kept aside and the rings start empty
+            print(f"Error reading time series snapshot {self.path}, starting empty: {e!r}")
+            self.adopt([], [Rollup(seconds, slots) for seconds, slots in sizes])
+            try:
+                os.replace(self.path, self.path + '.corrupt')
+            except OSError as e:
+                print(f"Error moving {self.path} aside: {e}")
+            restored = 0
+        if self.path:
+            self._task = asyncio.get_running_loop().create_task(self._persist_loop(persist_interval))
+        return restored
+
+    async def close(self):
+        # Stop persisting, write the rings a last time and stop the worker thread
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.run(self.save)
+        self._executor.shutdown(wait=True)
+
+    async def _persist_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run(self.save)
+            except Exception as e:
+                print(f"Error persisting time series: {e}")
+
+    def save(self):
+        # Write the rings atomically if they changed; worker thread only
+        if not self.path or not self._dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        meta = json.dumps({'byteorder': sys.byteorder, 'keys': self.keys,
+                           'rollups': [[rollup.seconds, rollup.slots] for rollup in self.rollups]}).encode('utf-8')
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack('<I', len(meta)) + meta)
+            for rollup in self.rollups:
+                for column in rollup.columns():
+                    column.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self._dirty = False
+
+    def load(self):
+        # Restore the rings written by a previous run; returns the number of series
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        keys, stored = read_snapshot(self.path)
+        if [(r.seconds, r.slots) for r in stored] == [(r.seconds, r.slots) for r in self.rollups]:
+            self.adopt(keys, stored)
+            return len(keys)
+        # The ring sizes were changed: add the stored buckets to the new rings
+        for number, (client, metric) in enumerate(keys):
+            series = self._series(client, metric)
+            if series is None:
+                break
+            for rollup in stored:
+                target = next((r for r in self.rollups if r.seconds == rollup.seconds), None)
+                if target is None or rollup.newest[number] < 0:
+                    continue
+                until = (rollup.newest[number] + 1) * rollup.seconds
+                for start, low, avg, high, count in rollup.points(number, 0, until):
+                    target.add(series, start, avg * count, count, low, high)
+        self._dirty = True
+        return len(keys)
+
+    def adopt(self, keys, rollups):
+        # Take over the series and rings read from a snapshot
+        self.rollups = rollups
+        self.keys = []
+        self.metrics = {}
+        self.per_client = {}
+        for client, metric in keys:
+            self.metrics.setdefault(metric, {})[client] = len(self.keys)
+            self.keys.append((client, metric))
+            self.per_client[client] = self.per_client.get(client, 0) + 1
+
+
+def read_snapshot(path):
+    # ([(client, metric)], [Rollup]) of a file written by TimeSeriesStore.save
+    with open(path, 'rb') as f:
+        if f.read(4) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a time series snapshot")
+        meta = json.loads(f.read(struct.unpack('<I', f.read(4))[0]))
+        keys = [tuple(key) for key in meta['keys']]
+        rollups = []
+        for seconds, slots in meta['rollups']:
+            rollup = Rollup(seconds, slots)
+            for column, count in zip(rollup.columns(), (1, slots, slots, slots, slots)):
+                column.fromfile(f, len(keys) * count)
+                if meta['byteorder'] != sys.byteorder:
+                    column.byteswap()
+            rollups.append(rollup)
+    return keys, rollups
+
+
+def summarize(points):
+    # (min, avg, max, count) over buckets
+    count = sum(point[4] for point in points)
+    return (min(point[1] for point in points), sum(point[2] * point[4] for point in points) / count,
+            max(point[3] for point in points), count)
+
+
+def merge_points(a, b):
+    # Buckets of one client recorded by two worker partitions, combined
+    buckets = {point[0]: point for point in a}
+    for point in b:
+        other = buckets.get(point[0])
+        if other is None:
+            buckets[point[0]] = point
+        else:
+            count = other[4] + point[4]
+            buckets[point[0]] = (point[0], min(other[1], point[1]),
+                                 (other[2] * other[4] + point[2] * point[4]) / count,
+                                 max(other[3], point[3]), count)
+    return [buckets[start] for start in sorted(buckets)]
+
+
+def parse_time(value):
+    # ISO 8601 local time or seconds since the epoch
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid timestamp: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the time series persisted by the CoAP server")
+    parser.add_argument('--directory', default='timeseries', help="Time series directory (default: timeseries)")
+    parser.add_argument('--metric', help="Metric name, e.g. memory_percent")
+    parser.add_argument('--client', help="Client IP address (default: all clients)")
+    parser.add_argument('--since', type=parse_time, help="Start (ISO 8601 or epoch seconds, default: a day ago)")
+    parser.add_argument('--until', type=parse_time, help="End (ISO 8601 or epoch seconds, default: now)")
+    parser.add_argument('--resolution', choices=RESOLUTIONS, help="Bucket size (default: finest covering --since)")
+    parser.add_argument('--summary', action='store_true', help="One min/avg/max/count per client")
+    args = parser.parse_args()
+
+    directories = [args.directory] + [os.path.join(args.directory, name)
+                                      for name in sorted(os.listdir(args.directory))
+                                      if PARTITION_PATTERN.match(name)]
+    result = None
+    for directory in directories:
+        path = os.path.join(directory, SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            continue
+        keys, rollups = read_snapshot(path)
+        store = TimeSeriesStore(None)
+        store.adopt(keys, rollups)
+        part = store.query(args.metric, args.client, args.since, args.until, args.resolution)
+        if result is None:
+            result = part
+        elif args.metric is None:
+            for name, clients in part['metrics'].items():
+                result['metrics'][name] = result['metrics'].get(name, 0) + clients
+        else:
+            for client, points in part['series'].items():
+                result['series'][client] = merge_points(result['series'].get(client, []), points)
+    if result is None:
+        raise SystemExit(f"No time series in {args.directory}")
+    if args.summary and args.metric is not None:
+        result['series'] = {client: summarize(points) for client, points in result['series'].items()}
+    json.dump(result, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+import asyncio
+import base64
+import hashlib
+import heapq
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+from collections import deque, namedtuple
+
+# Token Store
+#
+# Keeps the tokens issued by the CoAP server together with an expiry index so
+# that expired tokens are reclaimed even if they are never presented again.
+#
+# - Entries use __slots__ and monotonic expiry times (immune to clock changes).
+# - A min-heap ordered by expiry is swept periodically by a background task;
+#   heap items whose token was already removed are skipped lazily.
+# - Each user may hold at most max_per_user live tokens; issuing one more
+#   evicts that user's oldest token.
+# - Optionally the live tokens are persisted to a local file (wall-clock
+#   expiry, atomic rename) so that a restart does not force every agent to
+#   re-authenticate at the same time.
+#
+# SignedTokens (the default) keeps no per-token state at all. A token is
+# "<key id>.<username>.<expiry>.<mac>": the username (base64url) and the
+# wall-clock expiry are signed with HMAC-SHA256 under a key from the key file,
+# so validation is a constant-time MAC comparison and an expiry check. Tokens
+# survive restarts, can be validated by every worker process or server that
+# shares the key file, and agents can read their expiry.
+#
+# - The first key in the key file signs new tokens; all listed keys are
+#   accepted. To rotate, add a new key in front ("rotate" below) and remove
+#   the old one once its tokens have expired.
+# - An optional revocation file lists revoked tokens, or user:<name> to
+#   reject every token of a user. Both files are reloaded when they change.
+#
+#   python3 token_store.py rotate <key file>
+#   python3 token_store.py revoke <revocation file> <token | user:NAME>
+
+
+# Contents of the key and revocation files, read by SignedTokens.read() for reload()
+LoadedKeys = namedtuple('LoadedKeys', ['key_file', 'revocation_file', 'keys', 'signing_kid', 'revoked_macs',
+                                       'revoked_users', 'mtimes'])
+
+
+class TokenEntry:
+    __slots__ = ('username', 'expires')
+
+    def __init__(self, username, expires):
+        self.username = username
+        self.expires = expires
+
+
+class TokenStore:
+    # Token -> (username, expiry) map with expiry index and per-user cap
+    def __init__(self, expiry_seconds=3600, max_per_user=0, persist_path=None):
+        self.expiry_seconds = expiry_seconds
+        self.max_per_user = max_per_user  # 0 disables the cap
+        self.persist_path = persist_path
+        self._tokens = {}
+        self._expiry_heap = []
+        self._user_tokens = {}
+        self._task = None
+        self.evicted_expired = 0
+        self.evicted_cap = 0
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def stats(self):
+        # Counters for monitoring
+        return {
+            'live': len(self._tokens),
+            'evicted_expired': self.evicted_expired,
+            'evicted_cap': self.evicted_cap,
+        }
+
+    def issue(self, username):
+        # Create a new token for the user
+        token = str(uuid.uuid4())
+        self._add(token, username, time.monotonic() + self.expiry_seconds)
+        return token
+
+    def validate(self, token):
+        # Return the token's username, or None if unknown or expired
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        if time.monotonic() < entry.expires:
+            return entry.username
+        self._remove(token)
+        self.evicted_expired += 1
+        return None
+
+    def sweep(self):
+        # Remove every expired token; returns the number removed
+        now = time.monotonic()
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, token = heapq.heappop(heap)
+            entry = self._tokens.get(token)
+            if entry is not None and entry.expires == expires:
+                self._remove(token)
+                removed += 1
+        self.evicted_expired += removed
+        return removed
+
+    def start(self, sweep_interval=60.0):
+        # Start the periodic sweeper
+        self._task = asyncio.get_running_loop().create_task(self._run(sweep_interval))
+
+    async def close(self):
+        # Stop the sweeper and persist the remaining tokens
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.sweep()
+        if self.persist_path:
+            await asyncio.get_running_loop().run_in_executor(None, self._save, self._snapshot())
+
+    async def _run(self, sweep_interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(sweep_interval)
+            removed = self.sweep()
+            if removed:
+                print(f"Token sweep: removed {removed} expired tokens, {len(self._tokens)} live")
+            if self.persist_path:
+                try:
+                    await loop.run_in_executor(None, self._save, self._snapshot())
+                except Exception as e:
+                    print(f"Error persisting tokens: {e}")
+
+    def load(self):
+        # Restore tokens persisted by a previous run
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return 0
+        try:
+            with open(self.persist_path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading tokens from {self.persist_path}: {e}")
+            return 0
+        wall_now = time.time()
+        mono_now = time.monotonic()
+        # Oldest first so that the per-user cap keeps the newest tokens
+        for token, (username, wall_expiry) in sorted(saved.items(), key=lambda item: item[1][1]):
+            if wall_expiry > wall_now:
+                self._add(token, username, mono_now + (wall_expiry - wall_now))
+        return len(self._tokens)
+
+    def _snapshot(self):
+        # Convert monotonic expiry times to wall-clock time for persistence
+        offset = time.time() - time.monotonic()
+        return {token: (entry.username, entry.expires + offset)
+                for token, entry in self._tokens.items()}
+
+    def _save(self, snapshot):
+        tmp_path = self.persist_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.persist_path)
+
+    def _add(self, token, username, expires):
+        self._tokens[token] = TokenEntry(username, expires)
+        heapq.heappush(self._expiry_heap, (expires, token))
+        user_tokens = self._user_tokens.setdefault(username, deque())
+        user_tokens.append(token)
+        if self.max_per_user:
+            while len(user_tokens) > self.max_per_user:
+                oldest = user_tokens.popleft()
+                if self._tokens.pop(oldest, None) is not None:
+                    self.evicted_cap += 1
+
+    def _remove(self, token):
+        entry = self._tokens.pop(token)
+        user_tokens = self._user_tokens.get(entry.username)
+        if user_tokens:
+            # Tokens share one lifetime, so the expired one is usually the oldest
+            if user_tokens[0] == token:
+                user_tokens.popleft()
+            else:
+                try:
+                    user_tokens.remove(token)
+                except ValueError:
+                    pass
+            if not user_tokens:
+                del self._user_tokens[entry.username]
+
+
+class SignedTokens:
+    # Stateless tokens "<key id>.<username>.<expiry>.<mac>" (HMAC-SHA256)
+    def __init__(self, key_file, expiry_seconds=3600, revocation_file=None,
+                 reload_check_interval=2.0):
+        self.key_file = key_file
+        self.expiry_seconds = expiry_seconds
+        self.revocation_file = revocation_file
+        self.reload_check_interval = reload_check_interval
+        self._keys = {}
+        self._signing_kid = None
+        self._revoked_macs = set()
+        self._revoked_users = set()
+        self._mtimes = {}
+        self._last_check = 0.0
+        self.issued = 0
+        self.rejected = 0
+        if not os.path.exists(key_file):
+            add_key(key_file)
+            print(f"Created token key file {key_file}")
+        self.reload()
+
+    def __len__(self):
+        return 0  # Nothing is stored per token
+
+    def stats(self):
+        # Counters for monitoring
+        return {
+            'issued': self.issued,
+            'rejected': self.rejected,
+            'keys': len(self._keys),
+            'revoked': len(self._revoked_macs) + len(self._revoked_users),
+        }
+
+    def read(self, key_file, revocation_file):
+        # Parse the keys (the first one signs) and the revocation list into LoadedKeys for reload()
+        keys = {}
+        signing_kid = None
+        mtimes = {}
+        with open(key_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split()
+                if len(parts) != 2 or not parts[0].isalnum():
+                    print(f"Warning: Ignoring invalid token key line in {key_file}")
+                    continue
+                keys[parts[0]] = base64.b64decode(parts[1])
+                signing_kid = signing_kid or parts[0]
+        if signing_kid is None:
+            raise ValueError(f"No token keys in {key_file}")
+        mtimes[key_file] = os.stat(key_file).st_mtime_ns
+
+        macs, users = set(), set()
+        if revocation_file and os.path.exists(revocation_file):
+            now = time.time()
+            with open(revocation_file, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    if line.startswith('user:'):
+                        users.add(line[5:])
+                        continue
+                    parts = line.split('.')
+                    # Revoking an expired token is pointless, skip it
+                    if len(parts) == 4 and parts[2].isdigit() and int(parts[2]) > now:
+                        macs.add(parts[3])
+            mtimes[revocation_file] = os.stat(revocation_file).st_mtime_ns
+        return LoadedKeys(key_file, revocation_file, keys, signing_kid, macs, users, mtimes)
+
+    def reload(self, loaded=None):
+        # Replace the keys and revocations with the files' contents, or with the LoadedKeys read() returned
+        loaded = loaded or self.read(self.key_file, self.revocation_file)
+        self.key_file = loaded.key_file
+        self.revocation_file = loaded.revocation_file
+        self._keys = loaded.keys
+        self._signing_kid = loaded.signing_kid
+        self._revoked_macs = loaded.revoked_macs
+        self._revoked_users = loaded.revoked_users
+        self._mtimes = loaded.mtimes
+
+    def maybe_reload(self):
+        # Reload if a file changed (checked at most once per interval)
+        now = time.monotonic()
+        if now - self._last_check < self.reload_check_interval:
+            return
+        self._last_check = now
+        try:
+            paths = [self.key_file] + ([self.revocation_file] if self.revocation_file else [])
+            for path in paths:
+                mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+                if mtime != self._mtimes.get(path):
+                    self.reload()
+                    print("Reloaded token keys and revocations")
+                    break
+        except Exception as e:
+            print(f"Error reloading token keys: {e}")
+
+    def issue(self, username):
+        # Create a token for the user signed with the current key
+        self.maybe_reload()
+        expires = int(time.time()) + self.expiry_seconds
+        body = f"{self._signing_kid}.{_b64(username.encode('utf-8'))}.{expires}"
+        self.issued += 1
+        return f"{body}.{self._mac(self._keys[self._signing_kid], body)}"
+
+    def validate(self, token):
+        # Return the token's username, or None if forged, malformed, expired or revoked
+        self.maybe_reload()
+        # Valid tokens are ASCII; compare_digest() raises TypeError for other strings
+        parts = token.split('.') if token.isascii() else ()
+        key = self._keys.get(parts[0]) if len(parts) == 4 else None
+        if key is None or not hmac.compare_digest(
+                parts[3], self._mac(key, token[:-len(parts[3]) - 1])):
+            self.rejected += 1
+            return None
+        try:
+            if int(parts[2]) <= time.time():
+                return None
+            username = base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)).decode('utf-8')
+        except ValueError:
+            self.rejected += 1
+            return None
+        if self._revoked_macs or self._revoked_users:
+            if parts[3] in self._revoked_macs or username in self._revoked_users:
+                self.rejected += 1
+                return None
+        return username
+
+    @staticmethod
+    def _mac(key, body):
+        return _b64(hmac.new(key, body.encode('utf-8'), hashlib.sha256).digest()[:16])
+
+    # Nothing to sweep or persist
+    def start(self, sweep_interval=60.0):
+        pass
+
+    async def close(self):
+        pass
+
+    def load(self):
+        return 0
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def add_key(key_file):
+    # Put a new random signing key in front of the key file (key rotation)
+    kid = os.urandom(4).hex()
+    existing = ''
+    if os.path.exists(key_file):
+        with open(key_file, 'r') as f:
+            existing = f.read()
+    tmp_path = key_file + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(f"{kid} {base64.b64encode(os.urandom(32)).decode('ascii')}\n{existing}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, key_file)
+    return kid
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'rotate':
+        print(f"New signing key {add_key(sys.argv[2])} added to {sys.argv[2]}")
+    elif len(sys.argv) == 4 and sys.argv[1] == 'revoke':
+        with open(sys.argv[2], 'a') as f:
+            f.write(sys.argv[3] + '\n')
+        print(f"Revoked {sys.argv[3]}")
+    else:
+        print("Usage: python3 token_store.py rotate <key file>\n"
+              "       python3 token_store.py revoke <revocation file> <token | user:NAME>")
@@ -0,0 +1,154 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import time
+
+# Worker Processes
+#
+# Runs the CoAP server in several processes to use more than one CPU core.
+# Every worker binds the same UDP port with SO_REUSEPORT (set by aiocoap's
+# udp6 transport), so the kernel spreads clients over the workers; a client's
+# address always maps to the same worker, which keeps blockwise transfers on
+# one process.
+#
+# What the workers share:
+# - Tokens are signed with the keys of the shared key file
+#   (token_store.SignedTokens), so any worker validates tokens of the others.
+# - Each worker writes its own sink partition (record_store.py), so records
+#   are never interleaved; queries merge the partitions.
+# - Received reports are relayed between the workers over Unix datagram
+#   sockets (TailRelay) so that a live tail observer on one worker also sees
+#   reports received by the others. Reports are only relayed while observers
+#   exist, and the relay drops reports rather than block when a peer lags.
+#
+# The supervisor restarts workers that exit unexpectedly and forwards SIGINT,
+# SIGTERM and SIGHUP (configuration reload) to all of them.
+
+RESTART_DELAY = 1.0  # Seconds before a crashed worker is restarted
+
+
+class WorkerGroup:
+    # Supervisor side: forks the workers and keeps them running
+    def __init__(self, count):
+        self.count = count
+        # One datagram socket pair per worker: [0] is read by it, [1] written by its peers
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+        for channel in self.channels:
+            for sock in channel:
+                sock.setblocking(False)
+        # Live tail observers per worker
+        self.observer_counts = multiprocessing.Array('i', count, lock=False)
+        self._pids = {}
+        self._stopping = False
+
+    def run(self, target):
+        # Fork the workers, each calling target(index), and supervise them
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        for index in range(self.count):
+            self._spawn(target, index)
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            index = self._pids.pop(pid, None)
+            if index is None or self._stopping:
+                continue
+            print(f"Worker {index} exited with status {status}, restarting")
+            self.observer_counts[index] = 0  # Its observations are gone
+            time.sleep(RESTART_DELAY)
+            if not self._stopping:
+                self._spawn(target, index)
+
+    def _spawn(self, target, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)  # Until the worker handles reloads
+            code = 0
+            try:
+                target(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                print(f"Worker {index} failed: {e}")
+                code = 1
+            os._exit(code)
+        self._pids[pid] = index
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reload(self, signum, frame):
+        # Every worker reloads the configuration itself
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def relay(self, index, live_tail):
+        # TailRelay for the worker with the given index (called in the worker)
+        inbox = self.channels[index][0]
+        peers = [channel[1] for i, channel in enumerate(self.channels) if i != index]
+        return TailRelay(live_tail, inbox, peers, self.observer_counts, index)
+
+
+class TailRelay:
+    # LiveTail front end that also shares reports with the other workers
+    def __init__(self, live_tail, inbox, peers, observer_counts, index):
+        self.live_tail = live_tail
+        self.inbox = inbox
+        self.peers = peers
+        self.observer_counts = observer_counts
+        self.index = index
+        self.relayed = 0
+        self.dropped = 0
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.inbox.fileno(), self._receive)
+
+    def subscribe(self, client, user, notify):
+        observer = self.live_tail.subscribe(client, user, notify)
+        self.observer_counts[self.index] = len(self.live_tail.observers)
+        return observer
+
+    def unsubscribe(self, observer):
+        self.live_tail.unsubscribe(observer)
+        self.observer_counts[self.index] = len(self.live_tail.observers)
+
+    def publish(self, meta, data, total=None):
+        self.live_tail.publish(meta, data, total)
+        # Only this worker writes its slot, so the unlocked reads are safe enough
+        if not any(count for i, count in enumerate(self.observer_counts) if i != self.index):
+            return
+        message = pickle.dumps((meta, bytes(data[:self.live_tail.max_notify_bytes]),
+                                len(data) if total is None else total))
+        for peer in self.peers:
+            try:
+                peer.send(message)
+                self.relayed += 1
+            except (BlockingIOError, OSError):
+                self.dropped += 1
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.inbox.recv(65536)
+            except BlockingIOError:
+                return
+            meta, data, total = pickle.loads(message)
+            self.live_tail.publish(meta, data, total)
@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from aiocoap import CON, NON, Context, Message
+from aiocoap.numbers.codes import Code
+
+import sensor_1
+from sensor_1 import generate_sensor_data
+
+# The agent's report encoder, so the generated load matches real agent reports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'agent'))
+from report_format import CONTENT_FORMAT_CBOR, CONTENT_FORMAT_TEXT, cbor_available, encode_report
+
+# CoAP Load Generator
+#
+# Simulates thousands of virtual agents from one process to measure the
+# capacity of the CoAP server. All virtual agents share one client context
+# (one UDP socket); each has its own sensor ID and token. Reports are built
+# like the agent builds them (text or CBOR, see agent/report_format.py), with
+# log lines made of generate_sensor_data() records.
+#
+# - Arrivals: reports arrive at --rate per second in total, spaced evenly
+#   (constant), at random (poisson) or in groups (burst:<size>); each arrival
+#   is sent by a random virtual agent.
+# - Payload sizes: bytes of log data per report drawn from fixed:<bytes>,
+#   uniform:<min>:<max> or lognormal:<median>:<sigma>. Payloads are built
+#   ahead of the run (--payload-pool) so building them does not load the
+#   generator during the measurement. Reports larger than one block are sent
+#   with Block1.
+# - Auth patterns: a virtual agent either obtains a token from /auth and sends
+#   it with its reports (renewing it after 4.01), or sends the Authorization
+#   fallback with every report (--fallback-share of the agents).
+# - Latency is measured from the scheduled arrival time, not from the moment
+#   the request was actually sent, so a saturated generator or server shows up
+#   in the latency instead of silently lowering the offered load. Arrivals
+#   beyond --max-in-flight outstanding reports are dropped and counted.
+#
+# A virtual agent sends one report at a time, like the agent; reports that
+# arrive while it is busy wait for it. Requests are confirmable like the
+# agent's, or non-confirmable with --non (lost messages are not retransmitted
+# and count as timeouts).
+#
+# Results are printed and saved as JSON (--output); with --baseline a previous
+# result file is compared against, and --fail-on-regression makes the run
+# fail when throughput or p99 latency got worse by more than the given percent.
+#
+# Usage:
+#   python3 load_generator.py [--agents 1000] [--rate 500] [--duration 30]
+#                             [--payload lognormal:512:1.0] [--arrival poisson]
+#                             [--fallback-share 0.1] [--output results.json]
+
+Chunk = namedtuple('Chunk', ['path', 'offset', 'data'])
+
+SOURCE_FILE = '/var/log/sensor_data/sensor_data.json'  # Log file the virtual agents report from
+
+
+class VirtualAgent:
+    # State of one simulated agent
+    def __init__(self, number, fallback):
+        self.sensor_id = f"{sensor_1.SENSOR_ID}-{number}"
+        self.fallback = fallback
+        self.token = None
+        self.lock = asyncio.Lock()  # An agent sends one report at a time
+
+
+class Stats:
+    # Outcome counters and latencies of one request type
+    def __init__(self):
+        self.latencies = []
+        self.codes = Counter()
+        self.timeouts = 0
+        self.failures = 0
+
+    def summary(self, duration):
+        latencies = sorted(self.latencies)
+        return {
+            'ok': len(latencies),
+            'throughput': len(latencies) / duration if duration else 0.0,
+            'codes': dict(self.codes),
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'p999': percentile(latencies, 0.999),
+                'max': latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+
+def percentile(values, fraction):
+    # Percentile of sorted values in milliseconds
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def payload_distribution(spec):
+    # Return a function drawing payload sizes from fixed:N, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA
+    kind, *params = spec.split(':')
+    try:
+        values = [float(value) for value in params]
+    except ValueError:
+        values = None
+    if kind == 'fixed' and values and len(values) == 1:
+        return lambda: int(values[0])
+    if kind == 'uniform' and values and len(values) == 2:
+        return lambda: random.randint(int(values[0]), int(values[1]))
+    if kind == 'lognormal' and values and len(values) == 2:
+        return lambda: int(random.lognormvariate(math.log(values[0]), values[1]))
+    raise argparse.ArgumentTypeError(f"invalid payload size distribution: {spec}")
+
+
+def arrival_pattern(spec):
+    # Return (burst size, poisson) for constant, poisson or burst:N
+    if spec == 'constant':
+        return 1, False
+    if spec == 'poisson':
+        return 1, True
+    if spec.startswith('burst:') and spec[6:].isdigit() and int(spec[6:]) > 0:
+        return int(spec[6:]), False
+    raise argparse.ArgumentTypeError(f"invalid arrival pattern: {spec}")
+
+
+def build_report(sensor_id, size, content_format):
+    # Return a report with about size bytes of sensor log lines, as the agent would send it
+    lines = []
+    total = 0
+    while total < size:
+        line = json.dumps(generate_sensor_data(sensor_id)).encode('utf-8')
+        lines.append(line)
+        total += len(line) + 1
+    data = b'\n'.join(lines)[:max(size - 1, 0)] + b'\n'
+    memory = round(random.uniform(20.0, 80.0), 2)
+    disk = round(random.uniform(20.0, 80.0), 2)
+    if content_format == CONTENT_FORMAT_CBOR:
+        return b''.join(encode_report(time.time(), memory, disk, [Chunk(SOURCE_FILE, 0, data)]))
+    header = (f"Timestamp: {datetime.now().isoformat()}\n"
+              f"Memory Usage: {memory:.2f}%\n"
+              f"Disk Usage: {disk:.2f}%\n"
+              f"Logs:\n").encode('utf-8')
+    return header + data
+
+
+class LoadGenerator:
+    # Sends reports of the virtual agents at the configured arrival rate
+    def __init__(self, args, context, agents, payloads):
+        self.args = args
+        self.context = context
+        self.agents = agents
+        self.payloads = payloads
+        self.base_uri = f"coap://{args.host}:{args.port}"
+        self.data_path = args.path if args.path.startswith('/') else '/' + args.path
+        self.auth = "Basic " + base64.b64encode(args.user.encode('utf-8')).decode('ascii')
+        self.mtype = NON if args.non else CON
+        self.content_format = CONTENT_FORMAT_CBOR if args.format == 'cbor' else CONTENT_FORMAT_TEXT
+        self.reports = Stats()
+        self.auths = Stats()
+        self.sent = 0
+        self.dropped = 0
+        self.payload_bytes = 0
+        self.in_flight = 0
+        self.measure_from = None
+
+    async def request(self, message, stats, started, counted):
+        # Send one request; record its latency from started if it counts
+        message.mtype = self.mtype
+        try:
+            response = await asyncio.wait_for(self.context.request(message).response, self.args.timeout)
+        except asyncio.TimeoutError:
+            if counted:
+                stats.timeouts += 1
+            return None
+        except Exception:
+            if counted:
+                stats.failures += 1
+            return None
+        if counted:
+            if response.code.is_successful():
+                stats.latencies.append(time.monotonic() - started)
+            else:
+                stats.codes[str(response.code)] += 1
+        return response
+
+    async def obtain_token(self, agent, counted):
+        # Request a token from /auth
+        message = Message(code=Code.POST, uri=f"{self.base_uri}/auth")
+        message.opt.uri_query = [f"Authorization={self.auth}"]
+        response = await self.request(message, self.auths, time.monotonic(), counted)
+        if response is not None and response.code.is_successful():
+            agent.token = response.payload.decode('utf-8')
+        return agent.token
+
+    async def send_report(self, agent, payload, scheduled):
+        # Send a report once the agent is done with its previous one
+        self.in_flight += 1
+        counted = scheduled >= self.measure_from
+        try:
+            async with agent.lock:
+                await self.send_one(agent, payload, scheduled, counted)
+        finally:
+            self.in_flight -= 1
+
+    async def send_one(self, agent, payload, scheduled, counted):
+        # Authenticate with the agent's token (obtained first if needed) or the Authorization fallback
+        if agent.fallback:
+            query = [f"Authorization={self.auth}"]
+        else:
+            token = agent.token or await self.obtain_token(agent, counted)
+            if token is None:
+                if counted:
+                    self.reports.failures += 1
+                return
+            query = [f"Token={token}"]
+        # The server keys Block1 transfers by client address and query; real agents
+        # each have their own address, the virtual agents are told apart by their ID
+        query.append(f"agent={agent.sensor_id}")
+        message = Message(code=Code.POST, uri=f"{self.base_uri}{self.data_path}", payload=payload,
+                          content_format=self.content_format)
+        message.opt.uri_query = query
+        response = await self.request(message, self.reports, scheduled, counted)
+        if response is not None and response.code == Code.UNAUTHORIZED and not agent.fallback:
+            agent.token = None  # Expired or revoked, get a new one with the next report
+
+    async def run(self):
+        # Generate arrivals for warmup plus duration seconds
+        burst, poisson = arrival_pattern(self.args.arrival)
+        gap = burst / self.args.rate
+        started = time.monotonic()
+        self.measure_from = started + self.args.warmup
+        end = self.measure_from + self.args.duration
+        tasks = set()
+        next_at = started
+        while next_at < end:
+            now = time.monotonic()
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+            # Send every arrival that is due, several per wakeup at high rates
+            now = time.monotonic()
+            while next_at <= now and next_at < end:
+                scheduled = next_at
+                for _ in range(burst):
+                    if scheduled >= self.measure_from:
+                        self.sent += 1
+                    if self.in_flight >= self.args.max_in_flight:
+                        if scheduled >= self.measure_from:
+                            self.dropped += 1
+                        continue
+                    payload = random.choice(self.payloads)
+                    if scheduled >= self.measure_from:
+                        self.payload_bytes += len(payload)
+                    task = asyncio.ensure_future(self.send_report(random.choice(self.agents), payload, scheduled))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                next_at += random.expovariate(1 / gap) if poisson else gap
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+def compare(result, baseline):
+    # Print the changes against a baseline result; return the worst regression in percent
+    worst = 0.0
+    print(f"\nCompared with {baseline['started']}:")
+    for name, current, previous, higher_is_better in (
+            ('throughput', result['reports']['throughput'], baseline['reports']['throughput'], True),
+            ('p50 ms', result['reports']['latency_ms']['p50'], baseline['reports']['latency_ms']['p50'], False),
+            ('p99 ms', result['reports']['latency_ms']['p99'], baseline['reports']['latency_ms']['p99'], False),
+            ('p999 ms', result['reports']['latency_ms']['p999'], baseline['reports']['latency_ms']['p999'], False)):
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous * 100
+        regression = -change if higher_is_better else change
+        if name in ('throughput', 'p99 ms'):
+            worst = max(worst, regression)
+        print(f"  {name:<11} {previous:>10.2f} -> {current:>10.2f} ({change:+.1f}%)")
+    return worst
+
+
+def print_summary(result):
+    reports = result['reports']
+    latency = reports['latency_ms']
+    print(f"Offered {result['offered_rate']:.0f}/s, sent {result['sent']}, dropped {result['dropped']} "
+          f"(in-flight limit), {result['payload_bytes_mean']:.0f} bytes per report")
+    print(f"Reports: {reports['ok']} ok, {reports['throughput']:.0f}/s, errors {reports['codes']}, "
+          f"timeouts {reports['timeouts']}, failures {reports['failures']}")
+    if latency['p50'] is not None:
+        print(f"Latency ms: p50 {latency['p50']:.2f}, p99 {latency['p99']:.2f}, "
+              f"p999 {latency['p999']:.2f}, max {latency['max']:.2f}")
+    auths = result['auth']
+    if auths['ok'] or auths['timeouts'] or auths['codes']:
+        p50 = auths['latency_ms']['p50']
+        print(f"/auth: {auths['ok']} ok, errors {auths['codes']}, timeouts {auths['timeouts']}"
+              + (f", p50 {p50:.2f} ms" if p50 is not None else ""))
+    print(f"Generator CPU: {result['generator_cpu_percent']:.0f}% of one core"
+          + (" (results may be limited by the generator)" if result['generator_cpu_percent'] > 90 else ""))
+
+
+async def run(args):
+    if args.format == 'cbor' and not cbor_available():
+        raise SystemExit("CBOR reports require the cbor2 package")
+    draw_size = payload_distribution(args.payload)
+    fallback_agents = round(args.agents * args.fallback_share)
+    agents = [VirtualAgent(number, number < fallback_agents) for number in range(args.agents)]
+    content_format = CONTENT_FORMAT_CBOR if args.format == 'cbor' else CONTENT_FORMAT_TEXT
+    payloads = [build_report(random.choice(agents).sensor_id, min(max(draw_size(), 0), args.max_payload),
+                             content_format)
+                for _ in range(args.payload_pool)]
+
+    context = await Context.create_client_context()
+    generator = LoadGenerator(args, context, agents, payloads)
+    started = datetime.now()
+    wall_started = time.monotonic()
+    cpu_started = time.process_time()
+    await generator.run()
+    elapsed = time.monotonic() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    return {
+        'started': started.isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'offered_rate': args.rate,
+        'sent': generator.sent,
+        'dropped': generator.dropped,
+        'payload_bytes_mean': generator.payload_bytes / max(generator.sent - generator.dropped, 1),
+        'reports': generator.reports.summary(args.duration),
+        'auth': generator.auths.summary(args.duration),
+        'generator_cpu_percent': cpu / elapsed * 100,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many agents and measure CoAP server capacity")
+    parser.add_argument('--agents', type=int, default=1000, help="Virtual agents")
+    parser.add_argument('--rate', type=float, default=500.0, help="Reports per second, all agents together")
+    parser.add_argument('--arrival', default='poisson', type=str,
+                        help="Arrival pattern: constant, poisson or burst:<size>")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds measured")
+    parser.add_argument('--warmup', type=float, default=3.0, help="Seconds of load before measuring")
+    parser.add_argument('--payload', default='lognormal:512:1.0',
+                        help="Bytes of log data per report: fixed:<n>, uniform:<min>:<max> or "
+                             "lognormal:<median>:<sigma>")
+    parser.add_argument('--max-payload', type=int, default=1024 * 1024, help="Upper bound of the payload size")
+    parser.add_argument('--payload-pool', type=int, default=1000, help="Reports built ahead of the run")
+    parser.add_argument('--format', choices=('text', 'cbor'), default='text', help="Report encoding")
+    parser.add_argument('--fallback-share', type=float, default=0.0,
+                        help="Share of agents sending the Authorization fallback instead of a token (0-1)")
+    parser.add_argument('--non', action='store_true', help="Send non-confirmable requests")
+    parser.add_argument('--max-in-flight', type=int, default=5000, help="Outstanding reports before arrivals are dropped")
+    parser.add_argument('--timeout', type=float, default=10.0, help="Seconds before a request counts as timed out")
+    parser.add_argument('--host', default=sensor_1.URI_IP, help="Server address (default from sensor_1.conf)")
+    parser.add_argument('--port', type=int, default=int(sensor_1.URI_PORT), help="Server port")
+    parser.add_argument('--path', default=sensor_1.URI_PATH, help="Data resource path")
+    parser.add_argument('--user', default='username:password', help="Credentials as user:password")
+    parser.add_argument('--output', help="Save the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare with the results of a previous run")
+    parser.add_argument('--fail-on-regression', type=float, metavar='PERCENT',
+                        help="Exit with status 1 if throughput or p99 latency regressed by more than PERCENT")
+    args = parser.parse_args()
+    try:
+        payload_distribution(args.payload)
+        arrival_pattern(args.arrival)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    result = asyncio.run(run(args))
+    print_summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            worst = compare(result, json.load(f))
+        if args.fail_on_regression is not None and worst > args.fail_on_regression:
+            print(f"Regression of {worst:.1f}% exceeds {args.fail_on_regression:.1f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
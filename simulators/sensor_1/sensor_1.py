@@ -7,13 +7,19 @@ from aiocoap import *
 from aiocoap.numbers.codes import Code
 from datetime import datetime
 
+from sensor_store import open_store
+
 # CoAP Sensor 1 Implementation
 #
 # This CoAP sensor simulates sensor data generation and sends it to a CoAP server. 
 # It supports the following functionalities:
 # 1. Data Generation: Simulates temperature and humidity sensor data.
-# 2. Data Logging: Saves generated data to a JSON file and logs events.
+# 2. Data Logging: Appends generated data to the sensor data store (JSON Lines,
+#    compacted into columnar segments, see sensor_store.py) and logs events.
 # 3. Data Transmission: Sends the generated data to a specified CoAP server.
+#    Readings are sent one per request, or in batches of BATCH_SIZE readings
+#    to the listener's batch resource, which acknowledges every reading; the
+#    client context is created once and reused for all requests.
 
 # Load configuration from sensor_1.conf
 config = configparser.ConfigParser()
@@ -26,37 +32,35 @@ SENSOR_ID = config['sensor']['SENSOR_ID']
 URI_IP = config['sensor']['URI_IP']
 URI_PORT = config['sensor']['URI_PORT']
 URI_PATH = config['sensor']['URI_PATH']
+READ_INTERVAL = config.getfloat('sensor', 'READ_INTERVAL', fallback=15.0)  # Seconds between readings
+SENSOR_COUNT = config.getint('sensor', 'SENSOR_COUNT', fallback=1)  # Sensors simulated by this gateway
+
+# Batching configuration (optional section, defaults apply when missing)
+BATCH_SIZE = config.getint('batch', 'SIZE', fallback=1)  # 1 = one reading per request
+BATCH_URI_PATH = config.get('batch', 'URI_PATH', fallback='/iot/batch')
+BATCH_MAX_DELAY = config.getfloat('batch', 'MAX_DELAY', fallback=60.0)  # Seconds a reading may wait for its batch
+BATCH_MAX_PENDING = config.getint('batch', 'MAX_PENDING', fallback=10000)  # Oldest readings are dropped beyond
+
+STORE = None  # Sensor data store, opened in main()
+CONTEXT = None  # CoAP client context, created once in main()
+PENDING = []  # Readings waiting to be sent in a batch
 
-# Ensure the directory exists
-os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+# Sensor IDs simulated by this process: SENSOR_ID, then SENSOR_ID-2 ... SENSOR_ID-<SENSOR_COUNT>
+SENSOR_IDS = [SENSOR_ID] + [f"{SENSOR_ID}-{n}" for n in range(2, SENSOR_COUNT + 1)]
 
 # Generate simulated sensor data
-def generate_sensor_data():
+def generate_sensor_data(sensor_id=SENSOR_ID):
     return {
-        "sensor_id": SENSOR_ID,
+        "sensor_id": sensor_id,
         "timestamp": datetime.now().isoformat(),
         "temperature": round(random.uniform(15.0, 25.0), 2),
         "humidity": round(random.uniform(30.0, 70.0), 2)
     }
 
-# Save sensor data to a JSON file
+# Append sensor data to the data store
 def save_sensor_data(data):
     try:
-        if os.path.exists(DATA_FILE) and os.path.getsize(DATA_FILE) > 0:
-            with open(DATA_FILE, 'r') as f:
-                try:
-                    existing_data = json.load(f)
-                except json.JSONDecodeError:
-                    existing_data = []
-        else:
-            existing_data = []
-
-        existing_data.append(data)
-
-        with open(DATA_FILE, 'w') as f:
-            json.dump(existing_data, f, indent=4)
-
+        STORE.append(data)
     except Exception as e:
         log_message(f"Error saving sensor data: {e}")
 
@@ -67,34 +71,85 @@ def log_message(message):
     with open(LOG_FILE, 'a') as logfile:
         logfile.write(json.dumps(log_entry) + '\n')
 
-# Send sensor data to the CoAP server
-async def send_data():
-    context = await Context.create_client_context()
-    data = generate_sensor_data()
+# Build the request URI for a listener path
+def request_uri(path):
+    if not path.startswith('/'):
+        path = '/' + path
+    return f"coap://{URI_IP}:{URI_PORT}{path}"
 
+# Send sensor data to the CoAP server
+async def send_data(data):
     payload = json.dumps({"sensor_data": data}).encode('utf-8')
-
-    global URI_PATH
-    if not URI_PATH.startswith('/'):
-        URI_PATH = '/' + URI_PATH
-
-    request_uri = f"coap://{URI_IP}:{URI_PORT}{URI_PATH}"
     request = Message(code=Code.POST, payload=payload)
-    request.set_request_uri(request_uri)
+    request.set_request_uri(request_uri(URI_PATH))
 
     try:
-        response = await context.request(request).response
+        response = await CONTEXT.request(request).response
         print(f"Received response: {response.code}")
         save_sensor_data(data)
         log_message(f"Data sent successfully: {data}")
     except Exception as e:
         log_message(f"Error sending data: {e}")
 
+# Send up to BATCH_SIZE pending readings in one request
+async def send_batch():
+    batch = PENDING[:BATCH_SIZE]
+    payload = json.dumps({"readings": batch}, separators=(',', ':')).encode('utf-8')
+    request = Message(code=Code.POST, payload=payload)
+    request.set_request_uri(request_uri(BATCH_URI_PATH))
+
+    try:
+        response = await CONTEXT.request(request).response
+        print(f"Received response: {response.code}")
+        if not response.code.is_successful():
+            # Nothing was acknowledged; the readings stay pending for the next attempt
+            log_message(f"Batch of {len(batch)} readings refused: {response.code}")
+            return False
+        result = json.loads(response.payload.decode('utf-8'))
+    except Exception as e:
+        log_message(f"Error sending batch: {e}")
+        return False
+
+    # Every reading is acknowledged; rejected ones are invalid and not sent again
+    rejected = {item['index']: item['error'] for item in result.get('rejected', [])}
+    del PENDING[:len(batch)]
+    for index, data in enumerate(batch):
+        if index in rejected:
+            log_message(f"Reading rejected: {rejected[index]}: {data}")
+        else:
+            save_sensor_data(data)
+    log_message(f"Batch sent successfully: {len(batch) - len(rejected)} readings accepted, "
+                f"{len(rejected)} rejected")
+    return True
+
+# Queue the readings of one interval and send full or overdue batches
+async def send_batched(readings):
+    PENDING.extend(readings)
+    if len(PENDING) > BATCH_MAX_PENDING:
+        log_message(f"Dropping {len(PENDING) - BATCH_MAX_PENDING} unsent readings")
+        del PENDING[:len(PENDING) - BATCH_MAX_PENDING]
+    oldest = datetime.fromisoformat(PENDING[0]['timestamp'])
+    if len(PENDING) < BATCH_SIZE and (datetime.now() - oldest).total_seconds() < BATCH_MAX_DELAY:
+        return
+    while PENDING and await send_batch() and len(PENDING) >= BATCH_SIZE:
+        pass
+
 # Main function to continuously send data
 async def main():
+    global STORE, CONTEXT
+    # Ensure the directory exists
+    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    STORE = open_store(config)
+    CONTEXT = await Context.create_client_context()
     while True:
-        await send_data()
-        await asyncio.sleep(15)  # Wait 15 seconds before sending data again
+        readings = [generate_sensor_data(sensor_id) for sensor_id in SENSOR_IDS]
+        if BATCH_SIZE > 1:
+            await send_batched(readings)
+        else:
+            for data in readings:
+                await send_data(data)
+        await asyncio.sleep(READ_INTERVAL)  # Wait before taking the next readings
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,364 @@
+import argparse
+import bisect
+import configparser
+import json
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+# Sensor Data Store
+#
+# Keeps the readings of the sensor without rewriting what is already stored:
+#
+# - DATA_FILE is append-only JSON Lines, one reading per line, written with a
+#   single write() per reading. A crash can at most tear the last line, which
+#   readers skip. The agent can tail the file like any other log.
+# - When DATA_FILE reaches ROTATE_BYTES it is renamed to DATA_FILE.1 (like
+#   logrotate with delaycompress, so a tailing agent still finishes reading
+#   it) and a new DATA_FILE is started. At the next rotation the previous .1
+#   file is compacted into a columnar segment in ARCHIVE_DIR and removed.
+# - A segment holds the readings sorted by time as arrays (timestamps in
+#   microseconds, sensor index, temperature, humidity), so a range query only
+#   decodes the part it needs. Segments are written to a temporary file,
+#   synced and renamed into place, and named after their first and last
+#   timestamp, so a compaction interrupted by a crash is simply repeated.
+# - A DATA_FILE from older versions (one JSON array) is converted on open.
+# - export and query open the store read-only: nothing is converted, removed
+#   or created, so they can run next to the sensor, and a legacy DATA_FILE
+#   or a .1 file that was already compacted is read as it is.
+#
+# Usage:
+#   python3 sensor_store.py export [--output sensor_data.json] [--since T] [--until T]
+#   python3 sensor_store.py query [--since T] [--until T]
+# export writes the legacy JSON array, query writes JSON Lines; T is an ISO
+# timestamp like 2024-01-01T12:00:00.
+
+SEGMENT_MAGIC = b'SDC1'
+SEGMENT_SUFFIX = '.sdc'
+COLUMNS = ('sensor_id', 'timestamp', 'temperature', 'humidity')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(timestamp):
+    # Microseconds since 1970 of a naive ISO timestamp or datetime, None if it has another form
+    try:
+        moment = timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        return None
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    return (EPOCH + micros * MICROSECOND).isoformat()
+
+
+def parse_lines(path):
+    # Readings in a JSON Lines file; torn or damaged lines are skipped
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield record
+
+
+def read_legacy(path):
+    # Readings of a legacy JSON array file, or None if the file is JSON Lines or missing
+    try:
+        with open(path, 'r') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+    if not text.lstrip().startswith('['):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return salvage_array(text)
+
+
+def salvage_array(text):
+    # Readings of a legacy JSON array, up to the first damaged entry
+    decoder = json.JSONDecoder()
+    records = []
+    position = text.find('[') + 1
+    while position:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        if position >= len(text) or text[position] == ']':
+            break
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except ValueError:
+            break
+        if isinstance(record, dict):
+            records.append(record)
+    return records
+
+
+def columnar(record):
+    # (micros, sensor_id, temperature, humidity) if the reading fits the segment columns exactly
+    if set(record) != set(COLUMNS):
+        return None
+    timestamp, sensor_id = record['timestamp'], record['sensor_id']
+    temperature, humidity = record['temperature'], record['humidity']
+    if not (isinstance(timestamp, str) and isinstance(sensor_id, str)
+            and type(temperature) is float and type(humidity) is float):
+        return None
+    micros = to_micros(timestamp)
+    if micros is None or from_micros(micros) != timestamp:
+        return None  # Would not be exported back unchanged
+    return micros, sensor_id, temperature, humidity
+
+
+def write_segment(directory, records):
+    # Write readings as a segment, atomically; returns its path (None if there were no readings)
+    rows = []
+    others = []
+    for record in records:
+        row = columnar(record)
+        if row is None:
+            others.append(record)
+        else:
+            rows.append(row)
+    if not rows and not others:
+        return None
+    rows.sort(key=lambda row: row[0])
+    others.sort(key=lambda record: to_micros(record.get('timestamp')) or 0)
+    sensor_ids = sorted({row[1] for row in rows})
+    index = {sensor_id: i for i, sensor_id in enumerate(sensor_ids)}
+    bounds = [row[0] for row in rows] + [m for m in (to_micros(r.get('timestamp')) for r in others) if m is not None]
+    first, last = (min(bounds), max(bounds)) if bounds else (0, 0)
+    meta = json.dumps({'count': len(rows), 'sensor_ids': sensor_ids, 'first': first, 'last': last,
+                       'byteorder': sys.byteorder, 'others': others}).encode('utf-8')
+
+    path = os.path.join(directory, f"segment-{first}-{last}{SEGMENT_SUFFIX}")
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(SEGMENT_MAGIC + struct.pack('<I', len(meta)) + meta)
+        array('q', (row[0] for row in rows)).tofile(f)
+        array('H', (index[row[1]] for row in rows)).tofile(f)
+        array('d', (row[2] for row in rows)).tofile(f)
+        array('d', (row[3] for row in rows)).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    return path
+
+
+def read_segment(path, since=None, until=None):
+    # Readings of a segment with since <= timestamp < until (microseconds), in time order
+    with open(path, 'rb') as f:
+        if f.read(4) != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a sensor data segment")
+        meta = json.loads(f.read(struct.unpack('<I', f.read(4))[0]))
+        count = meta['count']
+        columns = []
+        for typecode in ('q', 'H', 'd', 'd'):
+            column = array(typecode)
+            column.fromfile(f, count)
+            if meta['byteorder'] != sys.byteorder:
+                column.byteswap()
+            columns.append(column)
+    timestamps, indexes, temperatures, humidities = columns
+    start = bisect.bisect_left(timestamps, since) if since is not None else 0
+    end = bisect.bisect_left(timestamps, until) if until is not None else count
+    sensor_ids = meta['sensor_ids']
+    rows = ((timestamps[i], {'sensor_id': sensor_ids[indexes[i]], 'timestamp': from_micros(timestamps[i]),
+                             'temperature': temperatures[i], 'humidity': humidities[i]})
+            for i in range(start, end))
+    others = ((to_micros(record.get('timestamp')), record) for record in meta['others'])
+    others = [(micros or 0, record) for micros, record in others if in_range(micros, since, until)]
+    # Merge the few readings stored as JSON into the columns by time
+    for micros, record in rows:
+        while others and others[0][0] <= micros:
+            yield others.pop(0)[1]
+        yield record
+    for _, record in others:
+        yield record
+
+
+def in_range(micros, since, until):
+    if micros is None:
+        return since is None and until is None  # Readings without a usable timestamp only appear unfiltered
+    return (since is None or micros >= since) and (until is None or micros < until)
+
+
+class SensorStore:
+    # Append-only store of sensor readings with rotation and columnar compaction
+    def __init__(self, path, archive_dir, rotate_bytes=1048576):
+        self.path = path
+        self.rotated = path + '.1'
+        self.archive_dir = archive_dir
+        self.rotate_bytes = rotate_bytes
+        self._fd = None
+        self._size = 0
+        self.read_only = False
+
+    def open(self, read_only=False):
+        self.read_only = read_only
+        if read_only:
+            return self
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self._migrate()
+        self._recover()
+        self._open_file()
+        return self
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _open_file(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = os.fstat(self._fd).st_size
+        if self._size:
+            # Terminate a line torn by a crash, so the next reading starts on its own line
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._size += os.write(self._fd, b'\n')
+
+    def _migrate(self):
+        # Convert a legacy JSON array into JSON Lines
+        records = read_legacy(self.path)
+        if records is None:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def _recover(self):
+        # A crash after compacting but before removing the .1 file leaves both; drop the copy
+        if os.path.exists(self.rotated) and self._segment_for(self.rotated) is not None:
+            os.unlink(self.rotated)
+
+    def _segment_for(self, path):
+        bounds = [m for m in (to_micros(r.get('timestamp')) for r in parse_lines(path)) if m is not None]
+        if not bounds:
+            return None
+        segment = os.path.join(self.archive_dir, f"segment-{min(bounds)}-{max(bounds)}{SEGMENT_SUFFIX}")
+        return segment if os.path.exists(segment) else None
+
+    def append(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        if self._size and self._size + len(line) > self.rotate_bytes:
+            self.rotate()
+        self._size += os.write(self._fd, line)
+
+    def rotate(self):
+        # Compact the previous .1 file, then move the current file to .1
+        self.compact()
+        self.close()
+        os.rename(self.path, self.rotated)
+        self._open_file()
+
+    def compact(self):
+        # Move the readings of the .1 file into a segment
+        if not os.path.exists(self.rotated):
+            return None
+        segment = write_segment(self.archive_dir, parse_lines(self.rotated))
+        os.unlink(self.rotated)
+        return segment
+
+    def segments(self):
+        # Segment paths in time order
+        names = []
+        try:
+            listing = os.listdir(self.archive_dir)
+        except FileNotFoundError:
+            return []  # Not created yet; only possible when opened read-only
+        for name in listing:
+            if name.startswith('segment-') and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    first, last = (int(part) for part in name[len('segment-'):-len(SEGMENT_SUFFIX)].split('-'))
+                except ValueError:
+                    continue
+                names.append((first, last, name))
+        return [(first, last, os.path.join(self.archive_dir, name)) for first, last, name in sorted(names)]
+
+    def records(self, since=None, until=None):
+        # Stream the readings with since <= timestamp < until (ISO timestamps or datetimes), oldest first
+        since = to_micros(since) if since is not None else None
+        until = to_micros(until) if until is not None else None
+        for first, last, path in self.segments():
+            if (since is not None and last < since) or (until is not None and first >= until):
+                continue
+            yield from read_segment(path, since, until)
+        for path in (self.rotated, self.path):
+            for record in self._readings(path):
+                if in_range(to_micros(record.get('timestamp')), since, until):
+                    yield record
+
+    def _readings(self, path):
+        # What a writable open() would have recovered or converted is handled here when read-only
+        if self.read_only:
+            if path == self.rotated and self._segment_for(path) is not None:
+                return ()  # Compacted already, its removal was interrupted
+            legacy = read_legacy(path) if path == self.path else None
+            if legacy is not None:
+                return (record for record in legacy if isinstance(record, dict))
+        return parse_lines(path)
+
+    def export_json(self, out, since=None, until=None):
+        # Write the readings as one JSON array, laid out like the legacy DATA_FILE
+        empty = True
+        for record in self.records(since, until):
+            entry = json.dumps(record, indent=4).replace('\n', '\n    ')
+            out.write(('[\n    ' if empty else ',\n    ') + entry)
+            empty = False
+        out.write('[]' if empty else '\n]')
+
+
+def open_store(config, read_only=False):
+    # Open the store configured in a sensor_1.conf
+    return SensorStore(config['sensor']['DATA_FILE'],
+                       config.get('store', 'ARCHIVE_DIR',
+                                  fallback=os.path.join(os.path.dirname(config['sensor']['DATA_FILE']), 'archive')),
+                       config.getint('store', 'ROTATE_BYTES', fallback=1048576)).open(read_only)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or query the stored sensor data")
+    parser.add_argument('command', choices=('export', 'query'))
+    parser.add_argument('--since', help="Only readings at or after this ISO timestamp")
+    parser.add_argument('--until', help="Only readings before this ISO timestamp")
+    parser.add_argument('--output', help="File to write to (default: standard output)")
+    parser.add_argument('--config', default='sensor_1.conf', help="Sensor configuration file")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    store = open_store(config, read_only=True)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.command == 'export':
+            store.export_json(out, args.since, args.until)
+        else:
+            for record in store.records(args.since, args.until):
+                out.write(json.dumps(record) + '\n')
+    finally:
+        store.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
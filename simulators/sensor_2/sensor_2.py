@@ -1,18 +1,31 @@
 import asyncio
 import json
-import random
+import math
 import os
+import signal
 import configparser
+import zlib
+import numpy as np
 from aiocoap import *
 from aiocoap.resource import Resource, Site
 from aiocoap.numbers.codes import Code
 from datetime import datetime
 
 # Description:
-# This script implements a CoAP listener for Sensor 2, which receives sensor data from other devices (like Sensor 1) 
+# This script implements a CoAP listener for Sensor 2, which receives sensor data from other devices (like Sensor 1)
 # and simulates internal adjustments of temperature and humidity based on the received external data.
-# The server responds to POST requests with the data and performs periodic adjustments to internal temperature 
+# The server responds to POST requests with the data and performs periodic adjustments to internal temperature
 # and humidity. It also logs all relevant events and errors to a specified log file in the configuration file.
+# Gateways and dense sensor deployments can POST many readings at once to the batch resource, which
+# acknowledges every reading: {"readings": [...]} is answered with {"accepted": n, "duplicates": n,
+# "rejected": [{"index": i, "error": "..."}]}. Readings that are not newer than the last one of their
+# sensor are acknowledged as duplicates without being applied again, so a batch can safely be resent.
+#
+# One process controls [zones] COUNT zones (a building, not just one room). The state of all zones is
+# kept in NumPy arrays and adjusted in one vectorized step per ADJUSTMENT_INTERVAL. Readings are routed
+# to a zone by their sensor_id (MAP_FILE, or a stable hash of the ID). Log lines are buffered and
+# written together once per LOG_FLUSH_INTERVAL. The zone state is checkpointed to CHECKPOINT_FILE
+# every CHECKPOINT_INTERVAL seconds and on shutdown, and restored on start.
 
 
 # Load configuration from sensor_2.conf
@@ -27,6 +40,18 @@ SENSOR_ID = config['sensor']['SENSOR_ID']
 URI_PATH_PART1 = config['sensor']['URI_PATH_PART1']
 URI_PATH_PART2 = config['sensor']['URI_PATH_PART2']
 
+# Batch resource configuration (optional section, defaults apply when missing)
+BATCH_URI_PATH_PART1 = config.get('batch', 'URI_PATH_PART1', fallback='iot')
+BATCH_URI_PATH_PART2 = config.get('batch', 'URI_PATH_PART2', fallback='batch')
+BATCH_MAX_ITEMS = config.getint('batch', 'MAX_ITEMS', fallback=1000)
+
+# Zone configuration (optional section, defaults apply when missing)
+ZONE_COUNT = config.getint('zones', 'COUNT', fallback=1)
+ZONE_MAP_FILE = config.get('zones', 'MAP_FILE', fallback='')  # Empty = route by hash of the sensor ID
+CHECKPOINT_FILE = config.get('zones', 'CHECKPOINT_FILE', fallback='')  # Empty = no checkpoints
+CHECKPOINT_INTERVAL = config.getfloat('zones', 'CHECKPOINT_INTERVAL', fallback=60.0)
+LOG_FLUSH_INTERVAL = config.getfloat('zones', 'LOG_FLUSH_INTERVAL', fallback=1.0)
+
 print("Configuration values:")
 print(f"LOG_FILE: {LOG_FILE}")
 print(f"URI_IP: {URI_IP}")
@@ -34,6 +59,8 @@ print(f"URI_PORT: {URI_PORT}")
 print(f"SENSOR_ID: {SENSOR_ID}")
 print(f"URI_PATH_PART1: {URI_PATH_PART1}")
 print(f"URI_PATH_PART2: {URI_PATH_PART2}")
+print(f"BATCH_URI_PATH: /{BATCH_URI_PATH_PART1}/{BATCH_URI_PATH_PART2}")
+print(f"ZONE_COUNT: {ZONE_COUNT}")
 
 # Define constants for internal temperature and humidity
 INTERNAL_TEMP_MIN = 20.0
@@ -42,60 +69,158 @@ INTERNAL_HUMIDITY_MIN = 30.0
 INTERNAL_HUMIDITY_MAX = 50.0
 ADJUSTMENT_INTERVAL = 15  # Interval in seconds
 
+# Adjustment ranges (low, high) when the external value is above, below or inside the internal range
+TEMP_ADJUSTMENTS = ((-1.0, -0.5), (0.5, 1.0), (-0.2, 0.2))  # Cool down, heat up, slight adjustment
+HUMIDITY_ADJUSTMENTS = ((-2.0, -1.0), (1.0, 2.0), (-0.5, 0.5))  # Decrease, increase, slight adjustment
+
 # Ensure the directory exists
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
+# Log lines waiting to be written, see flush_log()
+LOG_BUFFER = []
+
 # Function to log messages
-def log_message(message):
+def log_message(message, zone=None):
     timestamp = datetime.now().isoformat()
     log_entry = {"timestamp": timestamp, "sensor_id": SENSOR_ID, "message": message}
-    with open(LOG_FILE, 'a') as logfile:
-        logfile.write(json.dumps(log_entry) + '\n')
+    if zone is not None:
+        log_entry["zone"] = zone
+    LOG_BUFFER.append(json.dumps(log_entry) + '\n')
+
+# Write the buffered log lines with a single write
+def flush_log():
+    if not LOG_BUFFER:
+        return
+    lines = ''.join(LOG_BUFFER)
+    LOG_BUFFER.clear()
+    try:
+        with open(LOG_FILE, 'a') as logfile:
+            logfile.write(lines)
+    except OSError as e:
+        print(f"Error writing log file: {e}")
+
+# Function to simulate internal adjustments of all zones at once
+def adjust(external, internal, minimum, maximum, adjustments, rng):
+    (above_low, above_high), (below_low, below_high), (inside_low, inside_high) = adjustments
+    above = external > maximum
+    below = external < minimum
+    low = np.where(above, above_low, np.where(below, below_low, inside_low))
+    high = np.where(above, above_high, np.where(below, below_high, inside_high))
+    adjustment = low + rng.random(internal.shape) * (high - low)
+    return np.round(np.clip(internal + adjustment, minimum, maximum), 2)
 
 # Function to simulate internal temperature adjustment
-def adjust_internal_temperature(external_temp, internal_temp):
-    if external_temp > INTERNAL_TEMP_MAX:
-        adjustment = random.uniform(-1.0, -0.5)  # Cool down
-    elif external_temp < INTERNAL_TEMP_MIN:
-        adjustment = random.uniform(0.5, 1.0)  # Heat up
-    else:
-        adjustment = random.uniform(-0.2, 0.2)  # Slight adjustment
-
-    new_temp = internal_temp + adjustment
-    new_temp = max(INTERNAL_TEMP_MIN, min(INTERNAL_TEMP_MAX, new_temp))
-    return round(new_temp, 2)
+def adjust_internal_temperature(external_temp, internal_temp, rng):
+    return adjust(external_temp, internal_temp, INTERNAL_TEMP_MIN, INTERNAL_TEMP_MAX, TEMP_ADJUSTMENTS, rng)
 
 # Function to simulate internal humidity adjustment
-def adjust_internal_humidity(external_humidity, internal_humidity):
-    if external_humidity > INTERNAL_HUMIDITY_MAX:
-        adjustment = random.uniform(-2.0, -1.0)  # Decrease humidity
-    elif external_humidity < INTERNAL_HUMIDITY_MIN:
-        adjustment = random.uniform(1.0, 2.0)  # Increase humidity
-    else:
-        adjustment = random.uniform(-0.5, 0.5)  # Slight adjustment
-
-    new_humidity = internal_humidity + adjustment
-    new_humidity = max(INTERNAL_HUMIDITY_MIN, min(INTERNAL_HUMIDITY_MAX, new_humidity))
-    return round(new_humidity, 2)
+def adjust_internal_humidity(external_humidity, internal_humidity, rng):
+    return adjust(external_humidity, internal_humidity, INTERNAL_HUMIDITY_MIN, INTERNAL_HUMIDITY_MAX,
+                  HUMIDITY_ADJUSTMENTS, rng)
+
+# Load the sensor ID -> zone map ("<sensor_id> <zone>" per line)
+def load_zone_map(path):
+    zone_map = {}
+    if not path:
+        return zone_map
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if len(line) == 2:
+                zone_map[line[0]] = int(line[1])
+    return zone_map
+
+# State of all zones, one array element per zone
+class Zones:
+    def __init__(self, count, zone_map=None, seed=None):
+        self.count = count
+        self.zone_map = zone_map or {}
+        for sensor_id, zone in self.zone_map.items():
+            if not 0 <= zone < count:
+                raise ValueError(f"Zone {zone} of {sensor_id} is not between 0 and {count - 1}")
+        self.rng = np.random.default_rng(seed)
+        self.internal_temp = np.round(self.rng.uniform(INTERNAL_TEMP_MIN, INTERNAL_TEMP_MAX, count), 2)
+        self.internal_humidity = np.round(self.rng.uniform(INTERNAL_HUMIDITY_MIN, INTERNAL_HUMIDITY_MAX, count), 2)
+        self.external_temp = np.full(count, np.nan)  # NaN until a reading arrived for the zone
+        self.external_humidity = np.full(count, np.nan)
+        self.last_seen = {}  # sensor_id -> timestamp of its newest reading
+
+    def route(self, sensor_id):
+        # Zone of a sensor: from the map, else a hash of its ID that is stable across restarts
+        zone = self.zone_map.get(sensor_id)
+        if zone is None:
+            zone = self.zone_map[sensor_id] = zlib.crc32(sensor_id.encode('utf-8')) % self.count
+        return zone
+
+    def apply(self, zones, temperatures, humidities):
+        # Set the external conditions of the given zones
+        self.external_temp[zones] = temperatures
+        self.external_humidity[zones] = humidities
+
+    def step(self):
+        # Adjust every zone that has received a reading; returns the indexes of the adjusted zones
+        known = np.flatnonzero(~np.isnan(self.external_temp) & ~np.isnan(self.external_humidity))
+        if known.size == self.count:
+            self.internal_temp = adjust_internal_temperature(self.external_temp, self.internal_temp, self.rng)
+            self.internal_humidity = adjust_internal_humidity(self.external_humidity, self.internal_humidity,
+                                                              self.rng)
+        elif known.size:
+            self.internal_temp[known] = adjust_internal_temperature(
+                self.external_temp[known], self.internal_temp[known], self.rng)
+            self.internal_humidity[known] = adjust_internal_humidity(
+                self.external_humidity[known], self.internal_humidity[known], self.rng)
+        return known
+
+    def save(self, path):
+        # Write a checkpoint atomically
+        temporary = path + '.tmp'
+        sensors = sorted(self.last_seen)
+        with open(temporary, 'wb') as f:
+            np.savez(f, internal_temp=self.internal_temp, internal_humidity=self.internal_humidity,
+                     external_temp=self.external_temp, external_humidity=self.external_humidity,
+                     sensors=np.array(sensors, dtype=str),
+                     last_seen=np.array([self.last_seen[s].isoformat() for s in sensors], dtype=str))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    def load(self, path):
+        # Restore a checkpoint; zones beyond a changed COUNT are dropped or start fresh
+        with np.load(path) as checkpoint:
+            n = min(self.count, len(checkpoint['internal_temp']))
+            for name in ('internal_temp', 'internal_humidity', 'external_temp', 'external_humidity'):
+                getattr(self, name)[:n] = checkpoint[name][:n]
+            self.last_seen = {sensor: datetime.fromisoformat(timestamp)
+                              for sensor, timestamp in zip(checkpoint['sensors'].tolist(),
+                                                           checkpoint['last_seen'].tolist())}
+        return n
+
+# Zone state of this process, created in main()
+ZONES = None
+
+# Write one log line per adjusted zone
+def log_adjustments(zones):
+    prefix = json.dumps({"timestamp": datetime.now().isoformat(), "sensor_id": SENSOR_ID})[:-1]
+    temperatures = ZONES.internal_temp[zones].tolist()
+    humidities = ZONES.internal_humidity[zones].tolist()
+    LOG_BUFFER.extend(f'{prefix}, "zone": {zone}, "message": "Adjusting temperature to {temperature} '
+                      f'and humidity to {humidity}"}}\n'
+                      for zone, temperature, humidity in zip(zones.tolist(), temperatures, humidities))
 
 # CoAP resource to handle incoming POST requests
 class SensorDataResource(Resource):
     def __init__(self):
         super().__init__()
-        self.internal_temp = round(random.uniform(INTERNAL_TEMP_MIN, INTERNAL_TEMP_MAX), 2)
-        self.internal_humidity = round(random.uniform(INTERNAL_HUMIDITY_MIN, INTERNAL_HUMIDITY_MAX), 2)
-        self.external_temp = None
-        self.external_humidity = None
         self.start_periodic_adjustment()
 
     async def render_post(self, request):
         try:
             payload = json.loads(request.payload.decode('utf-8'))
             sensor_data = payload['sensor_data']
-            self.external_temp = sensor_data['temperature']
-            self.external_humidity = sensor_data['humidity']
+            zone = ZONES.route(str(sensor_data.get('sensor_id', '')))
+            ZONES.apply(zone, float(sensor_data['temperature']), float(sensor_data['humidity']))
 
-            log_message(f"Received sensor data: {sensor_data}")
+            log_message(f"Received sensor data: {sensor_data}", zone)
             return Message(code=Code.VALID, payload=b"Sensor data processed")
         except Exception as e:
             log_message(f"Error processing sensor data: {e}")
@@ -103,32 +228,126 @@ class SensorDataResource(Resource):
 
     def start_periodic_adjustment(self):
         asyncio.create_task(self.periodic_adjustment())
+        asyncio.create_task(self.periodic_flush())
 
     async def periodic_adjustment(self):
         while True:
-            if self.external_temp is not None and self.external_humidity is not None:
-                try:
-                    new_internal_temp = adjust_internal_temperature(self.external_temp, self.internal_temp)
-                    new_internal_humidity = adjust_internal_humidity(self.external_humidity, self.internal_humidity)
+            try:
+                log_adjustments(ZONES.step())
+            except Exception as e:
+                log_message(f"Error during adjustment: {e}")
 
-                    log_message(f"Adjusting temperature to {new_internal_temp}")
-                    log_message(f"Adjusting humidity to {new_internal_humidity}")
+            await asyncio.sleep(ADJUSTMENT_INTERVAL)
+
+    async def periodic_flush(self):
+        next_checkpoint = asyncio.get_running_loop().time() + CHECKPOINT_INTERVAL
+        while True:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            flush_log()
+            if CHECKPOINT_FILE and asyncio.get_running_loop().time() >= next_checkpoint:
+                save_checkpoint()
+                next_checkpoint += CHECKPOINT_INTERVAL
 
-                    self.internal_temp = new_internal_temp
-                    self.internal_humidity = new_internal_humidity
-                except Exception as e:
-                    log_message(f"Error during adjustment: {e}")
+# Write the zone state to CHECKPOINT_FILE
+def save_checkpoint():
+    try:
+        ZONES.save(CHECKPOINT_FILE)
+    except Exception as e:
+        print(f"Error writing checkpoint {CHECKPOINT_FILE}: {e}")
 
-            await asyncio.sleep(ADJUSTMENT_INTERVAL)
+# Check one reading of a batch; returns its timestamp or raises ValueError
+def validate_reading(reading):
+    if not isinstance(reading, dict):
+        raise ValueError("reading is not an object")
+    if not isinstance(reading.get('sensor_id'), str):
+        raise ValueError("missing sensor_id")
+    for field in ('temperature', 'humidity'):
+        value = reading.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"missing or non-numeric {field}")
+        # Zone conditions are float64, so huge integers, infinities and NaN are refused here
+        try:
+            if not math.isfinite(float(value)):
+                raise OverflowError
+        except OverflowError:
+            raise ValueError(f"{field} out of range")
+    try:
+        timestamp = datetime.fromisoformat(reading['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("missing or invalid timestamp")
+    # Sensors send local time without an offset; comparing with an offset would fail
+    if timestamp.tzinfo is not None:
+        raise ValueError("timestamp must not carry a UTC offset")
+    return timestamp
+
+# CoAP resource accepting many readings in one request, acknowledged per reading
+class BatchResource(Resource):
+    async def render_post(self, request):
+        try:
+            readings = json.loads(request.payload.decode('utf-8'))['readings']
+            if not isinstance(readings, list):
+                raise ValueError("readings is not an array")
+        except Exception as e:
+            log_message(f"Error processing sensor data batch: {e}")
+            return Message(code=Code.BAD_REQUEST, payload=b"Invalid sensor data batch")
+        if len(readings) > BATCH_MAX_ITEMS:
+            return Message(code=Code.REQUEST_ENTITY_TOO_LARGE,
+                           payload=f"At most {BATCH_MAX_ITEMS} readings per batch".encode('utf-8'))
+
+        accepted = duplicates = 0
+        rejected = []
+        newest = {}  # zone -> (timestamp, temperature, humidity) of its newest reading in the batch
+        for index, reading in enumerate(readings):
+            try:
+                timestamp = validate_reading(reading)
+            except ValueError as e:
+                rejected.append({"index": index, "error": str(e)})
+                continue
+            last = ZONES.last_seen.get(reading['sensor_id'])
+            if last is not None and timestamp <= last:
+                duplicates += 1
+                continue
+            ZONES.last_seen[reading['sensor_id']] = timestamp
+            accepted += 1
+            zone = ZONES.route(reading['sensor_id'])
+            if zone not in newest or timestamp >= newest[zone][0]:
+                newest[zone] = (timestamp, reading['temperature'], reading['humidity'])
+        if newest:
+            _, temperatures, humidities = zip(*newest.values())
+            ZONES.apply(list(newest), temperatures, humidities)
+
+        log_message(f"Received sensor data batch: {accepted} accepted, {duplicates} duplicates, "
+                    f"{len(rejected)} rejected, {len(newest)} zones updated")
+        result = {"accepted": accepted, "duplicates": duplicates, "rejected": rejected}
+        return Message(code=Code.CHANGED, payload=json.dumps(result, separators=(',', ':')).encode('utf-8'),
+                       content_format=50)  # application/json
 
 # Function to start the CoAP server
 async def main():
+    global ZONES
+    ZONES = Zones(ZONE_COUNT, load_zone_map(ZONE_MAP_FILE))
+    if CHECKPOINT_FILE and os.path.exists(CHECKPOINT_FILE):
+        try:
+            print(f"Restored {ZONES.load(CHECKPOINT_FILE)} zones from {CHECKPOINT_FILE}")
+        except Exception as e:
+            print(f"Error reading checkpoint {CHECKPOINT_FILE}, starting fresh: {e}")
+
     root = Site()
     root.add_resource([URI_PATH_PART1, URI_PATH_PART2], SensorDataResource())
+    root.add_resource([BATCH_URI_PATH_PART1, BATCH_URI_PATH_PART2], BatchResource())
     await Context.create_server_context(root, bind=(URI_IP, URI_PORT))
 
     print(f"CoAP server running on {URI_IP}:{URI_PORT}")
-    await asyncio.get_running_loop().create_future()
+    stop = asyncio.get_running_loop().create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+    try:
+        await stop
+    finally:
+        # Keep the state of a clean shutdown, so a restart resumes where it stopped
+        if CHECKPOINT_FILE:
+            save_checkpoint()
+        flush_log()
 
 if __name__ == "__main__":
     asyncio.run(main())